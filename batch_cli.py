@@ -0,0 +1,122 @@
+# 命令行批量处理入口（无需浏览器，进度以JSON Lines输出到标准输出）
+"""
+用法:
+    python -m batch_cli --csv 数据.csv --output /path/cards.pdf
+    python -m batch_cli --db --output /path/cards.pdf [--full-sync]
+    python -m batch_cli --resume 任务ID --output /path/cards.pdf
+    python -m batch_cli --list
+
+退出码:
+    0 处理完成  1 处理失败  3 需要用户选择（使用 --fail-on-selection 时）  4 没有成功处理的证卡
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_SELECTION_REQUIRED = 3
+EXIT_NO_CARDS = 4
+
+logger = logging.getLogger(__name__)
+
+def _emit(event, stream=sys.stdout):
+    """输出一行JSON格式的进度事件"""
+    event = {"time": round(time.time(), 3), **event}
+    stream.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+    stream.flush()
+
+def _strip_message(event):
+    """去掉界面用的换行和缩进，保留便于阅读的文本"""
+    if event.get("message"):
+        event = dict(event, message=event["message"].strip())
+    return event
+
+def run(args):
+    """执行一次批量处理，返回退出码"""
+    from batch_engine import (start_job, start_db_job, resume_job, run_batch, finish_job,
+                              list_unfinished_jobs)
+    from card_processor import processor
+
+    if args.list:
+        for job in list_unfinished_jobs():
+            _emit({"event": "job", **job})
+        return EXIT_OK
+
+    output_dir, output_name = os.path.split(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    if not processor.init_model():
+        _emit({"event": "error", "message": "模型初始化失败"})
+        return EXIT_FAILED
+
+    started = time.perf_counter()
+    if args.resume:
+        job, rows_to_process, start_row, selection_items = resume_job(args.resume, output_dir, output_name)
+    elif args.db:
+        # 边读取数据库边处理，读取失败时run_batch抛出异常
+        job, rows_to_process = start_db_job(output_name, output_dir=output_dir, full_sync=args.full_sync)
+        start_row, selection_items = 0, []
+    else:
+        job, rows_to_process = start_job(args.csv, output_name, output_dir=output_dir)
+        start_row, selection_items = 0, []
+
+    for event in run_batch(job, rows_to_process, start_row, selection_items):
+        if event["event"] == "waiting" and not args.verbose:
+            continue
+        if event["event"] in ("row", "card", "row_done") and args.quiet:
+            continue
+        _emit(_strip_message(event))
+
+        if event["event"] == "selection_required":
+            if args.fail_on_selection:
+                return EXIT_SELECTION_REQUIRED
+            # 无人值守时使用之前保存的选择，没有保存过的使用第一张
+            pdf_path, part_paths, card_count = finish_job(job)
+            _emit({"event": "done", "message": f"处理完成！共处理 {card_count} 张证卡",
+                   "job_id": job.job_id, "pdf_path": pdf_path, "part_paths": part_paths,
+                   "cards": card_count, "selection": "default", "timings": job.timings.as_dict(),
+                   "elapsed": round(time.perf_counter() - started, 3)})
+            return EXIT_OK if card_count else EXIT_NO_CARDS
+
+        if event["event"] == "done":
+            _emit({"event": "summary", "job_id": job.job_id,
+                   "elapsed": round(time.perf_counter() - started, 3), "timings": event["timings"]})
+            return EXIT_OK if event["cards"] else EXIT_NO_CARDS
+
+    return EXIT_FAILED
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m batch_cli", description="证卡批量处理（命令行）")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="CSV文件路径（姓名,正面URL,背面URL，无表头）")
+    source.add_argument("--db", action="store_true", help="从MySQL数据库逐行读取数据并处理")
+    source.add_argument("--resume", metavar="JOB_ID", help="恢复中断的任务")
+    source.add_argument("--list", action="store_true", help="列出未完成的任务")
+    parser.add_argument("--full-sync", action="store_true", help="与--db一起使用：忽略增量同步的水位，完整查询数据库")
+    parser.add_argument("-o", "--output", default="cards_output.pdf", help="输出PDF路径")
+    parser.add_argument("--fail-on-selection", action="store_true",
+                        help="有多卡证图片且没有保存过选择时退出（退出码3），默认使用第一张")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出逐行、逐张的进度事件")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出排队等待事件和详细日志")
+    args = parser.parse_args(argv)
+
+    # 日志输出到标准错误，标准输出只有JSON Lines
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    try:
+        return run(args)
+    except KeyboardInterrupt:
+        _emit({"event": "error", "message": "已中断，可使用 --resume 继续"})
+        return EXIT_FAILED
+    except Exception as e:
+        logger.exception("批量处理失败")
+        _emit({"event": "error", "message": f"处理失败: {e}"})
+        return EXIT_FAILED
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,787 @@
+# 批量处理引擎（与界面无关，Gradio界面和命令行共用）
+import os
+import csv
+import time
+import logging
+from functools import partial
+
+import numpy as np
+
+from batch_job import BatchJob
+from card_processor import processor
+from db_source import StreamedRows, iter_query_rows
+from db_sync import get_delta_sync
+from config import PREFETCH_WORKERS, PREFETCH_DEPTH, INFERENCE_BATCH_SIZE, PDF_SHARDS, PDF_ROWS_PER_FILE, SCHEDULER_POLL_INTERVAL
+from config import PROGRESS_TIMING_SUMMARY, DB_INCREMENTAL_SYNC, SINGLE_FLIGHT_TIMEOUT
+from image_loader import load_for_detection, prefetch_ordered
+from job_journal import JOB_RUNNING, JOB_SELECTING, JOB_DONE, SIDE_CACHED, SIDE_NO_CARD, SIDE_ERROR, SIDE_PENDING
+from pdf_generator import StreamingPdfWriter, generate_pdf_sharded, sort_images_by_type
+from metrics import metrics
+from scheduler import scheduler
+from single_flight import inference_flights
+from thumbnails import thumbnails
+
+logger = logging.getLogger(__name__)
+
+def _prefetch_url(url, cached_paths, stored_results):
+    """预取单个URL：缓存命中时直接返回缓存路径，已有检测结果时无需下载，否则下载并解码图片（大图缩小解码）"""
+    cache_path = cached_paths.get(url)
+    if cache_path:
+        return {"cache_path": cache_path}
+    
+    if url in stored_results:
+        return {"stored": True}
+    
+    try:
+        return {"image": load_for_detection(url)}
+    except Exception as e:
+        # 下载器已经重试过，不再交由模型重新下载
+        logger.warning(f"下载图片失败: {url} - {e}")
+        return {"error": e}
+
+def _iter_outcomes(prefetched, chunk_size, job_id, timer):
+    """
+    按顺序返回每个URL的处理结果：缓存命中或已有检测结果时直接返回，其余图片凑满chunk_size张后统一推理
+
+    Yields:
+        (url, outcome): outcome包含cache_path（缓存命中）、result（模型结果）或error（处理失败）之一；
+                        排队等待模型时会返回 (None, {"waiting": 排队情况})，不对应任何URL
+    """
+    chunk = []
+    pending_count = 0
+    for url, loaded in prefetched:
+        chunk.append((url, loaded))
+        if _needs_inference(loaded):
+            pending_count += 1
+        if pending_count >= chunk_size:
+            yield from _run_chunk(chunk, job_id, timer)
+            chunk = []
+            pending_count = 0
+    
+    if chunk:
+        yield from _run_chunk(chunk, job_id, timer)
+
+def _needs_inference(loaded):
+    """预取结果是否需要调用模型"""
+    return not loaded.get("cache_path") and not loaded.get("stored") and "error" not in loaded
+
+def _infer(inputs, job_id, timer):
+    """与其他任务公平共享模型执行批量推理，排队期间定时返回排队情况，返回与inputs顺序一致的结果列表"""
+    if not inputs:
+        return []
+    ticket = scheduler.request(job_id)
+    try:
+        with timer.stage("queue"):
+            while not ticket.wait(SCHEDULER_POLL_INTERVAL):
+                yield None, {"waiting": scheduler.status(job_id)}
+        with timer.stage("inference"):
+            return processor.process_many(inputs, batch_size=INFERENCE_BATCH_SIZE)
+    finally:
+        scheduler.release(ticket)
+
+def _run_chunk(chunk, job_id, timer):
+    """
+    对一组预取结果中需要推理的图片执行批量推理，并保存完整的检测结果
+
+    其他任务正在推理的URL不重复推理：先推理本任务负责的图片，再等待其他任务的结果
+    （超过SINGLE_FLIGHT_TIMEOUT仍未完成时自行推理）。
+    """
+    inputs = {url: loaded["image"] for url, loaded in chunk if _needs_inference(loaded)}
+    flights = {url: inference_flights.claim(url) for url in inputs}
+    leaders = [url for url, (_, leader) in flights.items() if leader]
+    results = {}
+    try:
+        # 预取时查询之后，其他任务可能已经推理完成并保存了检测结果
+        for url in processor.check_results_many(leaders):
+            result = processor.load_result(url)
+            if result is not None:
+                results[url] = result
+                flight, _ = flights[url]
+                inference_flights.finish(url, flight, result=result)
+        leaders = [url for url in leaders if url not in results]
+        for url, result in zip(leaders, (yield from _infer([inputs[url] for url in leaders], job_id, timer))):
+            results[url] = result
+            # 先保存再结束合并：结束后新来的请求会成为leader，需要能查到已保存的检测结果
+            if not isinstance(result, Exception):
+                processor.save_result(url, result)
+            flight, _ = flights[url]
+            inference_flights.finish(url, flight, result=result)
+    finally:
+        # 推理失败或任务中止时，同样通知等待这些URL的其他任务
+        for url in leaders:
+            flight, _ = flights[url]
+            if not flight.done:
+                inference_flights.finish(url, flight, error=RuntimeError("推理未完成"))
+    
+    retry = []
+    deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT
+    with timer.stage("queue"):
+        for url, (flight, leader) in flights.items():
+            if leader:
+                continue
+            while True:
+                try:
+                    results[url] = flight.wait(SCHEDULER_POLL_INTERVAL)
+                    logger.info(f"使用其他任务的推理结果: {url}")
+                except TimeoutError:
+                    if time.monotonic() < deadline:
+                        yield None, {"waiting": scheduler.status(job_id)}
+                        continue
+                    retry.append(url)
+                except Exception as e:
+                    results[url] = e
+                break
+    if retry:
+        logger.warning(f"等待其他任务推理超时，自行推理 {len(retry)} 张图片")
+        for url, result in zip(retry, (yield from _infer([inputs[url] for url in retry], job_id, timer))):
+            results[url] = result
+            if not isinstance(result, Exception):
+                processor.save_result(url, result)
+    
+    for url, loaded in chunk:
+        if loaded.get("cache_path"):
+            yield url, {"cache_path": loaded["cache_path"]}
+            continue
+        
+        if "error" in loaded:
+            yield url, {"error": loaded["error"]}
+            continue
+        
+        if loaded.get("stored"):
+            # 直接读取之前保存的检测结果
+            result = processor.load_result(url)
+            if result is None:
+                yield url, {"error": RuntimeError("读取已保存的检测结果失败")}
+            else:
+                yield url, {"result": result}
+            continue
+        
+        result = results[url]
+        if isinstance(result, Exception):
+            yield url, {"error": result}
+        else:
+            yield url, {"result": result}
+
+def _format_wait(status):
+    """排队情况的进度文本"""
+    return (f"  ⏳ 模型繁忙，排队中：{status['waiting_jobs']} 个任务共 {status['queue_depth']} 批等待推理，"
+            f"已等待 {status['waited']:.0f} 秒")
+
+def _add_selected_cards(job, url, card_type, row_index, name, output_imgs, selected_indices):
+    """将多卡证图片中选中的卡证按序号保存到缓存并加入处理结果，返回加入的图片路径"""
+    card_paths = []
+    for selected_index in selected_indices:
+        cache_path = processor.check_cache(url, index=selected_index)
+        if not cache_path:
+            if selected_index >= len(output_imgs) or not isinstance(output_imgs[selected_index], np.ndarray):
+                continue
+            # 模型输出直接编码压缩后保存到缓存
+            cache_path = processor.save_to_cache(output_imgs[selected_index], url, index=selected_index)
+            if not cache_path:
+                continue
+        card_paths.append(cache_path)
+    
+    for cache_path in card_paths:
+        job.add_processed_image(cache_path, card_type, row_index, name)
+    return card_paths
+
+def _build_pdf(job):
+    """处理结束后一次性生成PDF（分片并行生成，或按行拆分为多个文件）"""
+    _, image_info_list, _ = job.get_processed_data()
+    # 按照每行先正面后背面的顺序排序（按每张证卡的记录，同一图片被多行引用时每行各自标注）
+    sorted_cards = sort_images_by_type(image_info_list)
+    return generate_pdf_sharded(sorted_cards, job.output_name, job.work_dir)
+
+def read_csv_rows(csv_path):
+    """读取CSV文件（姓名,正面URL,背面URL，无表头），返回每行需要处理的URL"""
+    return [_parse_row(values, i) for i, values in enumerate(iter_csv_rows(csv_path))]
+
+def iter_csv_rows(csv_path):
+    """
+    逐行读取CSV文件，返回 (姓名, 正面URL, 背面URL)
+
+    所有列按字符串读取（不推断类型），缺少的列为空字符串，多出的列忽略，跳过空行。
+    各行列数可以不同（pandas按固定列数解析时，多出的列会被当作行索引使各列错位，或者直接报错）。
+    """
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            if row:
+                yield tuple((row + ["", ""])[:3])
+
+# 导出数据时空值可能被写成这些字符串
+_EMPTY_VALUES = ("", "nan", "None", "NULL")
+
+def _clean_cell(value):
+    """单元格的值去掉首尾空白，空值返回空字符串"""
+    if value is None:
+        return ""
+    value = str(value).strip()
+    return "" if value in _EMPTY_VALUES else value
+
+def _parse_row(values, i):
+    """解析一行数据（姓名, 正面URL, 背面URL），返回该行需要处理的 [(正面/背面, URL, 姓名)]"""
+    name, front_url, back_url = (_clean_cell(value) for value in (list(values) + [None] * 3)[:3])
+    name = name or f"未知_{i+1}"
+    
+    urls_to_process = []
+    if front_url:
+        urls_to_process.append(("正面", front_url, name))
+    if back_url:
+        urls_to_process.append(("背面", back_url, name))
+    return urls_to_process
+
+def _make_selection_item(url, card_type, row_index, name, output_imgs=None):
+    """
+    为多卡证图片准备选择界面的数据（内存中缓存的缩略图），没有可显示的图片时返回None
+
+    output_imgs为None时使用已缓存的缩略图，没有缓存时读取已保存的检测结果。
+    """
+    item_thumbnails = None
+    if output_imgs is None:
+        card_count = processor.check_results_many([url]).get(url)
+        item_thumbnails = thumbnails.get_cached(url, card_count) if card_count else None
+        if item_thumbnails is None:
+            result = processor.load_result(url)
+            output_imgs = result["output_imgs"] if result else []
+    if item_thumbnails is None:
+        item_thumbnails = thumbnails.get_many(url, output_imgs)
+    if not item_thumbnails:
+        return None
+    return {
+        "key": f"{url}_{card_type}",
+        "url": url,
+        "card_type": card_type,
+        "thumbnails": item_thumbnails,
+        "row_index": row_index,
+        "name": name,
+        "rows": [(row_index, name)],  # 引用同一图片的所有行 (行号, 姓名)，选择结果应用到每一行
+        "selected_indices": processor.get_selection(url, card_type)
+    }
+
+def _add_selection(selections, selection_items, url, card_type, row_index, name, output_imgs):
+    """
+    登记一行等待用户选择的多卡证图片，同一图片（URL和正反面相同）被多行引用时只需选择一次
+
+    Args:
+        selections: (URL, 正面/背面) -> 选择界面数据，与selection_items中的项相同
+
+    Returns:
+        bool: 是否已登记（没有可显示的图片时返回False）
+    """
+    item = selections.get((url, card_type))
+    if item is not None:
+        item["rows"].append((row_index, name))
+        return True
+    item = _make_selection_item(url, card_type, row_index, name, output_imgs)
+    if item is None:
+        return False
+    selections[(url, card_type)] = item
+    selection_items.append(item)
+    return True
+
+def _replay_journal(job, rows_to_process, next_row, selection_items):
+    """
+    按任务日志恢复已完成行的处理结果（不下载、不推理），重新生成这些行的PDF页面
+
+    Returns:
+        int: 恢复到的行数；某行的缓存文件或检测结果已丢失时，从该行开始重新处理
+    """
+    journal = processor.job_journal
+    sides_by_row = journal.load_sides(job.job_id, next_row)
+    selections = {(item["url"], item["card_type"]): item for item in selection_items}
+    for i in range(next_row):
+        sides = sides_by_row.get(i, [])
+        # 日志中的记录必须覆盖该行所有URL
+        if len(sides) < len(rows_to_process[i]):
+            return i
+        
+        row_cards = []
+        row_selections = []
+        for side in sides:
+            if side["status"] == SIDE_CACHED:
+                if not all(os.path.exists(path) for path in side["paths"]):
+                    logger.warning(f"第 {i+1} 行的缓存文件已不存在，从该行重新处理")
+                    return i
+                row_cards.extend((path, side["card_type"], side["name"]) for path in side["paths"])
+            elif side["status"] == SIDE_PENDING:
+                # 之前的行引用过同一图片时共用一次选择
+                item = (selections.get((side["url"], side["card_type"]))
+                        or _make_selection_item(side["url"], side["card_type"], i, side["name"]))
+                if item is None:
+                    logger.warning(f"第 {i+1} 行的检测结果已不存在，从该行重新处理")
+                    return i
+                row_selections.append((item, side["name"]))
+        
+        for path, card_type, name in row_cards:
+            job.add_processed_image(path, card_type, i, name)
+        for item, name in row_selections:
+            key = (item["url"], item["card_type"])
+            if selections.get(key) is item:
+                item["rows"].append((i, name))
+            else:
+                selections[key] = item
+                selection_items.append(item)
+            if job.pdf_writer is not None:
+                job.pdf_writer.mark_pending(i)
+        if job.pdf_writer is not None:
+            job.pdf_writer.end_row(i)
+    return next_row
+
+def _event(kind, message=None, **fields):
+    """进度事件：event为事件类型，message为界面显示的进度文本（可为None）"""
+    return {"event": kind, "message": message, **fields}
+
+def _card_event(message, status, **fields):
+    """单个URL的处理结果事件，同时按结果类型计数"""
+    metrics.inc("card_urls_total", 1, "批量处理的URL数量（按处理结果）", status=status)
+    return _event("card", message, status=status, **fields)
+
+# 处理耗时汇总中各阶段的显示名称
+_STAGE_LABELS = (
+    ("cache_lookup", "查询缓存"),
+    ("fetch", "等待下载"),
+    ("queue", "排队"),
+    ("inference", "推理"),
+    ("postprocess", "保存和压缩"),
+    ("pdf", "生成PDF"),
+    ("replay", "恢复日志"),
+)
+
+def format_timings(job):
+    """任务各阶段耗时的汇总文本"""
+    timings = job.timings.as_dict()
+    parts = [f"{label} {timings[stage]:.1f}s" for stage, label in _STAGE_LABELS if timings.get(stage)]
+    elapsed = time.time() - job.created
+    cards = len(job.processed_images)
+    rate = f"，{cards / elapsed:.2f} 张/秒" if elapsed > 0 and cards else ""
+    return f"耗时 {elapsed:.1f}s（{'，'.join(parts) or '无'}）{rate}"
+
+def _next_outcome(outcomes, timer):
+    """取出下一个URL的处理结果，等待下载的时间计入fetch阶段（查询缓存、排队和推理时间单独统计）"""
+    stages = ("cache_lookup", "queue", "inference")
+    before = timer.total(*stages)
+    start = time.perf_counter()
+    url, outcome = next(outcomes)
+    timer.add("fetch", time.perf_counter() - start - (timer.total(*stages) - before))
+    return url, outcome
+
+def _wait_row(rows_to_process, i):
+    """第i行是否存在；边读取边处理时等待该行到达"""
+    if isinstance(rows_to_process, StreamedRows):
+        return rows_to_process.wait(i)
+    return i < len(rows_to_process)
+
+def _total_rows(rows_to_process):
+    """总行数，边读取边处理且数据尚未读完时为None"""
+    if isinstance(rows_to_process, StreamedRows):
+        return rows_to_process.total
+    return len(rows_to_process)
+
+def _row_indices(rows_to_process, start_row):
+    """从start_row开始依次返回行号，数据读完后结束"""
+    i = start_row
+    while _wait_row(rows_to_process, i):
+        yield i
+        i += 1
+
+def _iter_prefetch_urls(rows_to_process, start_row, cached_paths, stored_results, timer):
+    """
+    按行顺序返回需要预取的URL，每个URL只返回一次（第一次出现时）
+
+    返回一批URL之前先批量查询其中命中缓存和已有检测结果的URL（写入cached_paths和stored_results）。
+    CSV文件一次查询全部行；边读取边处理时每次查询已到达的行，不必等数据全部读完。
+    """
+    seen = set()
+    i = start_row
+    while True:
+        try:
+            if not _wait_row(rows_to_process, i):
+                return
+        except RuntimeError:
+            # 读取数据失败时已读取的行照常处理，由逐行处理的循环报告错误
+            return
+        end = len(rows_to_process)
+        refs = [url for j in range(i, end) for _, url, _ in rows_to_process[j]]
+        urls = list(dict.fromkeys(url for url in refs if url not in seen))
+        seen.update(urls)
+        with timer.stage("cache_lookup"):
+            cached_paths.update(processor.check_cache_many(urls))
+            stored_results.update(processor.check_results_many([url for url in urls if url not in cached_paths]))
+        logger.info(f"第 {i+1}-{end} 行：{len(refs)} 个URL中 {len(urls)} 个第一次出现，"
+                    f"缓存命中 {sum(url in cached_paths for url in urls)} 个，"
+                    f"已有检测结果 {sum(url in stored_results for url in urls)} 个")
+        yield from urls
+        i = end
+
+def _shared_outcome(outcome):
+    """
+    URL处理完成后保留给之后引用同一URL的行使用的结果
+
+    检测到证卡时只保留标记（之后从缓存或已保存的检测结果读取），不在内存中保留模型输出的图片。
+    """
+    result = outcome.get("result")
+    if result and result.get("output_imgs"):
+        return {"stored": True}
+    return outcome
+
+def _reuse_outcome(url, shared):
+    """引用已处理过的URL时的处理结果：单张证卡直接使用缓存，多张证卡读取已保存的检测结果"""
+    if not shared.get("stored"):
+        return shared
+    cache_path = processor.check_cache(url)
+    if cache_path:
+        return {"cache_path": cache_path}
+    result = processor.load_result(url)
+    if result is None:
+        return {"error": RuntimeError("读取已保存的检测结果失败")}
+    return {"result": result}
+
+def start_job(csv_path, output_name="output.pdf", output_dir=None):
+    """
+    创建新的批量处理任务并登记到任务日志
+
+    Args:
+        csv_path: CSV文件路径（姓名,正面URL,背面URL）
+        output_name: PDF文件名
+        output_dir: PDF输出目录，None表示使用该任务的临时目录
+
+    Returns:
+        (job, rows_to_process)
+    """
+    job = BatchJob(output_name, output_dir=output_dir)
+    logger.info(f"创建批量处理任务: {job.job_id}")
+    
+    logger.info(f"读取CSV文件: {csv_path}")
+    rows_to_process = read_csv_rows(csv_path)
+    logger.info(f"CSV文件包含 {len(rows_to_process)} 行数据")
+    
+    # 登记到任务日志，中断后可以恢复
+    processor.job_journal.start_job(job.job_id, csv_path, output_name, len(rows_to_process))
+    
+    # 边处理边生成PDF，每凑满一页立即绘制；分片或按行拆分时在处理结束后统一生成
+    if PDF_SHARDS <= 1 and not PDF_ROWS_PER_FILE:
+        job.pdf_writer = StreamingPdfWriter(output_name, job.work_dir)
+    return job, rows_to_process
+
+def start_db_job(output_name="output.pdf", output_dir=None, rows=None, full_sync=False):
+    """
+    创建从数据库边读取边处理的批量处理任务
+
+    查询结果由后台线程通过服务端游标逐行读取，处理从第一行到达时开始，不等待整个查询完成；
+    读取的数据同时写入任务日志目录中的CSV文件，中断后按该文件恢复。
+    启用增量同步（DB_INCREMENTAL_SYNC）时只查询上次同步后新增和变化的行，报表按本地快照重新生成，
+    未变化的行直接使用缓存。
+
+    Args:
+        output_name: PDF文件名
+        output_dir: PDF输出目录，None表示使用该任务的临时目录
+        rows: 行数据的迭代器（姓名, 正面URL, 背面URL），None表示从数据库查询
+        full_sync: 增量同步时忽略水位，执行完整查询
+
+    Returns:
+        (job, rows_to_process)
+    """
+    job = BatchJob(output_name, output_dir=output_dir)
+    logger.info(f"创建批量处理任务（从数据库读取）: {job.job_id}")
+    
+    journal = processor.job_journal
+    csv_path = journal.csv_path(job.job_id)
+    # 总行数在数据读完后更新
+    journal.start_job(job.job_id, csv_path, output_name, 0)
+    if rows is None:
+        rows = get_delta_sync().iter_rows(full=full_sync) if DB_INCREMENTAL_SYNC else iter_query_rows()
+    rows_to_process = StreamedRows(rows, csv_path, _parse_row).start()
+    
+    if PDF_SHARDS <= 1 and not PDF_ROWS_PER_FILE:
+        job.pdf_writer = StreamingPdfWriter(output_name, job.work_dir)
+    return job, rows_to_process
+
+def resume_job(job_id, output_dir=None, output_name=None):
+    """
+    按任务日志恢复中断的任务：已完成的行直接使用日志中的结果
+
+    Args:
+        job_id: 任务ID
+        output_dir: PDF输出目录，None表示使用该任务的临时目录
+        output_name: PDF文件名，None表示沿用创建任务时的文件名
+
+    Returns:
+        (job, rows_to_process, start_row, selection_items)
+
+    Raises:
+        ValueError: 任务不存在或CSV文件已丢失
+    """
+    record = processor.job_journal.get_job(job_id)
+    if record is None or not os.path.exists(record["csv_path"]):
+        raise ValueError(f"任务 {job_id} 不存在或CSV文件已丢失")
+    
+    job = BatchJob(output_name or record["output_name"], job_id=job_id, output_dir=output_dir)
+    rows_to_process = read_csv_rows(record["csv_path"])
+    if len(rows_to_process) != record["total_rows"]:
+        logger.warning(f"任务 {job_id} 的数据在中断前没有读取完整，只能恢复已读取的 {len(rows_to_process)} 行")
+    
+    if PDF_SHARDS <= 1 and not PDF_ROWS_PER_FILE:
+        job.pdf_writer = StreamingPdfWriter(job.output_name, job.work_dir)
+    
+    selection_items = []
+    with job.timings.stage("replay"):
+        start_row = _replay_journal(job, rows_to_process, min(record["next_row"], len(rows_to_process)),
+                                    selection_items)
+    processor.job_journal.set_status(job_id, JOB_RUNNING)
+    return job, rows_to_process, start_row, selection_items
+
+def list_unfinished_jobs():
+    """未完成（可恢复）的任务"""
+    return processor.job_journal.list_unfinished()
+
+def run_batch(job, rows_to_process, start_row=0, selection_items=None):
+    """
+    从start_row开始逐行处理，每个URL的结果和每行的进度写入任务日志
+
+    Yields:
+        dict: 进度事件，event为以下之一：
+            start（开始处理）、row（开始处理一行）、card（一个URL的处理结果）、
+            waiting（排队等待模型）、row_done（一行处理完成）、info（其他提示）、
+            selection_required（有多卡证图片需要用户选择，之后调用finish_job）、
+            done（PDF已生成）
+    """
+    journal = processor.job_journal
+    timer = job.timings
+    selection_items = selection_items if selection_items is not None else []
+    total_rows = _total_rows(rows_to_process)
+    
+    if start_row:
+        yield _event("start", f"恢复任务 {job.job_id}：已完成 {start_row}/{total_rows} 行"
+                              f"（耗时 {timer.total('replay'):.1f} 秒），从第 {start_row + 1} 行继续",
+                     job_id=job.job_id, total_rows=total_rows, start_row=start_row)
+    elif total_rows is None:
+        yield _event("start", f"开始处理，边读取数据边处理（任务ID: {job.job_id}）",
+                     job_id=job.job_id, total_rows=total_rows, start_row=start_row)
+    else:
+        yield _event("start", f"开始处理，共 {total_rows} 行数据（任务ID: {job.job_id}）",
+                     job_id=job.job_id, total_rows=total_rows, start_row=start_row)
+    
+    # 下载线程提前加载后续图片，未命中缓存的图片按批次送入模型，结果按CSV行顺序返回
+    # 启用多进程工作池时每次凑够所有工作进程的批次，让各进程同时推理
+    chunk_size = INFERENCE_BATCH_SIZE * processor.parallelism
+    cached_paths, stored_results = {}, {}
+    prefetch_tasks = _iter_prefetch_urls(rows_to_process, start_row, cached_paths, stored_results, timer)
+    prefetched = prefetch_ordered(prefetch_tasks,
+                                  partial(_prefetch_url, cached_paths=cached_paths,
+                                          stored_results=stored_results),
+                                  workers=PREFETCH_WORKERS,
+                                  depth=max(PREFETCH_DEPTH, chunk_size))
+    outcomes = _iter_outcomes(prefetched, chunk_size, job.job_id, timer)
+    # 已处理的URL -> 处理结果，同一URL被多行引用时只下载和推理一次
+    shared_outcomes = {}
+    # 等待选择的图片，同一图片被多行引用时只需选择一次
+    selections = {(item["url"], item["card_type"]): item for item in selection_items}
+    
+    # 处理每一行
+    for i in _row_indices(rows_to_process, start_row):
+        total_rows = _total_rows(rows_to_process)
+        if total_rows is None:
+            row_info = f"\n处理第 {i+1} 行（已读取 {len(rows_to_process)} 行）"
+        else:
+            row_info = f"\n处理第 {i+1}/{total_rows} 行"
+        logger.info(row_info.strip())
+        yield _event("row", row_info, row=i, total_rows=total_rows)
+        
+        urls_to_process = rows_to_process[i]
+        logger.info(f"第 {i+1} 行需要处理 {len(urls_to_process)} 个URL")
+        
+        for card_type, url, name in urls_to_process:
+            if url in shared_outcomes:
+                outcome = _reuse_outcome(url, shared_outcomes[url])
+            else:
+                _, outcome = _next_outcome(outcomes, timer)
+                while "waiting" in outcome:
+                    # 模型正在处理其他用户的任务，返回排队情况
+                    yield _event("waiting", _format_wait(outcome["waiting"]), **outcome["waiting"])
+                    _, outcome = _next_outcome(outcomes, timer)
+                shared_outcomes[url] = _shared_outcome(outcome)
+            
+            card = {"row": i, "card_type": card_type, "url": url}
+            try:
+                logger.info(f"处理 {card_type} URL: {url}")
+                
+                # 检查缓存中是否已有处理好的图片（预取时已检查）
+                cache_path = outcome.get("cache_path")
+                if cache_path:
+                    # 使用缓存中的图片（直接使用缓存路径，不生成临时文件）
+                    logger.info(f"使用缓存图片: {cache_path}")
+                    # 直接使用缓存图片路径，不进行额外压缩
+                    job.add_processed_image(cache_path, card_type, i, name)
+                    journal.record_side(job.job_id, i, card_type, url, name, SIDE_CACHED, [cache_path])
+                    yield _card_event(f"  ✓ {card_type}: 使用缓存图片", status="cache_hit", count=1, **card)
+                    continue
+                
+                # 没有缓存，使用批量推理（或之前保存）的检测结果
+                if "error" in outcome:
+                    raise outcome["error"]
+                result = outcome["result"]
+                
+                if result and result.get("output_imgs"):
+                    cards_count = len(result["output_imgs"])
+                    
+                    # 检查是否需要用户选择
+                    saved_selection = processor.get_saved_selection(url, card_type) if cards_count > 1 else None
+                    if saved_selection is not None:
+                        # 之前已选择过，直接使用保存的选择
+                        with timer.stage("postprocess"):
+                            card_paths = _add_selected_cards(job, url, card_type, i, name, result["output_imgs"], saved_selection)
+                        journal.record_side(job.job_id, i, card_type, url, name, SIDE_CACHED, card_paths)
+                        logger.info(f"  ✓ {card_type}: 使用已保存的选择 {saved_selection}")
+                        yield _card_event(f"  ✓ {card_type}: 使用已保存的选择，{len(card_paths)} 张证卡",
+                                          status="saved_selection", count=len(card_paths), **card)
+                    elif cards_count > 1:
+                        # 准备选择数据（其他行已引用同一图片时共用一次选择）
+                        if _add_selection(selections, selection_items, url, card_type, i, name,
+                                          result["output_imgs"]):
+                            # 该行等待用户选择，PDF暂停输出到这一行
+                            if job.pdf_writer is not None:
+                                job.pdf_writer.mark_pending(i)
+                        journal.record_side(job.job_id, i, card_type, url, name, SIDE_PENDING)
+                        
+                        logger.info(f"  ⚠ {card_type}: 检测到 {cards_count} 张卡证，需要选择")
+                        yield _card_event(f"  ⚠ {card_type}: 检测到 {cards_count} 张卡证，需要选择",
+                                          status="selection_pending", count=cards_count, **card)
+                    else:
+                        # 只有一张卡证，直接处理
+                        card_paths = []
+                        with timer.stage("postprocess"):
+                            for img in result["output_imgs"]:
+                                if isinstance(img, np.ndarray):
+                                    # 模型输出直接编码为压缩后的缓存文件，用于显示和PDF生成
+                                    cache_path = processor.save_to_cache(img, url)
+                                    if not cache_path:
+                                        continue
+                                    job.add_processed_image(cache_path, card_type, i, name)
+                                    card_paths.append(cache_path)
+                        
+                        journal.record_side(job.job_id, i, card_type, url, name, SIDE_CACHED, card_paths)
+                        logger.info(f"  ✓ {card_type}: 1 张证卡")
+                        yield _card_event(f"  ✓ {card_type}: 1 张证卡", status="processed", count=1, **card)
+                
+                else:
+                    journal.record_side(job.job_id, i, card_type, url, name, SIDE_NO_CARD)
+                    logger.warning(f"  ✗ {card_type}: 未检测到证卡")
+                    yield _card_event(f"  ✗ {card_type}: 未检测到证卡", status="no_card", count=0, **card)
+                
+            except Exception as e:
+                error_msg = f"  ✗ {card_type}: 处理失败 - {str(e)}"
+                journal.record_side(job.job_id, i, card_type, url, name, SIDE_ERROR, message=str(e))
+                logger.error(error_msg)
+                yield _card_event(error_msg, status="error", count=0, error=str(e), **card)
+        
+        # 该行处理完成，凑满一页的证卡立即写入PDF
+        with timer.stage("pdf"):
+            if job.pdf_writer is not None:
+                job.pdf_writer.end_row(i)
+        journal.end_row(job.job_id, i)
+        yield _event("row_done", row=i, total_rows=total_rows)
+    
+    if isinstance(rows_to_process, StreamedRows):
+        total_rows = rows_to_process.total
+        journal.set_total_rows(job.job_id, total_rows)
+        yield _event("info", f"\n共读取 {total_rows} 行数据", total_rows=total_rows)
+    
+    total_wait = scheduler.status(job.job_id)["total_wait"]
+    if total_wait >= 1:
+        yield _event("info", f"\n与其他任务共享模型，排队等待共 {total_wait:.0f} 秒", total_wait=round(total_wait, 3))
+    
+    if PROGRESS_TIMING_SUMMARY:
+        yield _event("info", f"\n{format_timings(job)}")
+    
+    # 如果有需要选择的卡证，等待用户选择后再调用finish_job
+    if selection_items:
+        job.set_selection_data(selection_items)
+        journal.set_status(job.job_id, JOB_SELECTING)
+        yield _event("selection_required", f"\n⚠ 需要选择 {len(selection_items)} 组卡证",
+                     job_id=job.job_id, items=len(selection_items), timings=timer.as_dict())
+        return
+    
+    # 如果没有需要选择的卡证，PDF已随处理过程生成，只需输出最后一页
+    pdf_path, part_paths, card_count = finish_job(job)
+    for part_path in part_paths:
+        yield _event("info", f"分段PDF: {os.path.basename(part_path)}", part_path=part_path)
+    if card_count:
+        logger.info(f"批量处理完成！共处理 {card_count} 张证卡，PDF保存至: {pdf_path}")
+        message = f"\n处理完成！共处理 {card_count} 张证卡"
+    else:
+        logger.warning("没有成功处理的证卡")
+        message = "\n没有成功处理的证卡"
+    yield _event("done", message, job_id=job.job_id, pdf_path=pdf_path, part_paths=part_paths,
+                 cards=card_count, timings=timer.as_dict())
+
+def finish_job(job, output_name=None):
+    """
+    应用用户的选择并完成PDF
+
+    需要选择的卡证直接从检测结果存储中读取选中的裁剪图片（没有保存过选择时使用第一张）。
+
+    Args:
+        job: 批量处理任务
+        output_name: 新的PDF文件名（仅在处理结束后统一生成PDF时有效）
+
+    Returns:
+        (pdf_path, part_paths, card_count): 没有处理成功的证卡时pdf_path为None
+    """
+    timer = job.timings
+    selection_items = job.get_selection_data()
+    
+    results = {}
+    pending_items = []
+    for item in selection_items:
+        result = processor.load_result(item["url"])
+        if result is None:
+            pending_items.append(item)
+        else:
+            results[item["url"]] = result
+    
+    # 检测结果丢失时才重新推理
+    if pending_items:
+        logger.warning(f"{len(pending_items)} 个URL没有保存的检测结果，重新推理")
+        with scheduler.slot(job.job_id), timer.stage("inference"):
+            results_list = processor.process_many([item["url"] for item in pending_items])
+        for item, result in zip(pending_items, results_list):
+            if isinstance(result, Exception):
+                logger.error(f"重新处理 {item['card_type']} URL失败: {item['url']} - {result}")
+                continue
+            processor.save_result(item["url"], result)
+            results[item["url"]] = result
+    
+    pdf_writer = job.pdf_writer
+    for item in selection_items:
+        url = item["url"]
+        card_type = item["card_type"]
+        result = results.get(url)
+        selected_indices = processor.get_selection(url, card_type)
+        # 同一次选择应用到引用该图片的每一行
+        for row_index, name in item["rows"]:
+            if result and result.get("output_imgs"):
+                with timer.stage("postprocess"):
+                    _add_selected_cards(job, url, card_type, row_index, name,
+                                        result["output_imgs"], selected_indices)
+            if pdf_writer is not None:
+                # 该组选择完成，之后已就绪的页面继续写入PDF
+                with timer.stage("pdf"):
+                    pdf_writer.resolve_pending(row_index)
+    
+    processed_images, _, _ = job.get_processed_data()
+    pdf_path, part_paths = None, []
+    if processed_images:
+        with timer.stage("pdf"):
+            if pdf_writer is not None:
+                # 之前的页面已在批量处理过程中生成，这里只输出剩余部分
+                pdf_path = pdf_writer.close()
+            else:
+                if output_name:
+                    job.output_name = output_name
+                pdf_path, part_paths = _build_pdf(job)
+                if part_paths:
+                    logger.info(f"分段PDF: {', '.join(part_paths)}")
+    job.pdf_writer = None
+    processor.job_journal.set_status(job.job_id, JOB_DONE)
+    job.set_selection_data([])
+    return pdf_path, part_paths, len(processed_images)
\ No newline at end of file
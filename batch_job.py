@@ -0,0 +1,89 @@
+# 批量处理任务状态（每个用户的每次批量处理各自独立）
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class StageTimer:
+    """按处理阶段累计耗时（秒）"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """在with块内计时，计入name阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def total(self, *stages):
+        return sum(self.totals.get(stage, 0.0) for stage in stages)
+
+    def as_dict(self):
+        return {stage: round(seconds, 3) for stage, seconds in self.totals.items()}
+
+class BatchJob:
+    """
+    一次批量处理的全部状态
+
+    通过 gr.State 在批量处理、卡证选择和生成PDF之间传递，
+    多个用户同时处理时互不影响。模型、缓存和检测结果存储仍由全局 processor 共享。
+    """
+
+    def __init__(self, output_name="output.pdf", job_id=None, output_dir=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]  # 恢复任务时沿用任务日志中的ID
+        self.output_name = output_name
+        self.created = time.time()
+        # 该任务输出的PDF目录，未指定时使用单独的临时目录
+        self._owns_work_dir = output_dir is None
+        self.work_dir = output_dir or tempfile.mkdtemp(prefix=f"job_{self.job_id}_")
+        self.timings = StageTimer()  # 各处理阶段的累计耗时
+        self.selection_data = []  # 需要用户选择的卡证
+        self.processed_images = []  # 处理后的图片路径
+        self.image_info_list = []  # 每张证卡的记录（路径、正面/背面、行索引、姓名），同一图片被多行引用时各有一条
+        self.names_list = []  # 姓名信息
+        self.pdf_writer = None  # 增量PDF生成器（批量处理时边处理边生成）
+
+    def add_processed_image(self, image_path, card_type, row_index, name=None):
+        """添加处理后的图片"""
+        self.processed_images.append(image_path)
+        self.image_info_list.append({
+            "path": image_path,
+            "type": card_type,
+            "row_index": row_index,
+            "name": name
+        })
+        if name:
+            self.names_list.append(name)
+        metrics.inc("card_cards_total", 1, "加入PDF的证卡数量", card_type=card_type)
+        if self.pdf_writer is not None:
+            self.pdf_writer.add_card(row_index, image_path, card_type, name)
+
+    def get_processed_data(self):
+        """获取所有处理后的数据"""
+        return self.processed_images, self.image_info_list, self.names_list
+
+    def set_selection_data(self, data):
+        """设置需要选择的数据"""
+        self.selection_data = data
+
+    def get_selection_data(self):
+        """获取需要选择的数据"""
+        return self.selection_data
+
+    def cleanup(self):
+        """删除该任务的临时输出目录（开始新的批量处理前调用），指定的输出目录不会删除"""
+        if self._owns_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
\ No newline at end of file
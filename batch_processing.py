@@ -1,267 +1,168 @@
-# 批量处理功能
-from PIL import Image
+# 批量处理功能（Gradio界面适配，处理逻辑见batch_engine）
 import gradio as gr
-import logging
-import pandas as pd
-import numpy as np
-import pymysql
-import tempfile
 import os
+import logging
+import time
 
+from batch_engine import (start_job, start_db_job, resume_job, run_batch, finish_job,
+                          list_unfinished_jobs, format_timings)
+from config import PROGRESS_TIMING_SUMMARY
 from card_processor import processor
-from image_utils import compress_image, numpy_to_temp_file
-from pdf_generator import generate_pdf, sort_images_by_type
-from image_utils import process_image_format
+from progress import ProgressTracker
+from scheduler import scheduler
 
 logger = logging.getLogger(__name__)
 
-# 添加数据库查询函数
-def query_database_to_csv():
-    """从MySQL数据库查询数据并生成CSV文件"""
+def _hidden_outputs(progress, pdf_path, job, log=None):
+    """隐藏选择界面时的输出（log为处理日志文件，None表示不更新）"""
+    log = gr.update() if log is None else log
+    return progress, pdf_path, log, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False), job
+
+def _selection_label(item):
+    """选择界面的说明文字，多行引用同一图片时注明选择结果应用到这些行"""
+    label = f"当前选择: {item['card_type']} - {item['url']} - {item['name']}"
+    if len(item["rows"]) > 1:
+        label += f"（共 {len(item['rows'])} 行使用该图片，选择结果应用到所有这些行）"
+    return label
+
+def _progress_log_path(job):
+    """任务的处理日志文件（保存在任务目录中）"""
+    return os.path.join(job.work_dir, f"progress_{job.job_id}.log")
+
+def _to_gradio(job, events):
+    """
+    将批量处理引擎的进度事件转换为界面输出
+
+    界面只显示进度汇总和最近的记录，并按PROGRESS_UPDATES_PER_SECOND限制刷新频率；
+    完整记录写入处理日志文件，处理结束或需要选择时提供下载。
+    """
+    log_path = _progress_log_path(job)
+    tracker = ProgressTracker(log_path)
     try:
-        # 连接数据库
-        connection = pymysql.connect(
-            host='',
-            database='',
-            port=,
-            user='',
-            password='',
-            charset=''
-        )
-        
-        logger.info("数据库连接成功")
-        
-        # 执行SQL查询
-        sql = """
-        SELECT 
-            zhp.household_user_name AS '户主',
-            REPLACE(CONCAT(COALESCE(zhwa.front_img_url, ''), COALESCE(zhdcu.front_img_url, '')), ' ', '') AS id_card_front,
-            REPLACE(CONCAT(COALESCE(zhwa.back_img_url, ''), COALESCE(zhdcu.back_img_url, '')), ' ', '') AS id_card_back
-        FROM zy_household_project zhp 
-        LEFT JOIN zy_household_user zhu ON zhu.id = zhp.household_user_id 
-        LEFT JOIN zy_household_wallet_account zhwa ON zhwa.project_id = zhp.id 
-        LEFT JOIN zy_household_debit_card_upload zhdcu ON zhdcu.id = (
-            SELECT MAX(zhdcud.id)
-            FROM zy_household_debit_card_upload zhdcud
-            WHERE zhdcud.project_id = zhp.id 
-        )
-        WHERE zhp.project_status = 2
-        ORDER BY (
-            SELECT 序号 FROM (
-                SELECT 
-                    ROW_NUMBER() OVER () AS '序号',
-                    zhp_inner.id AS project_id
-                FROM zy_household_project zhp_inner
-                LEFT JOIN zy_household_project_design_device zhpdd_inner ON zhp_inner.id = zhpdd_inner.project_id 
-                WHERE zhp_inner.project_status = 2 
-                  AND zhpdd_inner.material_type = '组件'
-                GROUP BY zhp_inner.id
-            ) AS order_subquery
-            WHERE order_subquery.project_id = zhp.id
-        )
-        """
-        
-        # 读取数据到DataFrame
-        df = pd.read_sql(sql, connection)
-        
-        # 关闭数据库连接
-        connection.close()
-        
-        logger.info(f"查询成功，获取到 {len(df)} 条记录")
-        
-        # 创建临时CSV文件
-        temp_csv = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8')
-        
-        # 写入CSV文件（不包含表头）
-        df.to_csv(temp_csv.name, index=False, header=False)
-        temp_csv.close()
-        
-        logger.info(f"CSV文件已生成: {temp_csv.name}")
-        
-        return temp_csv.name, f"成功获取 {len(df)} 条记录"
-        
+        for event in events:
+            refresh = tracker.add(event)
+            
+            if event["event"] == "selection_required":
+                # 显示第一组需要选择的卡证
+                first_item = job.get_selection_data()[0]
+                selected_indices = first_item["selected_indices"]
+                checkbox_values = [f"第 {i+1} 张" for i in selected_indices]
+                tracker.close()
+                
+                yield (
+                    tracker.render(), 
+                    None, 
+                    log_path,
+                    gr.update(visible=True), 
+                    gr.update(visible=True, value=first_item["thumbnails"]),
+                    gr.update(choices=[f"第 {i+1} 张" for i in range(len(first_item["thumbnails"]))], 
+                             value=checkbox_values),
+                    gr.update(value=_selection_label(first_item)),
+                    job
+                )
+            elif event["event"] == "done":
+                tracker.close()
+                yield _hidden_outputs(tracker.render(), event["pdf_path"], job, log_path)
+            elif refresh:
+                yield _hidden_outputs(tracker.render(), None, job)
     except Exception as e:
-        logger.error(f"数据库查询失败: {e}")
-        return None, f"数据库查询失败: {str(e)}"
+        # 出错时把已有记录和错误信息一起显示，日志文件可下载排查
+        tracker.write(f"处理失败: {str(e)}")
+        tracker.close()
+        logger.exception("批量处理失败")
+        yield _hidden_outputs(tracker.render(), None, job, log_path)
+    finally:
+        tracker.close()
 
-def process_batch_images(csv_file, output_name="output.pdf"):
-    """批量处理CSV文件"""
+def _release_job(job):
+    """开始新的处理前清理上一次处理的任务"""
+    if job is not None:
+        job.cleanup()
+        scheduler.forget(job.job_id)
+
+def process_batch_images(csv_file, output_name="output.pdf", job=None):
+    """批量处理CSV文件，每次处理创建新的任务状态（通过gr.State传递给后续的选择和生成PDF）"""
     logger.info(f"开始批量处理，输出文件: {output_name}")
     
     if not processor.init_model():
         error_msg = "模型初始化失败"
         logger.error(error_msg)
-        yield error_msg, None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
+        yield _hidden_outputs(error_msg, None, job)
         return
     
     if csv_file is None:
         error_msg = "请先上传CSV文件"
         logger.warning(error_msg)
-        yield error_msg, None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
+        yield _hidden_outputs(error_msg, None, job)
         return
     
     try:
-        # 清空之前的数据
-        processor.clear_processed_data()
-        
-        # 读取CSV
-        logger.info(f"读取CSV文件: {csv_file.name}")
-        df = pd.read_csv(csv_file.name, header=None)
-        total_rows = len(df)
-        logger.info(f"CSV文件包含 {total_rows} 行数据")
-        
-        progress_info = [f"开始处理，共 {total_rows} 行数据"]
-        yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-        
-        selection_items = []
-        
-        # 处理每一行
-        for i in range(total_rows):
-            row_info = f"\n处理第 {i+1}/{total_rows} 行"
-            progress_info.append(row_info)
-            logger.info(row_info.strip())
-            yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-            
-            # 获取姓名（第一列）
-            name = str(df.iloc[i, 0]).strip() if len(df.iloc[i]) > 0 else f"未知_{i+1}"
-            
-            # 处理正面和背面URL
-            urls_to_process = []
-            if len(df.iloc[i]) > 1:
-                front_url = str(df.iloc[i, 1]).strip()
-                if front_url and front_url != 'nan' and front_url != 'None':
-                    urls_to_process.append(("正面", front_url, name))
-            
-            if len(df.iloc[i]) > 2:
-                back_url = str(df.iloc[i, 2]).strip()
-                if back_url and back_url != 'nan' and back_url != 'None':
-                    urls_to_process.append(("背面", back_url, name))
-            
-            logger.info(f"第 {i+1} 行需要处理 {len(urls_to_process)} 个URL")
-            
-            for card_type, url, name in urls_to_process:
-                try:
-                    logger.info(f"处理 {card_type} URL: {url}")
-                    
-                    # 检查缓存中是否已有处理好的图片
-                    # 在batch_processing.py中修改process_batch_images函数的相关部分
+        _release_job(job)
+        job, rows_to_process = start_job(csv_file.name, output_name)
+    except Exception as e:
+        error_msg = f"处理失败: {str(e)}"
+        logger.exception(error_msg)
+        yield _hidden_outputs(error_msg, None, job)
+        return
+    yield from _to_gradio(job, run_batch(job, rows_to_process))
 
-                    # 检查缓存中是否已有处理好的图片
-                    cache_path = processor.check_cache(url)
-                    if cache_path:
-                        # 使用缓存中的图片（直接使用缓存路径，不生成临时文件）
-                        progress_info.append(f"  ✓ {card_type}: 使用缓存图片")
-                        logger.info(f"使用缓存图片: {cache_path}")
-                        # 直接使用缓存图片路径，不进行额外压缩
-                        processor.add_processed_image(cache_path, card_type, i, name)
-                        yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-                        continue
-                    
-                    # 没有缓存，调用模型处理
-                    result = processor.model(url)
-                    
-                    if result and result.get("output_imgs"):
-                        cards_count = len(result["output_imgs"])
-                        
-                        # 检查是否需要用户选择
-                        if cards_count > 1:
-                            # 准备选择数据
-                            selection_key = f"{url}_{card_type}"
-                            temp_files = []
-                            
-                            for j, img in enumerate(result["output_imgs"]):
-                                if isinstance(img, np.ndarray):
-                                    temp_file = numpy_to_temp_file(img)
-                                    if temp_file:
-                                        temp_files.append(temp_file)
-                            
-                            if temp_files:
-                                selection_items.append({
-                                    "key": selection_key,
-                                    "url": url,
-                                    "card_type": card_type,
-                                    "temp_files": temp_files,
-                                    "row_index": i,
-                                    "name": name,
-                                    "selected_indices": processor.get_selection(url, card_type)
-                                })
-                            
-                            progress_info.append(f"  ⚠ {card_type}: 检测到 {cards_count} 张卡证，需要选择")
-                            logger.info(f"  ⚠ {card_type}: 检测到 {cards_count} 张卡证，需要选择")
-                        else:
-                            # 只有一张卡证，直接处理
-                            for img in result["output_imgs"]:
-                                if isinstance(img, np.ndarray):
-                                    img = process_image_format(img)
-                                    # 保存到缓存
-                                    cache_path = processor.save_to_cache(img, url)
-                                    # 压缩图片用于显示和PDF生成
-                                    compressed_img_path = compress_image(cache_path)
-                                    processor.add_processed_image(compressed_img_path, card_type, i, name)
-                                    logger.info(f"保存压缩图片: {compressed_img_path}")
-                            
-                            progress_info.append(f"  ✓ {card_type}: 1 张证卡")
-                            logger.info(f"  ✓ {card_type}: 1 张证卡")
-                    
-                    else:
-                        progress_info.append(f"  ✗ {card_type}: 未检测到证卡")
-                        logger.warning(f"  ✗ {card_type}: 未检测到证卡")
-                    
-                    yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-                    
-                except Exception as e:
-                    error_msg = f"  ✗ {card_type}: 处理失败 - {str(e)}"
-                    progress_info.append(error_msg)
-                    logger.error(error_msg)
-                    yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-        
-        # 如果有需要选择的卡证，提示用户
-        if selection_items:
-            processor.set_selection_data(selection_items)
-            progress_info.append(f"\n⚠ 需要选择 {len(selection_items)} 组卡证")
-            
-            # 显示第一组需要选择的卡证
-            first_item = selection_items[0]
-            selected_indices = first_item["selected_indices"]
-            checkbox_values = [f"第 {i+1} 张" for i in selected_indices]
-            
-            yield (
-                "\n".join(progress_info), 
-                None, 
-                gr.update(visible=True), 
-                gr.update(visible=True, value=first_item["temp_files"]),
-                gr.update(choices=[f"第 {i+1} 张" for i in range(len(first_item["temp_files"]))], 
-                         value=checkbox_values),
-                gr.update(value=f"当前选择: {first_item['card_type']} - {first_item['url']} - {first_item['name']}")
-            )
-            return
-        
-        # 如果没有需要选择的卡证，直接生成PDF
-        processed_images, image_info_list, names_list = processor.get_processed_data()
-        if processed_images:
-            logger.info(f"生成PDF，包含 {len(processed_images)} 张图片")
-            # 按照每行先正面后背面的顺序排序
-            sorted_images = sort_images_by_type(processed_images, image_info_list, names_list)
-            pdf_path = generate_pdf(sorted_images, names_list, output_name)
-            progress_info.append(f"\n处理完成！共处理 {len(processed_images)} 张证卡")
-            logger.info(f"批量处理完成！共处理 {len(processed_images)} 张证卡，PDF保存至: {pdf_path}")
-            
-            yield "\n".join(progress_info), pdf_path, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-        else:
-            warning_msg = "\n没有成功处理的证卡"
-            progress_info.append(warning_msg)
-            logger.warning(warning_msg)
-            yield "\n".join(progress_info), None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
-            
+def process_database_batch(output_name="output.pdf", full_sync=False, job=None):
+    """从数据库逐行读取数据并批量处理，第一行到达后立即开始处理（full_sync为True时忽略增量同步的水位）"""
+    logger.info(f"开始批量处理（从数据库读取），输出文件: {output_name}")
+    
+    if not processor.init_model():
+        error_msg = "模型初始化失败"
+        logger.error(error_msg)
+        yield _hidden_outputs(error_msg, None, job)
+        return
+    
+    try:
+        _release_job(job)
+        job, rows_to_process = start_db_job(output_name, full_sync=full_sync)
     except Exception as e:
         error_msg = f"处理失败: {str(e)}"
         logger.exception(error_msg)
-        yield error_msg, None, gr.update(visible=False), gr.update(visible=False), gr.update(value=[]), gr.update(visible=False)
+        yield _hidden_outputs(error_msg, None, job)
+        return
+    yield from _to_gradio(job, run_batch(job, rows_to_process))
 
-def handle_card_selection(selected_checkboxes, current_index):
+def list_resumable_jobs():
+    """未完成的任务，用于恢复任务的下拉列表"""
+    try:
+        jobs = list_unfinished_jobs()
+    except Exception as e:
+        logger.error(f"读取任务日志失败: {e}")
+        return []
+    return [f"{job['job_id']} | {job['output_name']} | {job['next_row']}/{job['total_rows']} 行 | "
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(job['updated']))}" for job in jobs]
+
+def resume_batch_job(job_choice, job=None):
+    """恢复中断的批量处理任务：按任务日志恢复已完成的行，从第一个未完成的行继续处理"""
+    if not job_choice:
+        yield _hidden_outputs("请先选择要恢复的任务", None, job)
+        return
+    
+    if not processor.init_model():
+        error_msg = "模型初始化失败"
+        logger.error(error_msg)
+        yield _hidden_outputs(error_msg, None, job)
+        return
+    
+    job_id = job_choice.split(" | ")[0].strip()
+    try:
+        _release_job(job)
+        job, rows_to_process, start_row, selection_items = resume_job(job_id)
+    except Exception as e:
+        error_msg = f"恢复任务失败: {str(e)}"
+        logger.exception(error_msg)
+        yield _hidden_outputs(error_msg, None, job)
+        return
+    yield from _to_gradio(job, run_batch(job, rows_to_process, start_row, selection_items))
+
+def handle_card_selection(selected_checkboxes, current_index, job):
     """处理卡证选择"""
     try:
-        selection_items = processor.get_selection_data()
+        selection_items = job.get_selection_data() if job is not None else []
         if not selection_items or current_index >= len(selection_items):
             return gr.update(), gr.update(), gr.update(), gr.update(), current_index
         
@@ -288,10 +189,10 @@ def handle_card_selection(selected_checkboxes, current_index):
             next_checkbox_values = [f"第 {i+1} 张" for i in next_selected_indices]
             
             return (
-                gr.update(value=next_item["temp_files"]),
-                gr.update(choices=[f"第 {i+1} 张" for i in range(len(next_item["temp_files"]))], 
+                gr.update(value=next_item["thumbnails"]),
+                gr.update(choices=[f"第 {i+1} 张" for i in range(len(next_item["thumbnails"]))], 
                          value=next_checkbox_values),
-                gr.update(value=f"当前选择: {next_item['card_type']} - {next_item['url']} - {next_item['name']}"),
+                gr.update(value=_selection_label(next_item)),
                 gr.update(),
                 next_index
             )
@@ -303,59 +204,30 @@ def handle_card_selection(selected_checkboxes, current_index):
         logger.error(f"处理卡证选择失败: {e}")
         return gr.update(), gr.update(), gr.update(), gr.update(), current_index
 
-def generate_final_pdf(output_name="output.pdf"):
+def generate_final_pdf(output_name="output.pdf", job=None):
     """生成最终的PDF文件"""
+    if job is None:
+        return "请先进行批量处理", None, gr.update()
+    
+    log_path = _progress_log_path(job)
     try:
-        selection_items = processor.get_selection_data()
-        processed_images, image_info_list, names_list = processor.get_processed_data()
-        
-        # 处理需要选择的卡证
-        for item in selection_items:
-            url = item["url"]
-            card_type = item["card_type"]
-            name = item["name"]
-            selected_indices = processor.get_selection(url, card_type)
-            
-            # 检查缓存中是否已有处理好的图片
-            cache_path = processor.check_cache(url)
-            if cache_path:
-                # 使用缓存中的图片
-                processor.add_processed_image(cache_path, card_type, item["row_index"], name)
-                continue
-            
-            # 没有缓存，重新处理URL获取选择的卡证
-            result = processor.model(url)
-            if result and result.get("output_imgs"):
-                for selected_index in selected_indices:
-                    if selected_index < len(result["output_imgs"]):
-                        img = result["output_imgs"][selected_index]
-                        if isinstance(img, np.ndarray):
-                            img = process_image_format(img)
-                            # 保存到缓存
-                            cache_path = processor.save_to_cache(img, url)
-                            compressed_img_path = compress_image(cache_path)
-                            processor.add_processed_image(compressed_img_path, card_type, item["row_index"], name)
-        
-        # 重新获取所有处理后的数据
-        processed_images, image_info_list, names_list = processor.get_processed_data()
-        
-        if not processed_images:
-            return "没有需要处理的卡证", None
-        
-        # 生成PDF
-        # 按照每行先正面后背面的顺序排序
-        sorted_images = sort_images_by_type(processed_images, image_info_list, names_list)
-        pdf_path = generate_pdf(sorted_images, names_list, output_name)
-        
-        # 清理临时文件
-        for img_path in processed_images:
-            try:
-                os.unlink(img_path)
-            except:
-                pass
-        
-        return f"处理完成！共生成 {len(processed_images)} 张卡证", pdf_path
+        pdf_path, _, card_count = finish_job(job, output_name)
+        if not card_count:
+            message, pdf_path = "没有需要处理的卡证", None
+        else:
+            message = f"处理完成！共生成 {card_count} 张卡证"
+            if PROGRESS_TIMING_SUMMARY:
+                message += f"\n{format_timings(job)}"
             
     except Exception as e:
         logger.error(f"生成最终PDF失败: {e}")
-        return f"处理失败: {str(e)}", None
\ No newline at end of file
+        message, pdf_path = f"处理失败: {str(e)}", None
+    
+    # 最终结果追加到处理日志
+    try:
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(message + "\n")
+    except OSError as e:
+        logger.warning(f"写入处理日志失败: {e}")
+        return message, pdf_path, gr.update()
+    return message, pdf_path, log_path
\ No newline at end of file
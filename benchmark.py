@@ -0,0 +1,1352 @@
+# 性能基准测试
+"""
+用法:
+    python benchmark.py inference 图片1.jpg 图片2.jpg ... [--batch-sizes 1 4 8 16]
+    python benchmark.py compress 图片1.jpg 图片2.jpg ... [--max-size-kb 20]
+    python benchmark.py pipeline [--rows 100 1000 10000] [--output bench_pipeline.json]
+    python benchmark.py encode [--cards 50]
+    python benchmark.py backends 图片1.jpg 图片2.jpg ... [--backends modelscope onnx torchscript]
+    python benchmark.py quantized 图片1.jpg 图片2.jpg ...
+    python benchmark.py resolution [图片1.jpg ...] [--photos 5] [--backend stub]
+    python benchmark.py dbstream [--rows 100000]
+    python benchmark.py csv [--rows 100000] [--distinct 60000]
+    python benchmark.py singleflight [--jobs 16] [--urls 80] [--per-job 40]
+    python benchmark.py download [--images 200] [--workers 8] [--failure-rate 0.2]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+
+# 基准测试固定在CPU上运行
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def _load_images(image_paths):
+    """读取测试图片为BGR格式的numpy数组"""
+    images = []
+    for path in image_paths:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning(f"无法读取图片，已跳过: {path}")
+            continue
+        images.append(image)
+    return images
+
+def bench_inference(image_paths, batch_sizes=(1, 4, 8, 16), repeat=3, polygon_tolerance=1.0, crop_tolerance=1.0):
+    """
+    比较逐张调用模型与批量推理的吞吐量
+
+    同时检查批量推理的结果与逐张调用一致（检测数量、角点坐标和裁剪结果），
+    合并前向计算后逐张恢复的流水线状态不完整时会从错误的原图裁剪，此时检查失败。
+    """
+    from card_processor import processor
+
+    if not processor.init_model():
+        print("模型初始化失败")
+        return 1
+
+    images = _load_images(image_paths)
+    if not images:
+        print("没有可用的测试图片")
+        return 1
+
+    # 预热，避免首次调用的初始化开销影响结果
+    processor.model(images[0])
+
+    def measure(fn):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return len(images) / best
+
+    baseline = measure(lambda: [processor.model(image) for image in images])
+    reference = [processor.model(image) for image in images]
+    print(f"{'模式':<12}{'图片/秒':>10}{'加速比':>10}{'角点误差px':>12}{'裁剪像素差':>12}{'数量一致':>10}")
+    print(f"{'逐张调用':<12}{baseline:>10.2f}{1.0:>10.2f}{'参考':>12}{'-':>12}{'-':>10}")
+
+    passed = True
+    for batch_size in batch_sizes:
+        throughput = measure(lambda: processor.process_many(images, batch_size=batch_size))
+        outputs = processor.process_many(images, batch_size=batch_size)
+        diffs = [_compare_results(ref, out) if not isinstance(out, Exception) else {"same_count": False}
+                 for ref, out in zip(reference, outputs)]
+        same_count = sum(d["same_count"] for d in diffs)
+        matched = [d for d in diffs if d["same_count"]]
+        polygon_px = max((d["polygon_px"] for d in matched), default=0.0)
+        crop_diff = max((d["crop_diff"] for d in matched), default=0.0)
+        if same_count < len(diffs) or polygon_px > polygon_tolerance or crop_diff > crop_tolerance:
+            passed = False
+        print(f"{f'batch={batch_size}':<12}{throughput:>10.2f}{throughput / baseline:>10.2f}"
+              f"{polygon_px:>12.2f}{crop_diff:>12.2f}{f'{same_count}/{len(diffs)}':>10}")
+    print(f"一致性检查（相对逐张调用，容差: 角点 {polygon_tolerance}px，裁剪像素差 {crop_tolerance}）: "
+          + ("通过" if passed else "失败"))
+    return 0 if passed else 1
+
+def _legacy_compress(img, output_path, max_size_kb, quality=85):
+    """原compress_image的JPEG逻辑：每次降低5的质量，写入磁盘后检查文件大小，返回编码次数"""
+    encodes = 0
+    current_quality = quality
+    temp_output = output_path + ".tmp"
+    while current_quality >= 10:
+        img.save(temp_output, 'JPEG', quality=current_quality, optimize=True)
+        encodes += 1
+        file_size_kb = os.path.getsize(temp_output) / 1024
+        if file_size_kb <= max_size_kb or current_quality <= 10:
+            shutil.move(temp_output, output_path)
+            break
+        current_quality -= 5
+        os.remove(temp_output)
+    return encodes
+
+def bench_compress(image_paths, max_size_kb=20, max_width=800, workers=4):
+    """比较原逐步降质量的压缩方式与内存中二分查找质量的编码次数和耗时"""
+    from PIL import Image
+    from image_utils import compress_images, encode_jpeg_to_size
+
+    images = []
+    for path in image_paths:
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+            if img.width > max_width:
+                img = img.resize((max_width, int(img.height * max_width / img.width)), Image.LANCZOS)
+            images.append(img)
+    if not images:
+        print("没有可用的测试图片")
+        return 1
+
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_")
+    try:
+        start = time.perf_counter()
+        legacy_encodes = sum(_legacy_compress(img, os.path.join(work_dir, f"legacy_{i}.jpg"), max_size_kb)
+                             for i, img in enumerate(images))
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        search_encodes = 0
+        for i, img in enumerate(images):
+            data, _, encodes = encode_jpeg_to_size(img, max_size_kb * 1024)
+            search_encodes += encodes
+            with open(os.path.join(work_dir, f"search_{i}.jpg"), "wb") as f:
+                f.write(data)
+        search_time = time.perf_counter() - start
+
+        # 并行压缩完整流程（读取、缩放、编码、写入）
+        copies = []
+        for i, path in enumerate(image_paths):
+            copy_path = os.path.join(work_dir, f"parallel_{i}{os.path.splitext(path)[1] or '.jpg'}")
+            shutil.copyfile(path, copy_path)
+            copies.append(copy_path)
+        start = time.perf_counter()
+        compress_images(copies, workers=workers, max_width=max_width, max_size_kb=max_size_kb)
+        parallel_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    count = len(images)
+    print(f"{'方式':<16}{'编码次数/张':>12}{'耗时(秒)':>12}")
+    print(f"{'逐步降质量':<16}{legacy_encodes / count:>12.2f}{legacy_time:>12.3f}")
+    print(f"{'二分查找':<16}{search_encodes / count:>12.2f}{search_time:>12.3f}")
+    print(f"{f'并行x{workers}':<16}{'-':>12}{parallel_time:>12.3f}")
+    return 0
+
+# 合成证卡照片的尺寸（身份证比例 85.6mm x 54mm）
+CARD_SIZE = (856, 540)
+PHOTO_SIZE = (1280, 960)
+
+def make_card_photo(seed, photo_size=PHOTO_SIZE):
+    """
+    生成一张模拟拍摄的证卡照片：随机背景上有一张带透视变形的卡片
+
+    Returns:
+        numpy.ndarray: BGR格式的照片
+    """
+    rng = np.random.default_rng(seed)
+    card_w, card_h = CARD_SIZE
+    photo_w, photo_h = photo_size
+
+    # 卡片：浅色底、头像区域、若干行“文字”
+    card = np.full((card_h, card_w, 3), rng.integers(200, 250, 3), dtype=np.uint8)
+    cv2.rectangle(card, (card_w - 260, 80), (card_w - 60, 330), tuple(int(c) for c in rng.integers(60, 160, 3)), -1)
+    for line in range(6):
+        y = 90 + line * 60
+        length = int(rng.integers(200, 480))
+        cv2.rectangle(card, (60, y), (60 + length, y + 22), (40, 40, 40), -1)
+    cv2.putText(card, f"{seed:018d}", (60, card_h - 60), cv2.FONT_HERSHEY_SIMPLEX, 1.4, (20, 20, 20), 3)
+
+    # 深色背景 + 噪声
+    background = np.full((photo_h, photo_w, 3), rng.integers(20, 90, 3), dtype=np.uint8)
+    noise = rng.normal(0, 8, (photo_h, photo_w, 3))
+    background = np.clip(background + noise, 0, 255).astype(np.uint8)
+
+    # 随机透视变形后贴到背景上
+    margin = 120
+    corners = np.float32([[margin, margin], [photo_w - margin, margin],
+                          [photo_w - margin, photo_h - margin], [margin, photo_h - margin]])
+    corners += rng.uniform(-60, 60, corners.shape).astype(np.float32)
+    source = np.float32([[0, 0], [card_w, 0], [card_w, card_h], [0, card_h]])
+    matrix = cv2.getPerspectiveTransform(source, corners)
+    warped = cv2.warpPerspective(card, matrix, (photo_w, photo_h))
+    mask = cv2.warpPerspective(np.full((card_h, card_w), 255, np.uint8), matrix, (photo_w, photo_h))
+    photo = np.where(mask[..., None] > 0, warped, background)
+    return cv2.GaussianBlur(photo, (3, 3), 0)
+
+class StubCardPipeline:
+    """
+    确定性的卡证检测校正替身，输出格式与modelscope的card_detection_correction一致
+
+    用阈值分割找到最大的四边形区域并透视校正，不需要模型权重，也不需要联网。
+    没有实现preprocess/forward，批量推理会退回逐张调用。
+    """
+
+    def __call__(self, image):
+        if isinstance(image, str):
+            from image_loader import download_image
+            image = download_image(image)
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return {"output_imgs": [], "polygons": np.zeros((0, 8)), "scores": np.zeros(0), "labels": []}
+
+        contour = max(contours, key=cv2.contourArea)
+        # 优先使用轮廓拟合的四边形，拟合不出四个角点时使用最小外接矩形
+        box = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True).reshape(-1, 2).astype(np.float32)
+        if len(box) != 4:
+            box = cv2.boxPoints(cv2.minAreaRect(contour))
+        # 按左上、右上、右下、左下排序
+        sums = box.sum(axis=1)
+        diffs = np.diff(box, axis=1).ravel()
+        ordered = np.float32([box[np.argmin(sums)], box[np.argmin(diffs)],
+                              box[np.argmax(sums)], box[np.argmax(diffs)]])
+        # 与modelscope流水线一致：裁剪尺寸由四边形大小决定
+        from inference_backends import crop_card
+        crop = crop_card(image, ordered)
+        return {
+            "output_imgs": [crop],
+            "polygons": ordered.reshape(1, 8),
+            "scores": np.array([0.99]),
+            "labels": [0],
+        }
+
+class _StageStats:
+    """记录各阶段每次调用的耗时"""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.samples.setdefault(stage, []).append(elapsed)
+        return timed
+
+    def summary(self):
+        return {stage: _latency_summary(samples) for stage, samples in self.samples.items()}
+
+def _latency_summary(samples):
+    """调用次数、总耗时、吞吐量和p50/p95延迟"""
+    samples = np.asarray(samples)
+    total = float(samples.sum())
+    return {
+        "calls": int(samples.size),
+        "total_s": round(total, 3),
+        "per_s": round(samples.size / total, 2) if total > 0 else None,
+        "p50_ms": round(float(np.percentile(samples, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(samples, 95)) * 1000, 2),
+    }
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def _run_pipeline_once(rows, images_dir, distinct_images):
+    """在单独的进程中运行一次完整的批量处理，返回统计结果（每个规模单独进程，峰值内存互不影响）"""
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+
+    # 缓存、检测结果和任务日志使用临时目录，不影响正式数据
+    import card_processor
+    card_processor.CACHE_DIR = os.path.join(work_dir, "cache")
+    card_processor.RESULT_DIR = os.path.join(work_dir, "results")
+    card_processor.JOB_DIR = os.path.join(work_dir, "jobs")
+    processor = card_processor.processor
+    processor.use_worker_pool = False
+    # 下载的原始图片也保存到临时目录（不写入正式的原始图片存储，也不读取其中已保存的图片）
+    from downloader import downloader
+    original_store = downloader.store_dir, downloader._store
+    downloader.store_dir, downloader._store = os.path.join(work_dir, "raw"), None
+
+    import batch_engine
+    import pdf_generator
+    stats = _StageStats()
+    processor.model = stats.wrap("inference", StubCardPipeline())
+    processor.model_loaded = True
+    processor.save_to_cache = stats.wrap("save_to_cache", processor.save_to_cache)
+    batch_engine.load_for_detection = stats.wrap("download", batch_engine.load_for_detection)
+    card_processor.encode_card = stats.wrap("encode_card", card_processor.encode_card)
+    pdf_generator.StreamingPdfWriter._draw_page = stats.wrap("pdf_page", pdf_generator.StreamingPdfWriter._draw_page)
+    pdf_generator.render_pages = stats.wrap("pdf_render", pdf_generator.render_pages)
+
+    # 本地HTTP服务提供图片，每行使用不同的URL（不会命中缓存）
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=images_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    csv_path = os.path.join(work_dir, "input.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        for i in range(rows):
+            front = f"{base_url}/card_{(2 * i) % distinct_images}.jpg?row={i}&side=front"
+            back = f"{base_url}/card_{(2 * i + 1) % distinct_images}.jpg?row={i}&side=back"
+            f.write(f"姓名{i},{front},{back}\n")
+
+    try:
+        start = time.perf_counter()
+        job, rows_to_process = batch_engine.start_job(csv_path, "bench.pdf", output_dir=work_dir)
+        row_latencies = []
+        row_start = None
+        result = None
+        for event in batch_engine.run_batch(job, rows_to_process):
+            if event["event"] == "row":
+                row_start = time.perf_counter()
+            elif event["event"] == "row_done":
+                row_latencies.append(time.perf_counter() - row_start)
+            elif event["event"] == "selection_required":
+                pdf_path, _, cards = batch_engine.finish_job(job)
+                result = {"pdf_path": pdf_path, "cards": cards}
+            elif event["event"] == "done":
+                result = {"pdf_path": event["pdf_path"], "cards": event["cards"]}
+        wall = time.perf_counter() - start
+
+        return {
+            "rows": rows,
+            "cards": result["cards"],
+            "wall_s": round(wall, 3),
+            "rows_per_s": round(rows / wall, 2),
+            "cards_per_s": round(result["cards"] / wall, 2),
+            "pdf_bytes": os.path.getsize(result["pdf_path"]) if result["pdf_path"] else 0,
+            "row_latency": _latency_summary(row_latencies),
+            "stages": stats.summary(),
+            "job_timings": job.timings.as_dict(),
+            # Linux下ru_maxrss单位为KB
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    finally:
+        server.shutdown()
+        downloader.store_dir, downloader._store = original_store
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_pipeline(row_counts=(100, 1000, 10000), distinct_images=200, output_path="bench_pipeline.json"):
+    """使用合成证卡照片和替身模型运行完整的批量处理流程，结果写入JSON文件便于对比"""
+    from config import INFERENCE_BATCH_SIZE, PREFETCH_WORKERS, PREFETCH_DEPTH, PDF_SHARDS, PDF_ROWS_PER_FILE
+
+    images_dir = tempfile.mkdtemp(prefix="bench_cards_")
+    try:
+        start = time.perf_counter()
+        for k in range(distinct_images):
+            cv2.imwrite(os.path.join(images_dir, f"card_{k}.jpg"), make_card_photo(k),
+                        [cv2.IMWRITE_JPEG_QUALITY, 90])
+        print(f"生成 {distinct_images} 张合成证卡照片，耗时 {time.perf_counter() - start:.1f} 秒")
+
+        runs = []
+        context = multiprocessing.get_context("spawn")
+        for rows in row_counts:
+            with context.Pool(1) as pool:
+                run = pool.apply(_run_pipeline_once, (rows, images_dir, distinct_images))
+            runs.append(run)
+            print(f"{rows:>6} 行: {run['wall_s']:>8.2f} 秒  {run['rows_per_s']:>8.2f} 行/秒  "
+                  f"行延迟 p50 {run['row_latency']['p50_ms']:.1f}ms p95 {run['row_latency']['p95_ms']:.1f}ms  "
+                  f"峰值内存 {run['peak_rss_mb']:.0f}MB")
+            for stage, summary in sorted(run["stages"].items()):
+                print(f"        {stage:<22}{summary['calls']:>8} 次  {summary['per_s'] or 0:>10.1f} 次/秒  "
+                      f"p50 {summary['p50_ms']:>8.2f}ms  p95 {summary['p95_ms']:>8.2f}ms")
+    finally:
+        shutil.rmtree(images_dir, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "distinct_images": distinct_images,
+        "config": {
+            "INFERENCE_BATCH_SIZE": INFERENCE_BATCH_SIZE,
+            "PREFETCH_WORKERS": PREFETCH_WORKERS,
+            "PREFETCH_DEPTH": PREFETCH_DEPTH,
+            "PDF_SHARDS": PDF_SHARDS,
+            "PDF_ROWS_PER_FILE": PDF_ROWS_PER_FILE,
+        },
+        "runs": runs,
+    }
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入: {output_path}")
+    return 0
+
+def _run_pdf_stream_once(rows, images_dir, distinct_images, pages_per_part):
+    """在单独的进程中用StreamingPdfWriter生成一份rows行的PDF，返回峰值内存等统计"""
+    from pdf_generator import StreamingPdfWriter
+
+    work_dir = tempfile.mkdtemp(prefix="bench_pdf_stream_")
+    try:
+        bases = []
+        for k in range(distinct_images):
+            with open(os.path.join(images_dir, f"card_{k}.jpg"), "rb") as f:
+                bases.append(f.read())
+        start = time.perf_counter()
+        writer = StreamingPdfWriter("bench.pdf", work_dir, pages_per_part=pages_per_part)
+        for i in range(rows):
+            for side, card_type in enumerate(("正面", "背面")):
+                # 在JPEG开头插入不同的注释段，每张证卡内容都不相同（不会按内容去重），与正式数据一致
+                comment = f"row {i} side {side}".encode()
+                base = bases[(2 * i + side) % distinct_images]
+                path = os.path.join(work_dir, f"card_{i}_{side}.jpg")
+                with open(path, "wb") as f:
+                    f.write(base[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + base[2:])
+                writer.add_card(i, path, card_type, f"姓名{i}")
+            writer.end_row(i)
+        pdf_path = writer.close()
+        return {
+            "rows": rows,
+            "cards": writer.card_count,
+            "wall_s": round(time.perf_counter() - start, 2),
+            "pdf_mb": round(os.path.getsize(pdf_path) / 1024 / 1024, 1),
+            # Linux下ru_maxrss单位为KB
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_pdf_stream(row_counts=(500, 2000, 8000), distinct_images=50, tolerance_mb=30):
+    """
+    边处理边生成PDF的峰值内存：不分段（reportlab在保存前保留所有页面）与按PDF_PAGES_PER_PART分段保存再合并的对比
+
+    每个规模在单独的进程中运行。分段时最大规模与最小规模的峰值内存之差超过tolerance_mb即检查未通过。
+    """
+    from config import PDF_PAGES_PER_PART
+
+    images_dir = tempfile.mkdtemp(prefix="bench_pdf_cards_")
+    try:
+        for k in range(distinct_images):
+            cv2.imwrite(os.path.join(images_dir, f"card_{k}.jpg"), make_card_photo(k, CARD_SIZE),
+                        [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+        print(f"{'方式':<16}{'行数':>8}{'证卡':>8}{'耗时s':>10}{'PDF MB':>10}{'峰值内存MB':>12}")
+        context = multiprocessing.get_context("spawn")
+        peaks = {}
+        for label, pages_per_part in (("不分段", 0), (f"每{PDF_PAGES_PER_PART}页分段", PDF_PAGES_PER_PART)):
+            for rows in row_counts:
+                with context.Pool(1) as pool:
+                    run = pool.apply(_run_pdf_stream_once, (rows, images_dir, distinct_images, pages_per_part))
+                peaks.setdefault(pages_per_part, []).append(run["peak_rss_mb"])
+                print(f"{label:<16}{run['rows']:>8}{run['cards']:>8}{run['wall_s']:>10.2f}"
+                      f"{run['pdf_mb']:>10.1f}{run['peak_rss_mb']:>12.1f}")
+    finally:
+        shutil.rmtree(images_dir, ignore_errors=True)
+
+    if PDF_PAGES_PER_PART <= 0:
+        print("PDF_PAGES_PER_PART为0（不分段），跳过峰值内存检查")
+        return 0
+    growth = max(peaks[PDF_PAGES_PER_PART]) - peaks[PDF_PAGES_PER_PART][0]
+    ok = growth <= tolerance_mb
+    print(f"分段时峰值内存增长 {growth:.1f} MB（允许 {tolerance_mb} MB），" + ("检查通过" if ok else "检查未通过"))
+    return 0 if ok else 1
+
+def _legacy_save_card(image_bgr, cache_path):
+    """原save_to_cache + compress_image的流程：两次通道转换、PIL保存原图，再从磁盘读取压缩"""
+    from PIL import Image
+    from image_utils import compress_image, process_image_format
+
+    img = process_image_format(process_image_format(image_bgr))[:, :, ::-1]
+    pil_image = Image.fromarray(img)
+    if pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    pil_image.save(cache_path, 'JPEG', quality=85)
+    compress_image(cache_path)
+    return cache_path
+
+def _new_save_card(image_bgr, cache_path):
+    """当前save_to_cache的编码方式：BGR直接编码为压缩后的文件（计时用，不经过缓存索引）"""
+    from image_utils import encode_card
+
+    data = encode_card(image_bgr, '.jpg')
+    with open(cache_path, "wb") as f:
+        f.write(data)
+    return cache_path
+
+def _cache_save_card(processor):
+    """
+    通过CardProcessor.save_to_cache保存（缓存查找、CARD_MAX_WIDTH、原子写入，非JPEG格式再经compress_image），
+    URL使用目标文件名，缓存文件的扩展名与之相同；返回缓存文件路径
+    """
+    def save_card(image_bgr, path):
+        url = f"http://example.com/{os.path.basename(path)}"
+        cache_path = processor.save_to_cache(image_bgr, url)
+        # 再次保存同一张证卡应直接返回已有的缓存文件
+        if cache_path is None or processor.save_to_cache(image_bgr, url) != cache_path:
+            raise RuntimeError(f"缓存查找没有返回已保存的文件: {url}")
+        return cache_path
+    return save_card
+
+# 颜色检查用的色块（BGR）及解码后应得到的RGB颜色
+_COLOR_PATCHES = (
+    ((0, 0, 255), (255, 0, 0)),
+    ((0, 255, 0), (0, 255, 0)),
+    ((255, 0, 0), (0, 0, 255)),
+    ((0, 200, 255), (255, 200, 0)),
+)
+
+def _check_colors(save_card, work_dir, ext=".jpg", max_width=None, tolerance=40):
+    """
+    保存一张由色块组成的BGR图片，按PDF嵌入图片的方式（reportlab ImageReader）读回RGB数据，检查每个色块的颜色
+
+    色块带噪声，编码后超过大小上限，会经过缩小和压缩；max_width不为None时同时检查保存的宽度。
+    """
+    from reportlab.lib.utils import ImageReader
+
+    patch = 300
+    image = np.zeros((patch, patch * len(_COLOR_PATCHES), 3), np.uint8)
+    for i, (bgr, _) in enumerate(_COLOR_PATCHES):
+        image[:, i * patch:(i + 1) * patch] = bgr
+    noise = np.random.default_rng(0).integers(-24, 25, image.shape)
+    image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    try:
+        path = save_card(image, os.path.join(work_dir, f"colors{ext}"))
+    except Exception as e:
+        return [str(e)]
+
+    reader = ImageReader(path)
+    width, height = reader.getSize()
+    saved = np.frombuffer(reader.getRGBData(), np.uint8).reshape(height, width, 3)
+    scale = saved.shape[1] / image.shape[1]
+    errors = []
+    if max_width is not None and width > max_width:
+        errors.append(f"保存的宽度 {width} 超过 {max_width}")
+    for i, (_, expected_rgb) in enumerate(_COLOR_PATCHES):
+        # 取色块中间区域的平均颜色（噪声和压缩误差平均后接近原色）
+        x0, x1 = int((i + 0.25) * patch * scale), int((i + 0.75) * patch * scale)
+        y0, y1 = int(0.25 * patch * scale), int(0.75 * patch * scale)
+        actual = saved[y0:y1, x0:x1].reshape(-1, 3).mean(axis=0).round().astype(int)
+        if np.abs(actual - expected_rgb).max() > tolerance:
+            errors.append(f"色块{i + 1}: 期望RGB{expected_rgb}，实际RGB{tuple(int(v) for v in actual)}")
+    return errors
+
+def bench_encode(card_count=50, repeat=3):
+    """
+    比较原保存缓存流程与BGR直接编码的耗时、内存分配和文件大小，并检查两种方式的颜色都正确
+
+    内存分配使用tracemalloc统计（numpy和cv2的数组会被记录，PIL内部缓冲区不会，
+    因此原流程的数值偏小），整图份数为峰值内存相当于几张证卡原图的大小。
+    """
+    import card_processor
+    from config import CARD_MAX_WIDTH
+
+    crops = [StubCardPipeline()(make_card_photo(seed))["output_imgs"][0] for seed in range(card_count)]
+    work_dir = tempfile.mkdtemp(prefix="bench_encode_")
+    cache_dir = card_processor.CACHE_DIR
+    results = {}
+    failed = False
+    try:
+        # 颜色检查：原流程作为参考，当前流程经过CardProcessor.save_to_cache（缓存使用临时目录）
+        card_processor.CACHE_DIR = os.path.join(work_dir, "cache")
+        save_to_cache = _cache_save_card(card_processor.CardProcessor(use_worker_pool=False))
+        checks = (("原流程", _legacy_save_card, ".jpg", None),
+                  ("缓存JPEG", save_to_cache, ".jpg", CARD_MAX_WIDTH),
+                  ("缓存PNG", save_to_cache, ".png", CARD_MAX_WIDTH))
+        for k, (label, save_card, ext, max_width) in enumerate(checks):
+            check_dir = os.path.join(work_dir, f"colors_{k}")
+            os.makedirs(check_dir)
+            errors = _check_colors(save_card, check_dir, ext, max_width)
+            if errors:
+                failed = True
+                print(f"{label} 颜色检查失败: " + "；".join(errors))
+
+        for label, save_card in (("原流程", _legacy_save_card), ("直接编码", _new_save_card)):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for i, crop in enumerate(crops):
+                    save_card(crop, os.path.join(work_dir, f"{save_card.__name__}_{i}.jpg"))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            # 逐张统计分配的峰值内存（每多一次整图复制约增加一张图的大小）
+            peaks = 0
+            for i, crop in enumerate(crops):
+                tracemalloc.start()
+                save_card(crop, os.path.join(work_dir, f"{save_card.__name__}_{i}.jpg"))
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                peaks += peak
+            sizes = [os.path.getsize(os.path.join(work_dir, f"{save_card.__name__}_{i}.jpg"))
+                     for i in range(len(crops))]
+            results[label] = (best / len(crops) * 1000, peaks / len(crops) / 1024, sum(sizes) / len(sizes) / 1024)
+    finally:
+        card_processor.CACHE_DIR = cache_dir
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    image_kb = crops[0].nbytes / 1024
+    print(f"{'方式':<10}{'毫秒/张':>10}{'峰值内存KB/张':>14}{'整图份数':>10}{'文件KB':>10}")
+    for label, (ms, peak_kb, size_kb) in results.items():
+        print(f"{label:<10}{ms:>10.2f}{peak_kb:>14.1f}{peak_kb / image_kb:>10.1f}{size_kb:>10.1f}")
+    print("颜色检查: " + ("失败" if failed else "通过"))
+    return 1 if failed else 0
+
+def _compare_results(reference, result):
+    """
+    比较两个后端对同一张图片的检测结果
+
+    Returns:
+        dict: same_count（检测数量是否一致）、polygon_px（最大角点误差）、
+              score（最大置信度误差）、crop_diff（裁剪结果的平均像素差，尺寸不同时先缩放到参考尺寸）
+    """
+    ref_imgs, imgs = reference["output_imgs"], result["output_imgs"]
+    if len(ref_imgs) != len(imgs):
+        return {"same_count": False, "polygon_px": None, "score": None, "crop_diff": None}
+    if not ref_imgs:
+        return {"same_count": True, "polygon_px": 0.0, "score": 0.0, "crop_diff": 0.0}
+
+    polygon_px = float(np.max(np.abs(np.asarray(reference["polygons"], np.float64)
+                                     - np.asarray(result["polygons"], np.float64))))
+    score = float(np.max(np.abs(np.asarray(reference["scores"], np.float64)
+                                - np.asarray(result["scores"], np.float64))))
+    crop_diffs = []
+    for ref_img, img in zip(ref_imgs, imgs):
+        if img.shape != ref_img.shape:
+            img = cv2.resize(img, (ref_img.shape[1], ref_img.shape[0]), interpolation=cv2.INTER_LINEAR)
+        crop_diffs.append(float(np.mean(np.abs(ref_img.astype(np.int16) - img.astype(np.int16)))))
+    return {"same_count": True, "polygon_px": polygon_px, "score": score, "crop_diff": max(crop_diffs)}
+
+def _compare_detectors(detectors, images, batch_size, repeat, polygon_tolerance, score_tolerance, crop_tolerance):
+    """
+    以第一个检测器为参考，逐张比较其余检测器的结果，并测量单张和批量推理的CPU延迟
+
+    Returns:
+        bool: 是否全部在容差范围内
+    """
+    from card_processor import CardProcessor
+
+    def measure(fn):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best / len(images) * 1000
+
+    reference_name = next(iter(detectors))
+    outputs = {name: [detector(image) for image in images] for name, detector in detectors.items()}
+
+    passed = True
+    print(f"{'后端':<14}{'单张ms':>10}{f'批量{batch_size}ms/张':>14}{'图片/秒':>10}{'角点误差px':>12}{'置信度误差':>12}"
+          f"{'裁剪像素差':>12}{'数量一致':>10}")
+    for name, detector in detectors.items():
+        single_ms = measure(lambda: [detector(image) for image in images])
+        runner = CardProcessor(use_worker_pool=False)
+        runner.model, runner.model_loaded = detector, True
+        batch_ms = measure(lambda: runner.process_many(images, batch_size=batch_size))
+        timing = f"{name:<14}{single_ms:>10.1f}{batch_ms:>14.1f}{1000 / batch_ms:>10.2f}"
+
+        if name == reference_name:
+            print(f"{timing}{'参考':>12}{'-':>12}{'-':>12}{'-':>10}")
+            continue
+
+        diffs = [_compare_results(ref, out) for ref, out in zip(outputs[reference_name], outputs[name])]
+        same_count = sum(d["same_count"] for d in diffs)
+        matched = [d for d in diffs if d["same_count"]]
+        polygon_px = max((d["polygon_px"] for d in matched), default=0.0)
+        score = max((d["score"] for d in matched), default=0.0)
+        crop_diff = max((d["crop_diff"] for d in matched), default=0.0)
+        if (same_count < len(diffs) or polygon_px > polygon_tolerance or score > score_tolerance
+                or crop_diff > crop_tolerance):
+            passed = False
+        print(f"{timing}{polygon_px:>12.2f}{score:>12.4f}{crop_diff:>12.2f}{f'{same_count}/{len(diffs)}':>10}")
+
+    print(f"一致性检查（相对 {reference_name}，容差: 角点 {polygon_tolerance}px，置信度 {score_tolerance}，"
+          f"裁剪像素差 {crop_tolerance}）: " + ("通过" if passed else "失败"))
+    return passed
+
+def bench_backends(image_paths, backends=("modelscope", "onnx", "torchscript"), batch_size=8, repeat=3,
+                   polygon_tolerance=2.0, score_tolerance=0.01, crop_tolerance=3.0):
+    """
+    推理后端的一致性检查和CPU延迟对比
+
+    第一个后端作为参考（默认modelscope），其余后端逐张比较检测数量、角点坐标、置信度和裁剪结果。
+    需要本地已下载模型权重，并已用 python -m inference_backends export 导出模型。
+    """
+    from inference_backends import create_backend
+
+    images = _load_images(image_paths)
+    if not images:
+        print("没有可用的测试图片")
+        return 1
+
+    detectors = {}
+    for name in backends:
+        try:
+            detectors[name] = create_backend(name, quantized=False)
+        except Exception as e:
+            print(f"{name}: 加载失败 - {e}")
+    if len(detectors) < len(backends):
+        return 1
+
+    passed = _compare_detectors(detectors, images, batch_size, repeat,
+                                polygon_tolerance, score_tolerance, crop_tolerance)
+    return 0 if passed else 1
+
+def bench_quantized(image_paths, batch_size=8, repeat=3, polygon_tolerance=6.0, score_tolerance=0.05,
+                    crop_tolerance=8.0):
+    """
+    int8量化模型相对fp32 ONNX模型的精度检查和吞吐量对比
+
+    量化会带来少量误差，容差比后端一致性检查宽松；测试图片应使用真实拍摄的证卡照片。
+    需要先运行 python -m inference_backends quantize。
+    """
+    from inference_backends import OnnxCardDetector
+
+    images = _load_images(image_paths)
+    if not images:
+        print("没有可用的测试图片")
+        return 1
+
+    try:
+        detectors = {"onnx-fp32": OnnxCardDetector(quantized=False), "onnx-int8": OnnxCardDetector(quantized=True)}
+    except Exception as e:
+        print(f"加载失败 - {e}")
+        return 1
+
+    passed = _compare_detectors(detectors, images, batch_size, repeat,
+                                polygon_tolerance, score_tolerance, crop_tolerance)
+    return 0 if passed else 1
+
+def bench_resolution(image_paths=(), photos=5, photo_size=(4032, 3024), backend="stub", repeat=3,
+                     polygon_tolerance=12.0, crop_tolerance=3.0):
+    """
+    大尺寸照片的两级分辨率检测与原分辨率检测对比
+
+    两种方式都从JPEG压缩数据开始计时（包含解码）：原分辨率方式完整解码后检测；两级分辨率方式
+    缩小解码后检测，再按证卡需要的分辨率重新裁剪。比较延迟、分配的峰值内存，以及缩小到保存宽度后的裁剪结果。
+    不指定图片时使用合成的大尺寸证卡照片（默认4032x3024，约12MP）；backend为stub时使用替身模型。
+    """
+    from card_processor import CardProcessor
+    from config import CARD_MAX_WIDTH
+    from image_loader import decode_image, decode_for_detection, EncodedImage
+
+    def _fit_width(img, max_width):
+        if img.shape[1] <= max_width:
+            return img
+        height = round(img.shape[0] * max_width / img.shape[1])
+        return cv2.resize(img, (max_width, height), interpolation=cv2.INTER_AREA)
+
+    if image_paths:
+        encoded = []
+        for path in image_paths:
+            with open(path, "rb") as f:
+                encoded.append(f.read())
+    else:
+        encoded = [cv2.imencode(".jpg", make_card_photo(seed, photo_size), [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+                   for seed in range(photos)]
+
+    if backend == "stub":
+        detector = StubCardPipeline()
+    else:
+        from inference_backends import create_backend
+        try:
+            detector = create_backend(backend)
+        except Exception as e:
+            print(f"{backend}: 加载失败 - {e}")
+            return 1
+    runner = CardProcessor(use_worker_pool=False)
+    runner.model, runner.model_loaded = detector, True
+
+    modes = {
+        "原分辨率": lambda data: runner.process_many([decode_image(data)], batch_size=1)[0],
+        "两级分辨率": lambda data: runner.process_many([decode_for_detection(data)], batch_size=1)[0],
+    }
+    outputs, stats = {}, {}
+    for label, run in modes.items():
+        outputs[label] = [run(data) for data in encoded]
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for data in encoded:
+                run(data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        # 逐张统计分配的峰值内存
+        peaks = 0
+        for data in encoded:
+            tracemalloc.start()
+            run(data)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peaks += peak
+        stats[label] = (best / len(encoded) * 1000, peaks / len(encoded) / 1024 / 1024)
+
+    for label, output in outputs.items():
+        errors = [result for result in output if isinstance(result, Exception)]
+        if errors:
+            print(f"{label} 处理失败: {errors[0]}")
+            return 1
+        # 按保存时的最大宽度比较裁剪结果
+        for result in output:
+            result["output_imgs"] = [_fit_width(img, CARD_MAX_WIDTH) for img in result["output_imgs"]]
+
+    reduced = [decode_for_detection(data) for data in encoded]
+    reduced_count = sum(isinstance(image, EncodedImage) for image in reduced)
+    print(f"图片: {len(encoded)} 张，缩小解码 {reduced_count} 张")
+    print(f"{'方式':<10}{'毫秒/张':>10}{'峰值内存MB/张':>14}")
+    for label, (ms, peak_mb) in stats.items():
+        print(f"{label:<10}{ms:>10.1f}{peak_mb:>14.1f}")
+
+    diffs = [_compare_results(ref, out) for ref, out in zip(outputs["原分辨率"], outputs["两级分辨率"])]
+    same_count = sum(d["same_count"] for d in diffs)
+    matched = [d for d in diffs if d["same_count"]]
+    polygon_px = max((d["polygon_px"] for d in matched), default=0.0)
+    crop_diff = max((d["crop_diff"] for d in matched), default=0.0)
+    passed = same_count == len(diffs) and polygon_px <= polygon_tolerance and crop_diff <= crop_tolerance
+    print(f"检测数量一致 {same_count}/{len(diffs)}，最大角点误差 {polygon_px:.2f}px（原图坐标），"
+          f"裁剪像素差 {crop_diff:.2f}")
+    print(f"裁剪结果检查（容差: 角点 {polygon_tolerance}px，裁剪像素差 {crop_tolerance}）: " + ("通过" if passed else "失败"))
+    return 0 if passed else 1
+
+def bench_db_stream(rows=100000):
+    """
+    数据库数据源：原流程（整个查询读入DataFrame、写临时CSV再读回）与逐行读取的对比
+
+    使用本地SQLite数据库代替MySQL，列与正式查询一致（姓名, 正面URL, 背面URL）。
+    比较第一行可以开始处理的时间、读完全部行的时间和分配的峰值内存。
+    """
+    import sqlite3
+    import pandas as pd
+    from batch_engine import read_csv_rows, _parse_row
+    from db_source import ConnectionPool, StreamedRows, iter_query_rows
+
+    work_dir = tempfile.mkdtemp(prefix="bench_db_")
+    try:
+        db_path = os.path.join(work_dir, "cards.db")
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE cards (name TEXT, front TEXT, back TEXT)")
+            conn.executemany("INSERT INTO cards VALUES (?, ?, ?)",
+                             ((f"姓名{i}", f"http://example.com/front_{i}.jpg", f"http://example.com/back_{i}.jpg")
+                              for i in range(rows)))
+        sql = "SELECT name, front, back FROM cards ORDER BY rowid"
+        pool = ConnectionPool(lambda: sqlite3.connect(db_path, check_same_thread=False))
+
+        def legacy():
+            start = time.perf_counter()
+            with sqlite3.connect(db_path) as conn:
+                df = pd.read_sql(sql, conn)
+            csv_path = os.path.join(work_dir, "legacy.csv")
+            df.to_csv(csv_path, index=False, header=False)
+            parsed = read_csv_rows(csv_path)
+            elapsed = time.perf_counter() - start
+            return elapsed, elapsed, len(parsed)
+
+        def streamed():
+            start = time.perf_counter()
+            stream = StreamedRows(iter_query_rows(sql, connection_pool=pool),
+                                  os.path.join(work_dir, "stream.csv"), _parse_row).start()
+            stream.wait(0)
+            first = time.perf_counter() - start
+            stream.wait(rows)
+            return first, time.perf_counter() - start, stream.total
+
+        print(f"{'方式':<12}{'首行可处理ms':>14}{'读完全部s':>12}{'行数':>10}{'峰值内存MB':>12}")
+        for label, run in (("原流程", legacy), ("逐行读取", streamed)):
+            tracemalloc.start()
+            first, total, count = run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{label:<12}{first * 1000:>14.1f}{total:>12.2f}{count:>10}{peak / 1024 / 1024:>12.1f}")
+        pool.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+def _legacy_read_csv_rows(csv_path):
+    """原CSV读取流程：整个文件读入DataFrame，再逐个单元格用iloc读取"""
+    import pandas as pd
+
+    df = pd.read_csv(csv_path, header=None)
+    parsed = []
+    for i in range(len(df)):
+        name = str(df.iloc[i, 0]).strip()
+        urls = []
+        for k, card_type in ((1, "正面"), (2, "背面")):
+            url = str(df.iloc[i, k]).strip()
+            if url and url != 'nan' and url != 'None':
+                urls.append((card_type, url, name))
+        parsed.append(urls)
+    return parsed
+
+def bench_csv(rows=100000, distinct=60000):
+    """
+    CSV读取：原流程（整表DataFrame + iloc逐格读取）与逐行读取的耗时和峰值内存对比
+
+    URL从distinct个不同的地址中随机选取（模拟共用账户和重复提交），同时统计去重后需要处理的URL数量。
+    """
+    from batch_engine import read_csv_rows
+
+    work_dir = tempfile.mkdtemp(prefix="bench_csv_")
+    try:
+        rng = np.random.default_rng(0)
+        csv_path = os.path.join(work_dir, "cards.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            for i in range(rows):
+                front, back = rng.integers(distinct, size=2)
+                back_url = f"http://example.com/card_{back}.jpg" if i % 10 else ""
+                f.write(f"姓名{i},http://example.com/card_{front}.jpg,{back_url}\n")
+
+        print(f"{'方式':<12}{'耗时s':>10}{'峰值内存MB':>12}{'URL引用':>10}{'不同URL':>10}")
+        results = {}
+        for label, read in (("原流程", _legacy_read_csv_rows), ("逐行读取", read_csv_rows)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            parsed = read(csv_path)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            urls = [url for row in parsed for _, url, _ in row]
+            results[label] = parsed
+            print(f"{label:<12}{elapsed:>10.2f}{peak / 1024 / 1024:>12.1f}{len(urls):>10}{len(set(urls)):>10}")
+        same = results["原流程"] == results["逐行读取"]
+        print(f"解析结果{'一致' if same else '不一致'}；同一URL只下载和推理一次，"
+              f"重复引用的行直接使用第一次的处理结果")
+
+        # 列数不固定的文件：多出的列忽略（不能错位），缺少的列为空
+        ragged_files = {
+            "第一行4列": (["A,http://x/a.jpg,http://x/b.jpg,extra", "B,http://x/c.jpg", "C,http://x/d.jpg,,x,y",
+                        ",http://x/e.jpg,http://x/f.jpg,"],
+                       [[("正面", "http://x/a.jpg", "A"), ("背面", "http://x/b.jpg", "A")],
+                        [("正面", "http://x/c.jpg", "B")],
+                        [("正面", "http://x/d.jpg", "C")],
+                        [("正面", "http://x/e.jpg", "未知_4"), ("背面", "http://x/f.jpg", "未知_4")]]),
+            "第一行2列": (["A,http://x/a.jpg", "B,http://x/c.jpg,http://x/b.jpg,extra", "C,http://x/d.jpg,,x,y"],
+                       [[("正面", "http://x/a.jpg", "A")],
+                        [("正面", "http://x/c.jpg", "B"), ("背面", "http://x/b.jpg", "B")],
+                        [("正面", "http://x/d.jpg", "C")]]),
+        }
+        for k, (label, (lines, expected)) in enumerate(ragged_files.items()):
+            ragged_path = os.path.join(work_dir, f"ragged_{k}.csv")
+            with open(ragged_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            parsed = read_csv_rows(ragged_path)
+            if parsed != expected:
+                same = False
+            print(f"列数不固定的CSV（{label}）解析{'正确' if parsed == expected else f'错误: {parsed}'}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if same else 1
+
+def _run_overlapping_jobs(photos, job_urls, flights):
+    """
+    多个线程同时按各自的URL列表批量推理并保存缓存（模拟多个用户同时导出有重叠的名单），
+    同时另有线程不断读取缓存文件，检查是否读到不完整的文件
+
+    Returns:
+        dict: 推理次数、编码次数、耗时、各任务得到的结果和检查出的问题
+    """
+    import batch_engine
+    import card_processor
+    from batch_job import StageTimer
+    from config import INFERENCE_BATCH_SIZE
+
+    processor = card_processor.processor
+    url_of = {id(photo): url for url, photo in photos.items()}
+    counts = {"inference": 0, "encode": 0}
+    count_lock = threading.Lock()
+    stub = StubCardPipeline()
+
+    def model(image):
+        with count_lock:
+            counts["inference"] += 1
+        time.sleep(0.005)
+        return stub(image)
+
+    # 逐张调用替身模型（替身没有实现批量前向计算）
+    model.process_batch = lambda images: [model(image) for image in images]
+    encode_card = card_processor.encode_card
+
+    def counting_encode(*args, **kwargs):
+        with count_lock:
+            counts["encode"] += 1
+        return encode_card(*args, **kwargs)
+
+    processor.model = model
+    processor.model_loaded = True
+    card_processor.encode_card = counting_encode
+    batch_engine.inference_flights = flights
+
+    problems = []
+    results = [dict() for _ in job_urls]
+    stop = threading.Event()
+    barrier = threading.Barrier(len(job_urls))
+
+    def run_job(k):
+        barrier.wait()
+        urls = job_urls[k]
+        try:
+            for start in range(0, len(urls), INFERENCE_BATCH_SIZE):
+                chunk = [(url, {"image": photos[url]}) for url in urls[start:start + INFERENCE_BATCH_SIZE]]
+                for url, outcome in batch_engine._run_chunk(chunk, f"job{k}", StageTimer()):
+                    if url is None:
+                        continue
+                    if "error" in outcome:
+                        problems.append(f"{url}: {outcome['error']}")
+                        continue
+                    result = outcome["result"]
+                    cache_path = processor.save_to_cache(result["output_imgs"][0], url)
+                    results[k][url] = (np.asarray(result["polygons"]).round(3).tolist(), cache_path)
+        except Exception as e:
+            problems.append(f"任务{k}: {e}")
+
+    def read_cache():
+        while not stop.is_set():
+            for url in photos:
+                path = processor.card_cache.path_for(url)
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    continue
+                if not data.endswith(b"\xff\xd9"):
+                    problems.append(f"读到不完整的缓存文件: {path} ({len(data)} 字节)")
+
+    reader = threading.Thread(target=read_cache, daemon=True)
+    reader.start()
+    threads = [threading.Thread(target=run_job, args=(k,)) for k in range(len(job_urls))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reader.join()
+    card_processor.encode_card = encode_card
+    return {**counts, "elapsed": elapsed, "results": results, "problems": problems}
+
+def bench_single_flight(jobs=16, distinct_urls=80, urls_per_job=40):
+    """
+    相同URL合并推理的压力测试：多个线程同时请求有重叠的URL
+
+    对比不合并（每个请求各自推理）与合并后的推理次数、缓存编码次数和耗时，
+    并检查同一URL在各任务中的结果一致、缓存读取方没有读到写了一半的文件、没有残留临时文件。
+    """
+    import card_processor
+    import batch_engine
+    from single_flight import Flight, SingleFlight
+    from downloader import downloader
+
+    class NoCoalescing(SingleFlight):
+        """每次请求都自行计算（合并之前的行为）"""
+
+        def claim(self, key):
+            return Flight(), True
+
+    work_dir = tempfile.mkdtemp(prefix="bench_flight_")
+    original_flights = batch_engine.inference_flights
+    original_store = downloader.store_dir, downloader._store
+    downloader.store_dir, downloader._store = os.path.join(work_dir, "raw"), None
+    try:
+        photos = {f"http://example.com/card_{k}.jpg": make_card_photo(k, (640, 480)) for k in range(distinct_urls)}
+        rng = np.random.default_rng(0)
+        pool = list(photos)
+        job_urls = [[pool[k] for k in rng.permutation(distinct_urls)[:urls_per_job]] for _ in range(jobs)]
+        requests = sum(len(urls) for urls in job_urls)
+        unique_urls = len(set(sum(job_urls, [])))
+
+        print(f"{jobs} 个任务同时请求 {requests} 次，{unique_urls} 个不同的URL")
+        print(f"{'方式':<10}{'推理次数':>10}{'编码次数':>10}{'耗时s':>10}")
+        ok = True
+        for label, flights in (("不合并", NoCoalescing("bench")), ("合并", SingleFlight("bench"))):
+            run_dir = os.path.join(work_dir, label)
+            card_processor.CACHE_DIR = os.path.join(run_dir, "cache")
+            card_processor.RESULT_DIR = os.path.join(run_dir, "results")
+            processor = card_processor.processor
+            processor.use_worker_pool = False
+            processor._card_cache = None
+            processor._result_store = None
+            run = _run_overlapping_jobs(photos, job_urls, flights)
+            print(f"{label:<10}{run['inference']:>10}{run['encode']:>10}{run['elapsed']:>10.2f}")
+
+            # 同一URL在所有任务中的检测结果和缓存路径一致
+            seen = {}
+            for job_results in run["results"]:
+                for url, value in job_results.items():
+                    if seen.setdefault(url, value) != value:
+                        run["problems"].append(f"{url}: 各任务得到的结果不一致")
+            if sum(len(job_results) for job_results in run["results"]) != requests:
+                run["problems"].append("部分请求没有得到结果")
+            # 合并后每个URL只推理一次；两种方式下每张证卡都只编码一次
+            if flights.__class__ is SingleFlight and run["inference"] != unique_urls:
+                run["problems"].append(f"推理 {run['inference']} 次，应为每个URL一次（{unique_urls} 次）")
+            if run["encode"] != unique_urls:
+                run["problems"].append(f"编码 {run['encode']} 次，应为每张证卡一次（{unique_urls} 次）")
+            leftovers = [name for _, _, names in os.walk(run_dir) for name in names if name.endswith(".tmp")]
+            if leftovers:
+                run["problems"].append(f"残留临时文件: {leftovers[:3]}")
+            for problem in run["problems"][:10]:
+                print(f"  ✗ {problem}")
+            ok = ok and not run["problems"]
+        print("检查通过" if ok else "检查未通过")
+    finally:
+        batch_engine.inference_flights = original_flights
+        downloader.store_dir, downloader._store = original_store
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if ok else 1
+
+class _FlakyImageHandler(BaseHTTPRequestHandler):
+    """
+    模拟图片服务器：支持keep-alive和ETag条件请求，部分图片前几次请求返回503
+
+    统计新建连接数、同时处理的最大请求数和传输的图片字节数。
+    """
+    protocol_version = "HTTP/1.1"
+    # keep-alive连接上响应头和图片数据分开发送，关闭Nagle算法避免等待延迟确认
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.stats["max_active"] = max(server.stats["max_active"], server.active)
+        try:
+            data = server.images.get(self.path)
+            if data is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            with server.lock:
+                failing = server.failures.get(self.path, 0) > 0
+                if failing:
+                    server.failures[self.path] -= 1
+            time.sleep(server.latency)
+            if failing:
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            etag = server.etags[self.path]
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(data)
+            with server.lock:
+                server.stats["bytes"] += len(data)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+def bench_download(images=200, workers=8, failure_rate=0.2, per_host=4, latency=0.01):
+    """
+    图片下载：原方式（urllib逐个建立连接、不重试）与下载器（连接池、按主机限制并发、重试、条件请求）的对比
+
+    使用本地HTTP服务模拟图片服务器，failure_rate比例的图片前1~2次请求返回503。
+    下载器再运行一次模拟重新处理（如模型升级后），图片未变化时只返回304，不再传输图片。
+    """
+    import hashlib
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from downloader import Downloader
+
+    work_dir = tempfile.mkdtemp(prefix="bench_download_")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FlakyImageHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.latency = latency
+    server.images = {}
+    server.etags = {}
+    for k in range(images):
+        ok, buffer = cv2.imencode(".jpg", make_card_photo(k, (640, 480)), [cv2.IMWRITE_JPEG_QUALITY, 85])
+        path = f"/card_{k}.jpg"
+        server.images[path] = buffer.tobytes()
+        server.etags[path] = '"' + hashlib.sha1(server.images[path]).hexdigest() + '"'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    expected = {base_url + path: data for path, data in server.images.items()}
+    urls = list(expected)
+
+    def legacy_fetch(url):
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.read()
+
+    downloader = Downloader(store_dir=os.path.join(work_dir, "raw"), max_bytes=0, per_host=per_host,
+                            backoff=0.05)
+    runs = (("原方式", legacy_fetch), ("下载器", downloader.fetch), ("下载器(重新处理)", downloader.fetch))
+    rng = np.random.default_rng(0)
+    ok = True
+    try:
+        print(f"{images} 张图片，{workers} 个下载线程，{failure_rate:.0%} 的图片前1~2次请求返回503，"
+              f"下载器每个主机最多 {per_host} 个并发")
+        print(f"{'方式':<16}{'成功':>6}{'失败':>6}{'新建连接':>10}{'最大并发':>10}{'传输MB':>10}{'耗时s':>8}")
+        for label, fetch in runs:
+            server.failures = {path: int(rng.integers(1, 3)) for path in server.images
+                               if rng.random() < failure_rate}
+            server.stats = {"connections": 0, "max_active": 0, "bytes": 0}
+            server.active = 0
+
+            def attempt(url):
+                try:
+                    return fetch(url) == expected[url]
+                except Exception:
+                    return False
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(attempt, urls))
+            elapsed = time.perf_counter() - start
+            stats = server.stats
+            print(f"{label:<16}{sum(results):>6}{results.count(False):>6}{stats['connections']:>10}"
+                  f"{stats['max_active']:>10}{stats['bytes'] / 1024 / 1024:>10.2f}{elapsed:>8.2f}")
+            if fetch is downloader.fetch:
+                ok = ok and all(results) and stats["max_active"] <= per_host
+        print("检查通过" if ok else "检查未通过")
+    finally:
+        downloader.close()
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0 if ok else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="证卡处理性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    inference_parser = subparsers.add_parser("inference", help="逐张推理与批量推理吞吐量对比")
+    inference_parser.add_argument("images", nargs="+", help="测试图片路径")
+    inference_parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 8, 16])
+    inference_parser.add_argument("--repeat", type=int, default=3)
+
+    compress_parser = subparsers.add_parser("compress", help="JPEG大小限制压缩的编码次数和耗时对比")
+    compress_parser.add_argument("images", nargs="+", help="测试图片路径")
+    compress_parser.add_argument("--max-size-kb", type=int, default=20)
+    compress_parser.add_argument("--workers", type=int, default=4)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="合成证卡和替身模型的端到端批量处理基准测试")
+    pipeline_parser.add_argument("--rows", nargs="+", type=int, default=[100, 1000, 10000])
+    pipeline_parser.add_argument("--images", type=int, default=200, help="不同的合成照片数量")
+    pipeline_parser.add_argument("--output", default="bench_pipeline.json", help="结果JSON文件")
+
+    encode_parser = subparsers.add_parser("encode", help="保存缓存时的图像转换、编码耗时和内存对比（含颜色检查）")
+    encode_parser.add_argument("--cards", type=int, default=50, help="合成证卡数量")
+    encode_parser.add_argument("--repeat", type=int, default=3)
+
+    backends_parser = subparsers.add_parser("backends", help="推理后端一致性检查和CPU延迟对比（需要本地模型权重）")
+    backends_parser.add_argument("images", nargs="+", help="测试图片路径")
+    backends_parser.add_argument("--backends", nargs="+", default=["modelscope", "onnx", "torchscript"],
+                                 choices=["modelscope", "onnx", "torchscript"], help="第一个作为参考")
+    backends_parser.add_argument("--batch-size", type=int, default=8)
+    backends_parser.add_argument("--repeat", type=int, default=3)
+
+    quantized_parser = subparsers.add_parser("quantized", help="int8量化模型与fp32的精度和吞吐量对比")
+    quantized_parser.add_argument("images", nargs="+", help="测试图片路径")
+    quantized_parser.add_argument("--batch-size", type=int, default=8)
+    quantized_parser.add_argument("--repeat", type=int, default=3)
+
+    resolution_parser = subparsers.add_parser("resolution", help="大尺寸照片两级分辨率检测与原分辨率检测的延迟、内存和裁剪结果对比")
+    resolution_parser.add_argument("images", nargs="*", help="测试图片路径（JPEG），不指定时使用合成照片")
+    resolution_parser.add_argument("--photos", type=int, default=5, help="合成照片数量")
+    resolution_parser.add_argument("--photo-size", nargs=2, type=int, default=[4032, 3024], metavar=("W", "H"))
+    resolution_parser.add_argument("--backend", default="stub", choices=["stub", "modelscope", "onnx", "torchscript"])
+    resolution_parser.add_argument("--repeat", type=int, default=3)
+
+    pdf_parser = subparsers.add_parser("pdfstream", help="边处理边生成PDF时分段保存与不分段的峰值内存对比（检查内存不随行数增长）")
+    pdf_parser.add_argument("--rows", nargs="+", type=int, default=[500, 2000, 8000])
+    pdf_parser.add_argument("--tolerance-mb", type=float, default=30, help="分段时允许的峰值内存增长")
+
+    db_parser = subparsers.add_parser("dbstream", help="数据库逐行读取与整表读取再写CSV的首行延迟和内存对比（SQLite）")
+    db_parser.add_argument("--rows", type=int, default=100000)
+
+    csv_parser = subparsers.add_parser("csv", help="CSV逐行读取与整表iloc读取的耗时和内存对比，以及重复URL统计")
+    csv_parser.add_argument("--rows", type=int, default=100000)
+    csv_parser.add_argument("--distinct", type=int, default=60000, help="不同URL的数量")
+
+    flight_parser = subparsers.add_parser("singleflight", help="多个任务同时请求重叠URL时的合并推理压力测试（含缓存原子写入检查）")
+    flight_parser.add_argument("--jobs", type=int, default=16, help="同时运行的任务（线程）数")
+    flight_parser.add_argument("--urls", type=int, default=80, help="不同URL的数量")
+    flight_parser.add_argument("--per-job", type=int, default=40, help="每个任务请求的URL数量")
+
+    download_parser = subparsers.add_parser("download", help="下载器（连接池、重试、条件请求）与原下载方式的对比（本地模拟图片服务器）")
+    download_parser.add_argument("--images", type=int, default=200)
+    download_parser.add_argument("--workers", type=int, default=8, help="下载线程数")
+    download_parser.add_argument("--failure-rate", type=float, default=0.2, help="前几次请求返回503的图片比例")
+    download_parser.add_argument("--per-host", type=int, default=4, help="下载器每个主机的最大并发数")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == "inference":
+        return bench_inference(args.images, args.batch_sizes, args.repeat)
+    if args.command == "compress":
+        return bench_compress(args.images, args.max_size_kb, workers=args.workers)
+    if args.command == "pipeline":
+        return bench_pipeline(args.rows, args.images, args.output)
+    if args.command == "encode":
+        return bench_encode(args.cards, args.repeat)
+    if args.command == "backends":
+        return bench_backends(args.images, args.backends, args.batch_size, args.repeat)
+    if args.command == "quantized":
+        return bench_quantized(args.images, args.batch_size, args.repeat)
+    if args.command == "resolution":
+        return bench_resolution(args.images, args.photos, tuple(args.photo_size), args.backend, args.repeat)
+    if args.command == "pdfstream":
+        return bench_pdf_stream(args.rows, tolerance_mb=args.tolerance_mb)
+    if args.command == "dbstream":
+        return bench_db_stream(args.rows)
+    if args.command == "csv":
+        return bench_csv(args.rows, args.distinct)
+    if args.command == "singleflight":
+        return bench_single_flight(args.jobs, args.urls, args.per_job)
+    if args.command == "download":
+        return bench_download(args.images, args.workers, args.failure_rate, args.per_host)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
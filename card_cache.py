@@ -0,0 +1,251 @@
+# 证卡缓存（SQLite索引，按容量上限LRU淘汰）
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = ".cache_index.sqlite"
+LEGACY_KEY_PREFIX = "legacy:"
+# SQLite单条语句的参数个数有限制，批量查询时分段执行
+_QUERY_CHUNK = 500
+
+def legacy_cache_relpath(url):
+    """旧版缓存路径：由URL路径清理得到（不同URL可能清理为同一路径，仅用于兼容已有缓存）"""
+    file_path = urlparse(url).path
+
+    # 处理/file/开头的路径
+    if file_path.startswith('/file/'):
+        file_path = file_path[6:]  # 去掉/file/前缀
+
+    # URL解码和清理路径
+    file_path = unquote(file_path)
+    file_path = re.sub(r'^/', '', file_path)  # 去掉开头的斜杠
+    file_path = re.sub(r'[^\w\.\/-]', '_', file_path)  # 替换非法字符
+    return file_path
+
+def file_checksum(path):
+    """计算文件内容的SHA1校验值"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CardCache:
+    """
+    处理后证卡图片的磁盘缓存
+
+    缓存文件按 URL+模型ID 的哈希存放，索引记录文件大小、格式、最后访问时间和校验值。
+    总大小超过 max_bytes 时按最后访问时间淘汰最久未使用的文件。
+    """
+
+    def __init__(self, cache_dir, model_id, max_bytes, min_age=3600):
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.min_age = min_age  # 最近访问过的文件不淘汰，避免正在生成PDF的图片被删除
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, INDEX_FILE_NAME),
+                                     check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    format TEXT,
+                    last_access REAL NOT NULL,
+                    checksum TEXT
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+        # 首次启动时根据已有的缓存目录建立索引
+        if self._get_meta("indexed_at") is None:
+            self.rebuild_index()
+
+    def _get_meta(self, name):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def make_key(self, url, index=None):
+        """缓存键：URL和模型ID的哈希，index为多卡证图片中的卡证序号"""
+        source = f"{self.model_id}\n{url}" if index is None else f"{self.model_id}\n{url}#{index}"
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def path_for(self, url, index=None):
+        """新缓存文件的存放路径（保留原URL的扩展名）"""
+        key = self.make_key(url, index)
+        ext = os.path.splitext(urlparse(url).path)[1].lower() or ".jpg"
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def lookup(self, url, index=None):
+        """查找单个URL（或多卡证图片中第index张卡证）的缓存文件，不存在时返回None"""
+        if index is None:
+            return self.lookup_many([url]).get(url)
+
+        key = self.make_key(url, index)
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        with self._lock, self._conn:
+            if not os.path.exists(row[0]):
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def lookup_many(self, urls):
+        """
+        批量查找缓存
+
+        Returns:
+            dict: URL -> 缓存文件路径（只包含命中的URL）
+        """
+        keys = {}
+        for url in set(urls):
+            keys[self.make_key(url)] = url
+            keys[LEGACY_KEY_PREFIX + legacy_cache_relpath(url)] = url
+
+        rows = []
+        key_list = list(keys)
+        with self._lock:
+            for start in range(0, len(key_list), _QUERY_CHUNK):
+                chunk = key_list[start:start + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(self._conn.execute(
+                    f"SELECT key, path FROM entries WHERE key IN ({placeholders})", chunk).fetchall())
+
+        found = {}
+        hit_keys = []
+        missing_keys = []
+        for key, path in rows:
+            url = keys[key]
+            if not os.path.exists(path):
+                missing_keys.append(key)
+                continue
+            # 新格式的缓存优先于旧版路径
+            if url not in found or not key.startswith(LEGACY_KEY_PREFIX):
+                found[url] = path
+            hit_keys.append(key)
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?",
+                                   [(now, key) for key in hit_keys])
+            # 文件已被外部删除的条目从索引中移除
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in missing_keys])
+        return found
+
+    def put(self, url, path, index=None):
+        """记录新写入的缓存文件，并在超出容量时淘汰旧文件"""
+        self._record(self.make_key(url, index), url, path)
+        self.evict()
+
+    def refresh(self, path):
+        """缓存文件被原地改写（如压缩）后更新索引中的大小和校验值"""
+        if not path or not os.path.exists(path):
+            return
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE entries SET size = ?, checksum = ?, last_access = ? WHERE path = ?",
+                               (os.path.getsize(path), file_checksum(path), time.time(), path))
+
+    def _record(self, key, url, path):
+        fmt = os.path.splitext(path)[1].lower().lstrip(".")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, url, path, size, format, last_access, checksum) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, url, path, os.path.getsize(path), fmt, time.time(), file_checksum(path)))
+
+    def total_size(self):
+        """索引中所有缓存文件的总大小（字节）"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def evict(self):
+        """总大小超过上限时，按最后访问时间删除最久未使用的文件"""
+        if not self.max_bytes:
+            return 0
+
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+
+        with self._lock:
+            candidates = self._conn.execute(
+                "SELECT key, path, size FROM entries WHERE last_access < ? ORDER BY last_access",
+                (time.time() - self.min_age,)).fetchall()
+
+        removed_keys = []
+        freed = 0
+        for key, path, size in candidates:
+            if freed >= excess:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除缓存文件失败: {path} - {e}")
+                continue
+            removed_keys.append(key)
+            freed += size
+
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in removed_keys])
+        if removed_keys:
+            logger.info(f"缓存淘汰 {len(removed_keys)} 个文件，释放 {freed / 1024 / 1024:.1f}MB")
+        return len(removed_keys)
+
+    def rebuild_index(self):
+        """扫描缓存目录，为尚未建立索引的文件（旧版缓存）补充索引"""
+        start = time.time()
+        with self._lock:
+            indexed_paths = {row[0] for row in self._conn.execute("SELECT path FROM entries")}
+
+        new_rows = []
+        stack = [self.cache_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                logger.warning(f"无法扫描缓存目录 {directory}: {e}")
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif (entry.is_file(follow_symlinks=False) and not entry.name.startswith(INDEX_FILE_NAME)
+                      and not entry.name.endswith(".tmp")):  # 跳过写入中断留下的临时文件
+                    if entry.path in indexed_paths:
+                        continue
+                    stat = entry.stat()
+                    relpath = os.path.relpath(entry.path, self.cache_dir).replace(os.sep, "/")
+                    fmt = os.path.splitext(entry.name)[1].lower().lstrip(".")
+                    # 旧版缓存只记录路径，校验值在重新写入时再计算，保证重建速度
+                    new_rows.append((LEGACY_KEY_PREFIX + relpath, None, entry.path,
+                                     stat.st_size, fmt, stat.st_mtime, None))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO entries (key, url, path, size, format, last_access, checksum) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", new_rows)
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('indexed_at', ?)",
+                               (str(time.time()),))
+        logger.info(f"缓存索引重建完成: 新增 {len(new_rows)} 个文件，耗时 {time.time() - start:.2f} 秒")
+        return len(new_rows)
\ No newline at end of file
@@ -1,30 +1,36 @@
 # CardProcessor类
 import os
-import re
 import time
 import logging
-from urllib.parse import unquote, urlparse
-from PIL import Image
 import numpy as np
-from modelscope.pipelines import pipeline
-from modelscope.utils.constant import Tasks
 
-from config import CACHE_DIR
-from image_utils import process_image_format
+from card_cache import CardCache
+from config import CACHE_DIR, CACHE_MAX_BYTES, RESULT_DIR, RESULT_STORE_MAX_BYTES, JOB_DIR, MODEL_ID, INFERENCE_BATCH_SIZE, MODEL_WORKERS, MODEL_WORKER_THREADS
+from config import INFERENCE_BACKEND, CARD_MAX_WIDTH
+from image_utils import atomic_write, compress_image, encode_card
+from image_loader import EncodedImage
+from inference_backends import create_backend, recrop_cards
+from job_journal import JobJournal
+from metrics import metrics, record_cache_lookup, stage_timer, timed
+from result_store import ResultStore
+from single_flight import cache_flights
+from worker_pool import ModelWorkerPool
 
 logger = logging.getLogger(__name__)
 
 class CardProcessor:
-    def __init__(self):
+    def __init__(self, use_worker_pool=True):
         self.model = None
         self.model_loaded = False
-        self.selection_cache = {}  # 缓存用户选择
-        self.current_selection_data = {}  # 当前需要选择的数据
-        self.processed_images = []  # 存储所有处理后的图片路径
-        self.image_info_list = []  # 存储图片信息（正面/背面，行索引）
-        self.names_list = []  # 存储姓名信息
         self.timestamp_dir = None  # 时间戳目录
         self.output_image_paths = {}  # 存储输出图片路径映射
+        self.use_worker_pool = use_worker_pool  # 工作进程内的实例不再创建工作池
+        self.worker_pool = None  # 多进程模型工作池（MODEL_WORKERS > 1 时启用）
+        self._card_cache = None  # 证卡缓存（首次使用时建立索引）
+        self._result_store = None  # 检测结果和用户选择的持久化存储
+        self._job_journal = None  # 批量处理任务日志
+        self.batch_forward = True  # modelscope流水线是否支持合并前向计算（状态无法逐张恢复时改为逐张调用）
+        self.batch_state_keys = ()  # 合并前向计算时逐张记录和恢复的pipeline属性
     
     def init_model(self):
         """初始化模型"""
@@ -33,9 +39,8 @@ class CardProcessor:
             return True
             
         try:
-            logger.info("正在初始化模型...")
-            self.model = pipeline(Tasks.card_detection_correction, 
-                                model='iic/cv_resnet18_card_correction')
+            logger.info(f"正在初始化模型（推理后端: {INFERENCE_BACKEND}）...")
+            self.model = create_backend(INFERENCE_BACKEND)
             self.model_loaded = True
             logger.info("模型初始化成功")
             return True
@@ -43,159 +48,247 @@ class CardProcessor:
             logger.error(f"模型初始化失败: {e}")
             return False
 
-    def check_cache(self, original_url):
-        """检查本地缓存中是否存在已处理的图片"""
+    @property
+    def parallelism(self):
+        """可同时执行推理的模型实例数"""
+        return max(1, MODEL_WORKERS) if self.use_worker_pool else 1
+
+    def get_worker_pool(self):
+        """获取多进程模型工作池，MODEL_WORKERS <= 1 时返回None（在当前进程内推理）"""
+        if MODEL_WORKERS <= 1 or not self.use_worker_pool:
+            return None
+        if self.worker_pool is None:
+            self.worker_pool = ModelWorkerPool(MODEL_WORKERS, MODEL_WORKER_THREADS).start()
+        return self.worker_pool
+
+    def process_many(self, images, batch_size=INFERENCE_BATCH_SIZE):
+        """
+        批量推理：将多张图片的预处理结果合并为一次前向计算，再按图片拆分检测结果
+
+        Args:
+            images: 图片列表（URL、文件路径、BGR格式的numpy数组或缩小解码的EncodedImage）
+            batch_size: 每次前向计算的图片数量
+
+        Returns:
+            list: 与输入顺序一致的结果列表，每项为模型输出字典；
+                  单张图片处理失败时对应位置为异常对象
+        """
+        with stage_timer("inference", len(images)):
+            # 启用工作池时分发到各个工作进程
+            worker_pool = self.get_worker_pool()
+            if worker_pool is not None:
+                return worker_pool.process_many(images, batch_size)
+            return self._process_chunks(images, batch_size)
+
+    def _process_chunks(self, images, batch_size):
+        """在当前进程内按批次推理，批量失败时逐张处理"""
+        results = []
+        for start in range(0, len(images), max(1, batch_size)):
+            # 缩小解码的图片在缩小图像上检测
+            chunk = [image.image if isinstance(image, EncodedImage) else image
+                     for image in images[start:start + batch_size]]
+            try:
+                results.extend(self._forward_batch(chunk))
+            except Exception as e:
+                logger.warning(f"批量推理失败，改为逐张处理: {e}")
+                for image in chunk:
+                    try:
+                        results.append(self.model(image))
+                    except Exception as single_error:
+                        results.append(single_error)
+
+        # 缩小解码的图片从更高分辨率的图像重新裁剪
+        for i, image in enumerate(images):
+            if isinstance(image, EncodedImage) and not isinstance(results[i], Exception):
+                try:
+                    results[i] = recrop_cards(results[i], image)
+                except Exception as e:
+                    results[i] = e
+        return results
+
+    def _forward_batch(self, images):
+        """对一批图片执行一次前向计算"""
+        if len(images) == 1:
+            return [self.model(images[0])]
+
+        # 导出模型的后端自带批量推理
+        if hasattr(self.model, "process_batch"):
+            return self.model.process_batch(images)
+
+        if not self.batch_forward:
+            return [self.model(image) for image in images]
+
+        # modelscope流水线：分别调用预处理、前向计算和后处理
+        import torch
+        pipe = self.model
+        prepared = []
+        state_keys = set()  # 任一图片的预处理设置或替换过的属性
+        for image in images:
+            before = {k: _state_snapshot(v) for k, v in vars(pipe).items()}
+            inputs = pipe.preprocess(image)
+            # 预处理会把原图等状态保存在pipeline实例上（后处理裁剪时使用），逐张记录属性
+            image_state = dict(vars(pipe))
+            changed = {k: v for k, v in image_state.items() if k not in before or _state_changed(before[k], v)}
+            problem = _batch_state_problem(changed, inputs, prepared[0][0] if prepared else inputs)
+            if problem:
+                # 无法确认逐张恢复的状态完整时，合并后处理可能从错误的原图裁剪，改为逐张调用
+                logger.warning(f"流水线不支持合并前向计算，改为逐张推理: {problem}")
+                self.batch_forward = False
+                return [self.model(image) for image in images]
+            prepared.append((inputs, image_state))
+            state_keys.update(changed)
+
+        state_keys = tuple(sorted(state_keys))
+        if state_keys != self.batch_state_keys:
+            logger.info(f"合并前向计算逐张恢复的pipeline属性: {', '.join(state_keys) or '无'}")
+            self.batch_state_keys = state_keys
+
+        # 合并输入张量，一次前向计算
+        batch_inputs = dict(prepared[0][0])
+        batch_inputs["img"] = torch.cat([inputs["img"] for inputs, _ in prepared], dim=0)
+        with torch.no_grad():
+            outputs = pipe.forward(batch_inputs)
+
+        # 按图片拆分输出并逐张后处理
+        results = []
+        for j, (inputs, image_state) in enumerate(prepared):
+            item_outputs = {k: _slice_batch(v, j) for k, v in outputs.items()}
+            item_outputs["meta"] = inputs.get("meta")
+            vars(pipe).update({k: image_state[k] for k in state_keys if k in image_state})
+            results.append(pipe.postprocess(item_outputs))
+        return results
+
+    @property
+    def card_cache(self):
+        """证卡缓存，工作进程中不会用到，因此在首次访问时再打开索引"""
+        if self._card_cache is None:
+            self._card_cache = CardCache(CACHE_DIR, MODEL_ID, CACHE_MAX_BYTES)
+        return self._card_cache
+
+    @property
+    def result_store(self):
+        """检测结果存储，在首次访问时打开"""
+        if self._result_store is None:
+            self._result_store = ResultStore(RESULT_DIR, MODEL_ID, RESULT_STORE_MAX_BYTES)
+        return self._result_store
+
+    @property
+    def job_journal(self):
+        """批量处理任务日志，在首次访问时打开"""
+        if self._job_journal is None:
+            self._job_journal = JobJournal(JOB_DIR)
+        return self._job_journal
+
+    def check_cache(self, original_url, index=None):
+        """检查本地缓存中是否存在已处理的图片，index为多卡证图片中的卡证序号"""
         try:
-            # 从URL中提取文件路径
-            parsed_url = urlparse(original_url)
-            file_path = parsed_url.path
-            
-            # 处理/file/开头的路径
-            if file_path.startswith('/file/'):
-                file_path = file_path[6:]  # 去掉/file/前缀
-            
-            # URL解码和清理路径
-            file_path = unquote(file_path)
-            file_path = re.sub(r'^/', '', file_path)  # 去掉开头的斜杠
-            file_path = re.sub(r'[^\w\.\/-]', '_', file_path)  # 替换非法字符
-                        
-            # 确保文件扩展名为.jpg
-            base_name = os.path.basename(file_path)
-            
-            # 构建缓存路径
-            cache_path = os.path.join(CACHE_DIR, file_path)
-            
-            # 检查缓存文件是否存在
-            if os.path.exists(cache_path):
+            cache_path = self.card_cache.lookup(original_url, index)
+            if cache_path:
                 logger.info(f"找到缓存文件: {cache_path}")
-                return cache_path
-                
-            # 检查目录是否存在，不存在则创建
-            cache_dir = os.path.dirname(cache_path)
-            os.makedirs(cache_dir, exist_ok=True)
-            
-            return None
+            record_cache_lookup(1 if cache_path else 0, 0 if cache_path else 1)
+            return cache_path
             
         except Exception as e:
             logger.error(f"检查缓存失败: {e}")
             return None
 
-    def save_to_cache(self, image_array, original_url):
-        """将处理后的图片保存到缓存"""
+    def check_cache_many(self, urls):
+        """批量检查缓存，返回 URL -> 缓存路径 的字典（只包含命中的URL）"""
         try:
-            # 从URL中提取文件路径
-            parsed_url = urlparse(original_url)
-            file_path = parsed_url.path
-            
-            # 处理/file/开头的路径
-            if file_path.startswith('/file/'):
-                file_path = file_path[6:]  # 去掉/file/前缀
-            
-            # URL解码和清理路径
-            file_path = unquote(file_path)
-            file_path = re.sub(r'^/', '', file_path)  # 去掉开头的斜杠
-            file_path = re.sub(r'[^\w\.\/-]', '_', file_path)  # 替换非法字符
-                        
-            # 原文件名
-            base_name = os.path.basename(file_path)
-            
-            # 获取文件扩展名
-            ext = os.path.splitext(file_path)[1].lower()
-            
+            found = self.card_cache.lookup_many(urls)
+            record_cache_lookup(len(found), len(set(urls)) - len(found))
+            return found
+        except Exception as e:
+            logger.error(f"批量检查缓存失败: {e}")
+            return {}
+
+    @timed("save_to_cache")
+    def save_to_cache(self, image_array, original_url, index=None):
+        """
+        将模型输出的证卡图片编码后保存到缓存，index为多卡证图片中的卡证序号
+
+        image_array 为模型输出的BGR图像（不需要先调用process_image_format），
+        直接编码为压缩后的最终文件（JPEG按compress_image的参数限制大小），只写一次磁盘。
+        多个任务同时保存同一张证卡时只编码和写入一次，其余调用等待并返回同一个缓存路径；已保存过时直接返回缓存路径。
+        """
+        return cache_flights.do((original_url, index), self._save_to_cache, image_array, original_url, index)
+
+    def _save_to_cache(self, image_array, original_url, index):
+        try:
+            # 其他任务已保存过同一张证卡（缓存键包含模型ID，内容相同）
+            cache_path = self.card_cache.lookup(original_url, index)
+            if cache_path:
+                return cache_path
+
             # 构建缓存路径
-            cache_path = os.path.join(CACHE_DIR, file_path)
+            cache_path = self.card_cache.path_for(original_url, index)
+            ext = os.path.splitext(cache_path)[1].lower()
             
             # 检查目录是否存在，不存在则创建
-            cache_dir = os.path.dirname(cache_path)
-            os.makedirs(cache_dir, exist_ok=True)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
             
-            # 处理图像格式 - 修复反色问题
-            img = process_image_format(image_array)
-            if img.shape[2] == 3:  # 确保是3通道图像
-                img = img[:, :, ::-1]  # 反转通道顺序 BGR->RGB
+            data = encode_card(image_array, ext, max_width=CARD_MAX_WIDTH)
+            with atomic_write(cache_path) as temp_path:
+                with open(temp_path, "wb") as f:
+                    f.write(data)
             
-            # 保存为正确格式
-            pil_image = Image.fromarray(img)
-            try:
-                if ext in ['.jpg', '.jpeg']:
-                    # JPEG格式 - 需要RGB模式，支持质量参数
-                    if pil_image.mode != 'RGB':
-                        pil_image = pil_image.convert('RGB')
-                    pil_image.save(cache_path, 'JPEG', quality=85)
-                    
-                elif ext == '.png':
-                    # PNG格式 - 支持透明度，不支持质量参数
-                    pil_image.save(cache_path, 'PNG')
-                    
-                elif ext in ['.bmp', '.dib']:
-                    # BMP格式
-                    pil_image.save(cache_path, 'BMP')
-                    
-                elif ext in ['.tif', '.tiff']:
-                    # TIFF格式
-                    pil_image.save(cache_path, 'TIFF')
-                    
-                elif ext == '.webp':
-                    # WebP格式 - 支持质量参数
-                    if pil_image.mode != 'RGB':
-                        pil_image = pil_image.convert('RGB')
-                    pil_image.save(cache_path, 'WEBP', quality=85)
-                    
-                else:
-                    # 其他格式，尝试使用默认保存
-                    pil_image.save(cache_path)
+            # 非JPEG格式仍使用原有的压缩方式（pngquant等外部工具）
+            if ext not in ('.jpg', '.jpeg'):
+                compress_image(cache_path)
             
-                logger.info(f"图片已保存到缓存: {cache_path}")
-                return cache_path
-            
-            except Exception as e:
-                print(f"保存图片时出错: {str(e)}")
-                return False
+            # 记录到缓存索引（超出容量时淘汰旧文件）
+            self.card_cache.put(original_url, cache_path, index)
+            logger.info(f"图片已保存到缓存: {cache_path} ({len(data) / 1024:.1f}KB)")
+            return cache_path
             
         except Exception as e:
             logger.error(f"保存到缓存失败: {e}")
             return None
 
+    def refresh_cache(self, cache_path):
+        """缓存文件被压缩改写后更新缓存索引"""
+        try:
+            self.card_cache.refresh(cache_path)
+        except Exception as e:
+            logger.error(f"更新缓存索引失败: {e}")
+
+    def save_result(self, url, result):
+        """保存完整的检测结果，之后的选择和PDF生成直接读取，不再重复推理"""
+        try:
+            self.result_store.save_result(url, result)
+        except Exception as e:
+            logger.error(f"保存检测结果失败: {url} - {e}")
+
+    def check_results_many(self, urls):
+        """批量查询已保存的检测结果，返回 URL -> 卡证数量 的字典"""
+        try:
+            return self.result_store.lookup_many(urls)
+        except Exception as e:
+            logger.error(f"批量查询检测结果失败: {e}")
+            return {}
+
+    def load_result(self, url, indices=None):
+        """读取已保存的检测结果，不存在时返回None"""
+        try:
+            return self.result_store.load_result(url, indices)
+        except Exception as e:
+            logger.error(f"读取检测结果失败: {url} - {e}")
+            return None
+
     def save_selection(self, url, card_type, selected_indices):
         """保存用户选择"""
-        key = f"{url}_{card_type}"
-        self.selection_cache[key] = selected_indices
-        logger.info(f"保存选择: {key} -> {selected_indices}")
+        self.result_store.save_selection(url, card_type, selected_indices)
+        logger.info(f"保存选择: {url}_{card_type} -> {selected_indices}")
+
+    def get_saved_selection(self, url, card_type):
+        """获取用户保存过的选择，没有保存过时返回None"""
+        return self.result_store.get_selection(url, card_type)
 
     def get_selection(self, url, card_type):
         """获取用户选择"""
-        key = f"{url}_{card_type}"
-        return self.selection_cache.get(key, [0])  # 默认选择第一张
-
-    def set_selection_data(self, data):
-        """设置当前需要选择的数据"""
-        self.current_selection_data = data
-
-    def get_selection_data(self):
-        """获取当前需要选择的数据"""
-        return self.current_selection_data
-
-    def add_processed_image(self, image_path, card_type, row_index, name=None):
-        """添加处理后的图片"""
-        self.processed_images.append(image_path)
-        self.image_info_list.append({
-            "path": image_path,
-            "type": card_type,
-            "row_index": row_index
-        })
-        if name:
-            self.names_list.append(name)
-
-    def get_processed_data(self):
-        """获取所有处理后的数据"""
-        return self.processed_images, self.image_info_list, self.names_list
-
-    def clear_processed_data(self):
-        """清空处理数据"""
-        self.processed_images = []
-        self.image_info_list = []
-        self.names_list = []
-        
+        selected_indices = self.get_saved_selection(url, card_type)
+        return selected_indices if selected_indices is not None else [0]  # 默认选择第一张
+
     def init_timestamp_dir(self):
         """初始化时间戳目录"""
         if self.timestamp_dir is None:
@@ -206,5 +299,63 @@ class CardProcessor:
             logger.info(f"创建时间戳目录: {self.timestamp_dir}")
         return self.timestamp_dir
 
+def _state_snapshot(value):
+    """pipeline属性的浅层快照：对象本身，以及字典、列表和普通对象中的各元素（用于发现原地修改）"""
+    if isinstance(value, dict):
+        contents = [item for pair in value.items() for item in pair]
+    elif isinstance(value, (list, tuple, set)):
+        contents = list(value)
+    elif hasattr(value, "__dict__") and not callable(value):
+        contents = [item for pair in vars(value).items() for item in pair]
+    else:
+        contents = []
+    return value, contents
+
+def _state_changed(snapshot, value):
+    """属性被替换或原地修改过（按对象标识比较）"""
+    old_value, old_contents = snapshot
+    _, contents = _state_snapshot(value)
+    return (old_value is not value or len(old_contents) != len(contents)
+            or any(a is not b for a, b in zip(old_contents, contents)))
+
+# 合并前向计算时可以逐张保存和恢复的pipeline属性类型
+_RESTORABLE_STATE = (np.ndarray, np.generic, int, float, str, bytes, type(None))
+
+def _batch_state_problem(changed, inputs, first_inputs):
+    """
+    检查一张图片的预处理结果能否与其他图片合并前向计算，可以时返回None，否则返回原因
+
+    合并时只拼接img、逐张保留meta和pipeline上的属性，其余输入沿用第一张图片的值；
+    因此逐张恢复的属性必须都是numpy数组或不可变的数值、字符串（张量、PIL图像、字典等可能被原地修改，无法可靠地恢复），
+    其余输入必须与第一张图片相同。
+    """
+    import torch
+    for key, value in changed.items():
+        if not isinstance(value, _RESTORABLE_STATE):
+            return f"预处理在pipeline上保存了 {type(value).__name__} 类型的属性 {key}"
+    if set(inputs) != set(first_inputs):
+        return "各图片的预处理输出字段不同"
+    for key, value in inputs.items():
+        if key in ("img", "meta") or value is first_inputs[key]:
+            continue
+        if isinstance(value, (torch.Tensor, np.ndarray, dict, list, tuple)) or value != first_inputs[key]:
+            return f"预处理输出的 {key} 字段逐张不同"
+    return None
+
+def _slice_batch(value, index):
+    """从批量输出中取出第index张图片对应的部分"""
+    import torch
+    if isinstance(value, torch.Tensor):
+        return value[index:index + 1]
+    if isinstance(value, dict):
+        return {k: _slice_batch(v, index) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_slice_batch(v, index) for v in value)
+    return value
+
 # 全局处理器
-processor = CardProcessor()
\ No newline at end of file
+processor = CardProcessor()
+
+metrics.gauge("card_cache_bytes",
+              lambda: processor._card_cache.total_size() if processor._card_cache is not None else 0,
+              "证卡缓存占用的磁盘空间（字节）")
\ No newline at end of file
@@ -9,4 +9,85 @@ tempfile.tempdir = TEMP_DIR
 
 # 缓存目录
 CACHE_DIR = "/home/file"
-os.makedirs(CACHE_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# 批量处理预取配置
+PREFETCH_WORKERS = 4  # 下载线程数
+PREFETCH_DEPTH = 8  # 最多提前下载的图片数量
+DOWNLOAD_TIMEOUT = 30  # 单张图片下载超时（秒）
+DOWNLOAD_CONNECT_TIMEOUT = 5  # 建立连接的超时（秒）
+DOWNLOAD_PER_HOST = 8  # 同一主机同时下载的最大数量（也是每个主机保留的连接数）
+DOWNLOAD_RETRIES = 3  # 连接错误、超时和429/5xx响应的重试次数
+DOWNLOAD_BACKOFF = 0.5  # 第一次重试前等待的秒数，之后每次加倍
+# 下载的原始图片保存目录（重新处理时发送条件请求，图片未变化时不再下载），为空时不保存
+RAW_STORE_DIR = "/home/raw_images"
+RAW_STORE_MAX_BYTES = 20 * 1024 * 1024 * 1024  # 原始图片存储容量上限（字节），0表示不限制
+
+# 批量推理配置
+INFERENCE_BATCH_SIZE = 8  # 每次前向计算的图片数量
+# 两级分辨率检测：大尺寸JPEG先缩小解码（长边不小于该值）用于检测，再按证卡需要的分辨率重新解码裁剪；
+# 不应小于检测模型的输入尺寸（768），0表示始终按原分辨率检测
+DETECTION_SIDE = 768
+CARD_MAX_WIDTH = 800  # 缓存中证卡图片的最大宽度（像素），裁剪结果不需要超过该分辨率
+
+# 多进程模型工作池配置
+MODEL_WORKERS = 1  # 工作进程数，1表示在当前进程内推理（不启用工作池）
+MODEL_WORKER_THREADS = 0  # 每个工作进程的torch线程数，0表示按CPU核心数平均分配
+
+# 模型与缓存配置
+MODEL_ID = 'iic/cv_resnet18_card_correction'
+# 推理后端: modelscope / onnx / torchscript（后两者需先导出模型），可用环境变量按部署切换
+INFERENCE_BACKEND = os.environ.get("CARD_INFERENCE_BACKEND", "modelscope")
+# 使用int8量化模型推理（仅onnx后端，需先运行 python -m inference_backends quantize）
+INFERENCE_QUANTIZED = os.environ.get("CARD_INFERENCE_QUANTIZED", "0").lower() in ("1", "true", "yes")
+EXPORTED_MODEL_DIR = os.environ.get("CARD_EXPORTED_MODEL_DIR", "/home/models/card_correction")  # 导出的ONNX/TorchScript模型目录
+QUANT_CALIBRATION_SAMPLES = 100  # int8量化时使用的校准图片数量（取自CACHE_DIR）
+CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024  # 缓存容量上限（字节），超出时淘汰最久未使用的文件，0表示不限制
+
+# 检测结果存储目录（保存全部裁剪结果和用户选择）
+RESULT_DIR = "/home/results"
+RESULT_STORE_MAX_BYTES = 5 * 1024 * 1024 * 1024  # 检测结果存储容量上限（字节），超出时淘汰最久未使用的结果，0表示不限制
+RESULT_JPEG_QUALITY = 95  # 裁剪结果以高质量JPEG保存（无损PNG体积约为其5~10倍）
+
+# PDF生成配置
+PDF_BINARY_STREAMS = True  # 图片以二进制流嵌入PDF（关闭后使用ASCII85编码，文件更大）
+
+PDF_SHARDS = 1  # 分片并行生成PDF的进程数，1表示边处理边生成单个PDF（分片合并需要安装pypdf）
+PDF_ROWS_PER_FILE = 0  # 大于0时另外按每N行输出独立的PDF文件
+PDF_PAGES_PER_PART = 50  # 边处理边生成PDF时每N页保存一个临时分段文件，最后合并（内存占用不随行数增长，需要安装pypdf），0表示不分段
+
+# 多用户任务调度配置
+MAX_CONCURRENT_JOBS = 4  # 同时运行的批量处理任务数（Gradio事件并发数）
+SCHEDULER_POLL_INTERVAL = 1.0  # 排队等待模型时刷新排队情况的间隔（秒）
+# 其他任务正在推理同一URL时等待其结果，超过该时间（秒）仍未完成则自行推理
+SINGLE_FLIGHT_TIMEOUT = 600
+
+# 任务日志配置（记录批量处理进度，重启后可恢复）
+JOB_DIR = "/home/jobs"
+
+# 运行指标配置
+METRICS_PORT = 8081  # Prometheus指标端口（/metrics），0表示不启动
+PROGRESS_TIMING_SUMMARY = False  # 批量处理结束时在进度中显示各阶段耗时汇总
+
+# 批量处理进度显示配置
+PROGRESS_UPDATES_PER_SECOND = 2  # 进度界面每秒最多刷新次数
+PROGRESS_TAIL_LINES = 20  # 进度界面显示的最近记录行数（完整记录见日志文件）
+THUMBNAIL_SIZE = 300  # 卡证选择界面缩略图的最大边长（像素）
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024  # 内存中缩略图缓存的容量上限（字节）
+
+# 数据库配置（可用环境变量按部署设置）
+DB_CONFIG = {
+    "host": os.environ.get("CARD_DB_HOST", ""),
+    "port": int(os.environ.get("CARD_DB_PORT", "3306")),
+    "database": os.environ.get("CARD_DB_NAME", ""),
+    "user": os.environ.get("CARD_DB_USER", ""),
+    "password": os.environ.get("CARD_DB_PASSWORD", ""),
+    "charset": os.environ.get("CARD_DB_CHARSET", "utf8mb4"),
+}
+DB_POOL_SIZE = 2  # 连接池保留的空闲连接数
+DB_FETCH_SIZE = 500  # 服务端游标每次读取的行数
+
+# 数据库增量同步配置（记录上次查询的水位，只查询新增和变化的行）
+DB_INCREMENTAL_SYNC = True  # 从数据库处理时使用增量同步，False表示每次执行完整查询
+DB_SYNC_PATH = os.path.join(JOB_DIR, "db_sync.sqlite")  # 查询结果快照和水位
+DB_FULL_SYNC_DAYS = 7  # 距上次完整查询超过该天数时自动完整查询一次（发现钱包账户等ID水位无法反映的变化），0表示不自动
\ No newline at end of file
@@ -0,0 +1,223 @@
+# 数据库数据源（连接池 + 服务端游标，查询结果边读取边处理）
+import csv
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+from config import DB_CONFIG, DB_POOL_SIZE, DB_FETCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 查询需要处理的数据：姓名, 正面URL, 背面URL
+_CARD_COLUMNS = """
+    zhp.household_user_name AS '户主',
+    REPLACE(CONCAT(COALESCE(zhwa.front_img_url, ''), COALESCE(zhdcu.front_img_url, '')), ' ', '') AS id_card_front,
+    REPLACE(CONCAT(COALESCE(zhwa.back_img_url, ''), COALESCE(zhdcu.back_img_url, '')), ' ', '') AS id_card_back
+"""
+_CARD_FROM = """
+FROM zy_household_project zhp
+LEFT JOIN zy_household_user zhu ON zhu.id = zhp.household_user_id
+LEFT JOIN zy_household_wallet_account zhwa ON zhwa.project_id = zhp.id
+LEFT JOIN zy_household_debit_card_upload zhdcu ON zhdcu.id = (
+    SELECT MAX(zhdcud.id)
+    FROM zy_household_debit_card_upload zhdcud
+    WHERE zhdcud.project_id = zhp.id
+)
+WHERE zhp.project_status = 2
+"""
+_CARD_ORDER = """
+ORDER BY (
+    SELECT 序号 FROM (
+        SELECT
+            ROW_NUMBER() OVER () AS '序号',
+            zhp_inner.id AS project_id
+        FROM zy_household_project zhp_inner
+        LEFT JOIN zy_household_project_design_device zhpdd_inner ON zhp_inner.id = zhpdd_inner.project_id
+        WHERE zhp_inner.project_status = 2
+          AND zhpdd_inner.material_type = '组件'
+        GROUP BY zhp_inner.id
+    ) AS order_subquery
+    WHERE order_subquery.project_id = zhp.id
+)
+"""
+CARD_QUERY_SQL = f"SELECT {_CARD_COLUMNS} {_CARD_FROM} {_CARD_ORDER}"
+
+# 增量同步用的查询：额外返回项目ID和证件上传记录ID（用于记录水位）
+SYNC_FULL_SQL = f"SELECT zhp.id AS project_id, zhdcu.id AS upload_id, {_CARD_COLUMNS} {_CARD_FROM} {_CARD_ORDER}"
+# 只查询满足condition的项目（ID超过水位的新项目、有新的证件上传记录的项目等），不需要排序子查询
+SYNC_DELTA_SQL = (f"SELECT zhp.id AS project_id, zhdcu.id AS upload_id, {_CARD_COLUMNS} {_CARD_FROM}"
+                  " AND ({condition}) ORDER BY zhp.id")
+# 当前仍需处理的项目ID（单表查询，用于删除快照中已不在结果里的项目）
+SYNC_IDS_SQL = "SELECT id FROM zy_household_project WHERE project_status = 2"
+
+def _connect_mysql():
+    """创建MySQL连接，默认使用服务端（非缓冲）游标"""
+    import pymysql
+    return pymysql.connect(cursorclass=pymysql.cursors.SSCursor, **DB_CONFIG)
+
+class ConnectionPool:
+    """
+    数据库连接池：最多保留 size 个空闲连接
+
+    取出空闲连接时先检查连接是否可用；使用过程中出错（包括中途放弃读取）的连接直接关闭，
+    不放回连接池，避免下次使用时残留未读完的结果。
+    """
+
+    def __init__(self, connect, size=DB_POOL_SIZE):
+        self._connect = connect  # 创建新连接的函数
+        self._idle = queue.LifoQueue(maxsize=max(1, size))
+
+    def _acquire(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            try:
+                # MySQL连接空闲过久会被服务器断开，使用前检查（SQLite连接没有ping）
+                ping = getattr(conn, "ping", None)
+                if ping is not None:
+                    ping(reconnect=False)
+                return conn
+            except Exception as e:
+                logger.info(f"丢弃失效的数据库连接: {e}")
+                self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """在with块内使用一个连接，正常结束后放回连接池"""
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            self._discard(conn)
+            raise
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            self._discard(conn)
+
+    def close(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+# 全局MySQL连接池（首次查询时才建立连接）
+pool = ConnectionPool(_connect_mysql)
+
+def iter_query_rows(sql=CARD_QUERY_SQL, params=None, connection_pool=None, fetch_size=DB_FETCH_SIZE):
+    """
+    逐行返回查询结果，不把整个结果集读入内存
+
+    MySQL连接使用服务端游标，每次从服务器读取fetch_size行；
+    传入SQLite等其他DB-API连接的连接池时可在本地测试（SQLite的游标本身就是逐行读取的）。
+
+    Yields:
+        tuple: 一行查询结果
+    """
+    connection_pool = connection_pool or pool
+    with connection_pool.connection() as conn:
+        cursor = conn.cursor()
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            count += len(rows)
+            yield from rows
+        cursor.close()
+        logger.info(f"查询完成，共读取 {count} 行")
+
+class StreamedRows:
+    """
+    边读取边处理的行数据
+
+    后台线程从数据源逐行读取，追加写入CSV文件（任务中断后按该文件恢复）并解析为待处理的URL；
+    处理时按行号读取，对应的行还没到达时等待。数据库游标只在读取期间占用，不受图片处理速度影响。
+    """
+
+    def __init__(self, rows, csv_path, parse_row):
+        """
+        Args:
+            rows: 行数据的迭代器，每行为 (姓名, 正面URL, 背面URL)
+            csv_path: 写入的CSV文件路径
+            parse_row: 解析函数，接收 (行数据, 行号)，返回该行需要处理的URL列表
+        """
+        self.csv_path = csv_path
+        self._source = rows
+        self._parse_row = parse_row
+        self._rows = []
+        self._finished = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def start(self):
+        """启动后台读取线程"""
+        threading.Thread(target=self._read, name="row-stream", daemon=True).start()
+        return self
+
+    def _read(self):
+        try:
+            with open(self.csv_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                for values in self._source:
+                    values = ["" if value is None else value for value in values]
+                    writer.writerow(values)
+                    f.flush()
+                    with self._cond:
+                        self._rows.append(self._parse_row(values, len(self._rows)))
+                        self._cond.notify_all()
+        except Exception as e:
+            logger.error(f"读取数据失败: {e}")
+            self._error = e
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def wait(self, index):
+        """
+        等待第index行（从0开始）到达
+
+        Returns:
+            bool: 该行是否存在（数据已全部读完且不足index+1行时返回False）
+
+        Raises:
+            RuntimeError: 读取数据失败，且已读取的行都已处理完
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: index < len(self._rows) or self._finished)
+            if index < len(self._rows):
+                return True
+            if self._error is not None:
+                raise RuntimeError(f"读取数据失败（已读取 {len(self._rows)} 行）: {self._error}")
+            return False
+
+    @property
+    def total(self):
+        """数据全部读完后的总行数，读取中返回None"""
+        with self._cond:
+            return len(self._rows) if self._finished and self._error is None else None
+
+    def __len__(self):
+        """已读取的行数"""
+        with self._cond:
+            return len(self._rows)
+
+    def __getitem__(self, index):
+        with self._cond:
+            return self._rows[index]
\ No newline at end of file
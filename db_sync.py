@@ -0,0 +1,199 @@
+# 数据库增量同步（本地保存查询结果快照和水位，之后只查询新增和变化的行）
+import os
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+from config import DB_SYNC_PATH, DB_FULL_SYNC_DAYS
+from db_source import SYNC_FULL_SQL, SYNC_DELTA_SQL, SYNC_IDS_SQL, iter_query_rows
+
+logger = logging.getLogger(__name__)
+
+def _fingerprint(rows):
+    """一个项目所有行（姓名, 正面URL, 背面URL）的指纹"""
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update("\x1f".join("" if value is None else str(value) for value in row).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+class DeltaSync:
+    """
+    数据库查询结果的本地快照
+
+    完整查询（含排序子查询）时按查询顺序保存每个项目的行，并记录项目ID和证件上传记录ID的最大值作为水位。
+    之后的增量同步先用一次单表查询取得当前需要处理的项目ID，删除快照中已不在结果里的项目，
+    再只查询ID超过水位的项目和快照中缺少的项目，按项目比较指纹后更新快照
+    （新项目排在最后，变化的项目保持原来的位置）。
+    报表按快照顺序重新生成，未变化的行直接使用缓存和已保存的检测结果，只有新增和变化的URL需要下载和推理。
+    """
+
+    def __init__(self, path=DB_SYNC_PATH, connection_pool=None):
+        self.connection_pool = connection_pool  # None表示使用全局MySQL连接池
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # 一个项目关联多个钱包账户时查询结果有多行，part为项目内的行号
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rows (
+                    project_id INTEGER NOT NULL,
+                    part INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    name TEXT,
+                    front_url TEXT,
+                    back_url TEXT,
+                    PRIMARY KEY (project_id, part)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS projects (
+                    project_id INTEGER PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _get_meta(self, key, default=None):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def needs_full_sync(self):
+        """还没有完整查询过，或距上次完整查询超过DB_FULL_SYNC_DAYS天"""
+        with self._lock:
+            full_synced_at = self._get_meta("full_synced_at")
+        if full_synced_at is None:
+            return True
+        return DB_FULL_SYNC_DAYS > 0 and time.time() - float(full_synced_at) > DB_FULL_SYNC_DAYS * 86400
+
+    def iter_rows(self, full=False):
+        """
+        同步后按报表顺序返回所有行
+
+        完整查询时边查询边返回；增量同步时先更新快照再返回。
+
+        Args:
+            full: 忽略水位执行完整查询
+
+        Yields:
+            tuple: (姓名, 正面URL, 背面URL)
+        """
+        if full or self.needs_full_sync():
+            yield from self._full_sync()
+        else:
+            self._delta_sync()
+            yield from self._snapshot_rows()
+
+    def _query(self, sql):
+        return iter_query_rows(sql, connection_pool=self.connection_pool)
+
+    def _full_sync(self):
+        """执行完整查询并重建快照，查询失败时保留原来的快照"""
+        start = time.perf_counter()
+        projects = {}  # 项目ID -> (顺序, 行列表)
+        max_project = max_upload = 0
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rows")
+            self._conn.execute("DELETE FROM projects")
+            for project_id, upload_id, name, front_url, back_url in self._query(SYNC_FULL_SQL):
+                seq, rows = projects.setdefault(project_id, (len(projects), []))
+                self._conn.execute(
+                    "INSERT INTO rows (project_id, part, seq, name, front_url, back_url) VALUES (?, ?, ?, ?, ?, ?)",
+                    (project_id, len(rows), seq, name, front_url, back_url))
+                rows.append((name, front_url, back_url))
+                max_project = max(max_project, project_id or 0)
+                max_upload = max(max_upload, upload_id or 0)
+                yield name, front_url, back_url
+
+            self._conn.executemany("INSERT INTO projects (project_id, seq, fingerprint) VALUES (?, ?, ?)",
+                                   ((project_id, seq, _fingerprint(rows))
+                                    for project_id, (seq, rows) in projects.items()))
+            now = time.time()
+            self._set_meta("project_id", max_project)
+            self._set_meta("upload_id", max_upload)
+            self._set_meta("full_synced_at", now)
+            self._set_meta("synced_at", now)
+        logger.info(f"完整查询完成：{len(projects)} 个项目，耗时 {time.perf_counter() - start:.1f} 秒")
+
+    def _delta_sync(self):
+        """
+        增量同步：更新快照中新增、变化和已删除的项目
+
+        Returns:
+            dict: added、changed、removed（项目数量）
+        """
+        start = time.perf_counter()
+        with self._lock:
+            max_project = int(self._get_meta("project_id", 0))
+            max_upload = int(self._get_meta("upload_id", 0))
+            existing = dict(self._conn.execute("SELECT project_id, fingerprint FROM projects"))
+
+        # 当前需要处理的项目ID，快照中缺少的（ID在水位以下，但之前不在结果中）一起查询
+        live_ids = {project_id for project_id, in self._query(SYNC_IDS_SQL)}
+        missing = sorted(project_id for project_id in live_ids if project_id not in existing and project_id <= max_project)
+        condition = f"zhp.id > {max_project:d} OR zhdcu.id > {max_upload:d}"
+        if missing:
+            condition += f" OR zhp.id IN ({','.join(str(int(i)) for i in missing)})"
+        sql = SYNC_DELTA_SQL.format(condition=condition)
+
+        delta = {}  # 项目ID -> 行列表
+        for project_id, upload_id, name, front_url, back_url in self._query(sql):
+            delta.setdefault(project_id, []).append((name, front_url, back_url))
+            max_project = max(max_project, project_id or 0)
+            max_upload = max(max_upload, upload_id or 0)
+
+        added = changed = 0
+        removed = [project_id for project_id in existing if project_id not in live_ids]
+        with self._lock, self._conn:
+            next_seq = (self._conn.execute("SELECT MAX(seq) FROM projects").fetchone()[0] or 0) + 1
+            for project_id, rows in delta.items():
+                fingerprint = _fingerprint(rows)
+                if existing.get(project_id) == fingerprint:
+                    continue
+                if project_id in existing:
+                    # 变化的项目保持原来的位置
+                    seq = self._conn.execute("SELECT seq FROM projects WHERE project_id = ?", (project_id,)).fetchone()[0]
+                    self._conn.execute("DELETE FROM rows WHERE project_id = ?", (project_id,))
+                    changed += 1
+                else:
+                    seq = next_seq
+                    next_seq += 1
+                    added += 1
+                self._conn.executemany(
+                    "INSERT INTO rows (project_id, part, seq, name, front_url, back_url) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((project_id, part, seq, *row) for part, row in enumerate(rows)))
+                self._conn.execute("INSERT OR REPLACE INTO projects (project_id, seq, fingerprint) VALUES (?, ?, ?)",
+                                   (project_id, seq, fingerprint))
+            self._conn.executemany("DELETE FROM rows WHERE project_id = ?", ((i,) for i in removed))
+            self._conn.executemany("DELETE FROM projects WHERE project_id = ?", ((i,) for i in removed))
+            self._set_meta("project_id", max_project)
+            self._set_meta("upload_id", max_upload)
+            self._set_meta("synced_at", time.time())
+
+        logger.info(f"增量同步完成：新增 {added} 个项目，变化 {changed} 个，删除 {len(removed)} 个，"
+                    f"查询 {len(delta)} 个项目，耗时 {time.perf_counter() - start:.1f} 秒")
+        return {"added": added, "changed": changed, "removed": len(removed)}
+
+    def _snapshot_rows(self):
+        """按报表顺序读取快照中的所有行"""
+        with self._lock:
+            return self._conn.execute("SELECT name, front_url, back_url FROM rows ORDER BY seq, part").fetchall()
+
+_delta_sync = None
+_delta_sync_lock = threading.Lock()
+
+def get_delta_sync():
+    """全局增量同步实例（首次使用时打开快照）"""
+    global _delta_sync
+    with _delta_sync_lock:
+        if _delta_sync is None:
+            _delta_sync = DeltaSync()
+        return _delta_sync
\ No newline at end of file
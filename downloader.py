@@ -0,0 +1,160 @@
+# 图片下载（连接复用、按主机限制并发、超时重试、条件请求，原始数据保存到本地）
+import time
+import random
+import logging
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import DOWNLOAD_TIMEOUT, DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_PER_HOST, DOWNLOAD_RETRIES, DOWNLOAD_BACKOFF
+from config import RAW_STORE_DIR, RAW_STORE_MAX_BYTES
+from metrics import metrics
+from raw_store import RawImageStore
+
+logger = logging.getLogger(__name__)
+
+# 这些状态码表示服务器暂时无法处理，可以重试；其他错误状态码直接失败
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# 重试前最多等待的秒数（包括服务器Retry-After要求的时间）
+_MAX_RETRY_DELAY = 30
+_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+def _retry_after(response):
+    """响应头Retry-After中的等待秒数（只支持秒数格式），没有时返回None"""
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+def _record(result):
+    metrics.inc("card_download_requests_total", 1, "图片下载次数（按结果）", result=result)
+
+class Downloader:
+    """
+    图片下载器
+
+    所有下载共用一个连接池（HTTP keep-alive），同一主机同时下载的数量不超过per_host；
+    连接错误、超时和429/5xx响应按指数退避重试。下载的原始数据保存到RawImageStore，
+    再次下载同一URL时发送If-None-Match/If-Modified-Since条件请求，未变化时不再传输图片。
+    """
+
+    def __init__(self, store_dir=RAW_STORE_DIR, max_bytes=RAW_STORE_MAX_BYTES, per_host=DOWNLOAD_PER_HOST,
+                 retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, connect_timeout=DOWNLOAD_CONNECT_TIMEOUT):
+        self.store_dir = store_dir  # 为空时不保存原始数据
+        self.max_bytes = max_bytes
+        self.per_host = max(1, per_host)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.connect_timeout = connect_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._store = None
+        self._lock = threading.Lock()
+        self._host_slots = {}  # 主机 -> 限制并发数的信号量
+
+    @property
+    def store(self):
+        """原始图片存储，在首次访问时打开；未配置存储目录时为None"""
+        if self._store is None and self.store_dir:
+            with self._lock:
+                if self._store is None:
+                    self._store = RawImageStore(self.store_dir, self.max_bytes)
+        return self._store
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+        return slot
+
+    def fetch(self, url, timeout=DOWNLOAD_TIMEOUT):
+        """
+        下载图片的原始数据
+
+        Args:
+            url: 图片URL（非HTTP地址如file://直接读取，不经过连接池和原始图片存储）
+            timeout: 读取超时（秒）
+
+        Returns:
+            bytes: 图片数据
+
+        Raises:
+            requests.RequestException: 重试后仍下载失败，且没有之前保存的数据
+        """
+        if urlparse(url).scheme not in ("http", "https"):
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                return response.read()
+
+        store = self.store
+        stored = store.get(url) if store is not None else None
+        headers = {}
+        if stored is not None:
+            data, etag, last_modified = stored
+            if not etag and not last_modified:
+                # 服务器没有提供校验信息，同一URL视为同一张图片
+                _record("stored")
+                return data
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = min(_MAX_RETRY_DELAY, retry_delay)
+                logger.info(f"下载失败，{delay:.1f} 秒后第 {attempt} 次重试: {url} - {error}")
+                metrics.inc("card_download_retries_total", 1, "图片下载重试次数")
+                time.sleep(delay)
+
+            retry_delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            try:
+                with self._host_slot(url):
+                    response = self.session.get(url, headers=headers, timeout=(self.connect_timeout, timeout))
+            except _RETRY_ERRORS as e:
+                error = e
+                continue
+
+            if response.status_code == 304 and stored is not None:
+                store.touch(url)
+                _record("not_modified")
+                return stored[0]
+            if response.status_code in RETRY_STATUS:
+                error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+                retry_delay = _retry_after(response) or retry_delay
+                continue
+            if response.status_code >= 400:
+                _record("error")
+                response.raise_for_status()
+
+            data = response.content
+            if store is not None:
+                try:
+                    store.put(url, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                except Exception as e:
+                    logger.error(f"保存原始图片失败: {url} - {e}")
+            _record("downloaded")
+            return data
+
+        if stored is not None:
+            logger.warning(f"下载失败，使用之前保存的数据: {url} - {error}")
+            _record("stored")
+            return stored[0]
+        _record("error")
+        raise error
+
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+
+# 全局下载器
+downloader = Downloader()
\ No newline at end of file
@@ -5,8 +5,10 @@ import tempfile
 import os
 
 from card_processor import processor
+from config import MAX_CONCURRENT_JOBS
 from single_image_processing import process_single_image
-from batch_processing import process_batch_images, handle_card_selection, generate_final_pdf, query_database_to_csv
+from batch_processing import (process_batch_images, handle_card_selection, generate_final_pdf, process_database_batch,
+                              list_resumable_jobs, resume_batch_job)
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +25,7 @@ def create_interface():
         
         # 隐藏的状态变量
         current_selection_index = gr.State(0)
-        db_csv_path = gr.State(None)  # 存储数据库查询生成的CSV文件路径
+        batch_job = gr.State(None)  # 当前用户的批量处理任务（每个会话独立）
         
         with gr.Tabs():
             # 单张处理
@@ -64,15 +66,6 @@ def create_interface():
                     with gr.Column(scale=1):
                         gr.Markdown("### 上传CSV或从数据库获取")
                         
-                        # 数据库查询部分
-                        with gr.Row():
-                            db_query_btn = gr.Button("从数据库获取数据", variant="secondary")
-                            db_status = gr.Textbox(
-                                label="数据库状态",
-                                value="点击按钮从数据库获取数据",
-                                interactive=False
-                            )
-                        
                         csv_input = gr.File(
                             label="CSV文件",
                             file_types=[".csv"]
@@ -81,7 +74,23 @@ def create_interface():
                             label="PDF文件名",
                             value="cards_output.pdf"
                         )
-                        batch_btn = gr.Button("批量处理", variant="primary")
+                        with gr.Row():
+                            batch_btn = gr.Button("批量处理", variant="primary")
+                            # 从数据库逐行读取，第一行到达后立即开始处理
+                            db_query_btn = gr.Button("从数据库获取并处理", variant="secondary")
+                        db_full_sync = gr.Checkbox(
+                            label="完整查询数据库（默认只查询上次之后新增和变化的数据）",
+                            value=False
+                        )
+                        
+                        # 恢复中断的任务
+                        with gr.Row():
+                            resume_job_select = gr.Dropdown(
+                                choices=list_resumable_jobs(),
+                                label="未完成的任务",
+                                interactive=True
+                            )
+                            resume_btn = gr.Button("恢复任务", variant="secondary")
                     
                     with gr.Column(scale=1):
                         gr.Markdown("### 处理进度")
@@ -93,6 +102,10 @@ def create_interface():
                             label="下载PDF",
                             file_count="single"
                         )
+                        batch_log = gr.File(
+                            label="下载处理日志",
+                            file_count="single"
+                        )
                 
                 # 卡证选择界面（初始隐藏）
                 with gr.Row(visible=False) as selection_row:
@@ -120,57 +133,70 @@ def create_interface():
                 gr.Markdown("""
                 **单张处理：** 上传图片，自动检测并提取所有证卡  
                 **批量处理：** CSV格式：姓名,正面URL,背面URL  
-                **数据库获取：** 直接从MySQL数据库获取需要处理的数据  
+                **数据库获取：** 直接从MySQL数据库逐行读取需要处理的数据，边读取边处理；默认只查询上次之后新增和变化的数据，其余行使用已处理的结果  
                 **注意：** 
                 - 处理过程中请勿关闭页面
                 - 如果一张图片中包含多张卡证，系统会提示您选择要使用的卡证
                 - 您的选择会被缓存，下次处理相同URL时会自动使用之前的选择
                 - PDF输出将在每张图片下方显示序号和姓名
+                - 处理过程中断（如容器重启）后，可在“未完成的任务”中选择任务并点击“恢复任务”，已完成的行不会重新处理
+                - 多人同时处理时模型按任务轮流分配，排队情况会显示在处理进度中
+                - 处理进度只显示汇总和最近的记录，完整记录可在处理结束后通过“下载处理日志”获取
                 """)
         
         # 事件绑定
         process_btn.click(
             fn=process_single_image,
             inputs=[image_input, format_select],
-            outputs=[progress_output, gallery, pdf_output]
+            outputs=[progress_output, gallery, pdf_output],
+            concurrency_limit=MAX_CONCURRENT_JOBS
         )
         
         batch_btn.click(
             fn=process_batch_images,
-            inputs=[csv_input, pdf_name],
-            outputs=[batch_progress, pdf_output, selection_row, selection_gallery, selection_checkbox, selection_info]
+            inputs=[csv_input, pdf_name, batch_job],
+            outputs=[batch_progress, pdf_output, batch_log, selection_row, selection_gallery, selection_checkbox, selection_info, batch_job],
+            concurrency_limit=MAX_CONCURRENT_JOBS  # 多个用户可同时批量处理，模型推理由调度器公平分配
+        )
+        
+        # 恢复任务事件：从任务日志中第一个未完成的行继续
+        resume_btn.click(
+            fn=resume_batch_job,
+            inputs=[resume_job_select, batch_job],
+            outputs=[batch_progress, pdf_output, batch_log, selection_row, selection_gallery, selection_checkbox, selection_info, batch_job],
+            concurrency_limit=MAX_CONCURRENT_JOBS
+        )
+        
+        # 打开页面时刷新未完成的任务列表
+        def refresh_resumable_jobs():
+            return gr.update(choices=list_resumable_jobs())
+        
+        demo.load(
+            fn=refresh_resumable_jobs,
+            outputs=resume_job_select
         )
         
         # 选择确认事件
         confirm_selection_btn.click(
             fn=handle_card_selection,
-            inputs=[selection_checkbox, current_selection_index],
+            inputs=[selection_checkbox, current_selection_index, batch_job],
             outputs=[selection_gallery, selection_checkbox, selection_info, generate_pdf_row, current_selection_index]
         )
         
         # 生成PDF事件
         generate_pdf_btn.click(
             fn=generate_final_pdf,
-            inputs=[pdf_name],
-            outputs=[batch_progress, pdf_output]
+            inputs=[pdf_name, batch_job],
+            outputs=[batch_progress, pdf_output, batch_log],
+            concurrency_limit=MAX_CONCURRENT_JOBS
         )
         
-        # 添加数据库查询事件
+        # 数据库批量处理事件：边读取边处理，进度和选择界面与CSV批量处理相同
         db_query_btn.click(
-            fn=query_database_to_csv,
-            outputs=[db_csv_path, db_status]
-        )
-        
-        # 当数据库查询完成后，更新CSV文件输入
-        def update_csv_input(csv_path):
-            if csv_path and os.path.exists(csv_path):
-                return gr.update(value=csv_path)
-            return gr.update()
-        
-        db_csv_path.change(
-            fn=update_csv_input,
-            inputs=db_csv_path,
-            outputs=csv_input
+            fn=process_database_batch,
+            inputs=[pdf_name, db_full_sync, batch_job],
+            outputs=[batch_progress, pdf_output, batch_log, selection_row, selection_gallery, selection_checkbox, selection_info, batch_job],
+            concurrency_limit=MAX_CONCURRENT_JOBS
         )
     
     return demo
\ No newline at end of file
@@ -0,0 +1,138 @@
+# 图片下载与预取
+import io
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config import DOWNLOAD_TIMEOUT, DETECTION_SIDE
+from downloader import downloader
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# JPEG按比例缩小解码（在DCT阶段直接缩小，比完整解码后再缩放快得多），按缩小比例从大到小尝试
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+class EncodedImage:
+    """
+    缩小解码的大图：检测在缩小的图像上进行，裁剪校正时再按需要的分辨率重新解码
+
+    只保存压缩数据和缩小后的图像，更高分辨率的图像仅在检测到证卡时临时解码，
+    传给工作进程时也只需传输这两部分。
+    """
+
+    def __init__(self, data, image, factor, source=None):
+        self.data = data  # 原始的压缩图片数据
+        self.image = image  # 检测用的缩小图像（BGR）
+        self.factor = factor  # 缩小比例（1/2/4/8）
+        self.source = source  # 图片来源（用于日志）
+
+    def decode(self, factor=1):
+        """按1/factor的比例重新解码，factor为1时解码原图"""
+        if factor == 1:
+            return decode_image(self.data, self.source)
+        image = cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), dict(_REDUCED_DECODE_FLAGS)[factor])
+        if image is None:
+            raise ValueError(f"无法解码图片: {self.source}")
+        return image
+
+def fetch_image_data(url, timeout=DOWNLOAD_TIMEOUT):
+    """下载图片的原始数据（连接复用、失败重试，未变化的图片使用本地保存的数据）"""
+    return downloader.fetch(url, timeout)
+
+def decode_image(data, source=None):
+    """把压缩图片数据解码为BGR格式的numpy数组"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"无法解码图片: {source}")
+    return image
+
+@timed("download")
+def download_image(url, timeout=DOWNLOAD_TIMEOUT):
+    """下载图片并解码为BGR格式的numpy数组"""
+    return decode_image(fetch_image_data(url, timeout), url)
+
+def _reduce_factor(data, detection_side):
+    """JPEG图片可缩小解码的最大比例（缩小后长边不小于detection_side），其他格式返回1"""
+    if detection_side <= 0 or not data.startswith(b"\xff\xd8"):
+        return 1
+    try:
+        # 只读取文件头中的尺寸，不解码像素
+        with Image.open(io.BytesIO(data)) as img:
+            long_side = max(img.size)
+    except Exception:
+        return 1
+    for factor, _ in _REDUCED_DECODE_FLAGS:
+        if long_side // factor >= detection_side:
+            return factor
+    return 1
+
+def decode_for_detection(data, source=None, detection_side=DETECTION_SIDE):
+    """
+    解码用于检测的图片：大尺寸JPEG按1/2、1/4或1/8缩小解码，其余图片按原分辨率解码
+
+    Args:
+        data: 压缩图片数据
+        source: 图片来源（用于日志）
+        detection_side: 缩小后图片长边的最小像素数（不应小于检测模型的输入尺寸），0表示不缩小
+
+    Returns:
+        EncodedImage（缩小解码时）或BGR格式的numpy数组
+    """
+    factor = _reduce_factor(data, detection_side)
+    if factor == 1:
+        return decode_image(data, source)
+
+    image = EncodedImage(data, None, factor, source)
+    image.image = image.decode(factor)
+    return image
+
+@timed("download")
+def load_for_detection(url, timeout=DOWNLOAD_TIMEOUT):
+    """下载图片并解码为检测用的图像（见decode_for_detection）"""
+    return decode_for_detection(fetch_image_data(url, timeout), url)
+
+def prefetch_ordered(items, loader, workers=4, depth=8):
+    """
+    使用线程池提前加载后续的数据，并按输入顺序逐个返回
+
+    Args:
+        items: 待加载的数据（可迭代对象）
+        loader: 加载函数，接收单个数据，返回加载结果
+        workers: 下载线程数
+        depth: 最多提前加载的数量（有界队列长度）
+
+    Yields:
+        (item, result): 原始数据和加载结果，顺序与输入一致
+    """
+    depth = max(1, depth)
+    pending = deque()
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prefetch") as executor:
+        try:
+            # 先填满预取队列
+            for item in items:
+                pending.append((item, executor.submit(loader, item)))
+                if len(pending) >= depth:
+                    break
+
+            while pending:
+                item, future = pending.popleft()
+                # 取出一个后立即补充一个，保持队列中始终有depth个任务在加载
+                for next_item in items:
+                    pending.append((next_item, executor.submit(loader, next_item)))
+                    break
+                yield item, future.result()
+        finally:
+            # 提前退出时取消尚未开始的任务
+            for _, future in pending:
+                future.cancel()
\ No newline at end of file
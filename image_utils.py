@@ -1,15 +1,41 @@
 # 图像处理工具函数
-import tempfile
 import logging
 from PIL import Image
 import cv2
 import numpy as np
+import io
 import os
-import shutil
+import math
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timed
 
 logger = logging.getLogger(__name__)
 
-def compress_image(input_path, output_path=None, max_width=800, quality=85, max_size_kb=20):
+@contextmanager
+def atomic_write(path):
+    """
+    原子地写入文件：with块内向返回的临时文件路径写入，正常结束后替换为path
+
+    临时文件与path在同一目录，文件名包含进程和线程ID，多个线程同时写同一个文件时互不覆盖；
+    读取方只会看到替换前或替换后的完整文件。出错时删除临时文件。
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+@timed("compress_image")
+def compress_image(input_path, output_path=None, max_width=800, quality=85, max_size_kb=20, allow_downscale=False):
     """
     压缩单张图片，支持调整尺寸和文件大小限制
     
@@ -19,6 +45,7 @@ def compress_image(input_path, output_path=None, max_width=800, quality=85, max_
         max_width: 最大宽度（像素）
         quality: 初始压缩质量（1-100）
         max_size_kb: 文件大小上限（KB，仅对JPEG有效）
+        allow_downscale: 最低质量仍超出大小上限时是否继续缩小尺寸（仅对JPEG有效）
     
     Returns:
         bool: 是否成功压缩
@@ -45,31 +72,33 @@ def compress_image(input_path, output_path=None, max_width=800, quality=85, max_
                 if format == 'PNG':
                     # PNG格式处理 - 使用外部工具或PIL
                     try:                    
-                        # 尝试使用pngquant压缩
-                        subprocess.run([
-                            "pngquant",
-                            "--force",
-                            "--speed", "1",
-                            "--quality", f"{max(10, 100 - quality)}-100",
-                            "--output", output_path,
-                            "--",
-                            output_path
-                        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        
-                        # 使用optipng进一步优化
-                        subprocess.run([
-                            "optipng",
-                            "-o5",
-                            "-quiet",
-                            "-clobber",
-                            output_path
-                        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        # 尝试使用pngquant压缩（写入临时文件后替换）
+                        with atomic_write(output_path) as temp_output:
+                            subprocess.run([
+                                "pngquant",
+                                "--force",
+                                "--speed", "1",
+                                "--quality", f"{max(10, 100 - quality)}-100",
+                                "--output", temp_output,
+                                "--",
+                                output_path
+                            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                            
+                            # 使用optipng进一步优化
+                            subprocess.run([
+                                "optipng",
+                                "-o5",
+                                "-quiet",
+                                "-clobber",
+                                temp_output
+                            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                         
                         logger.info(f"PNG工具压缩: {input_path} -> {output_path}")
                         
                     except (subprocess.CalledProcessError, FileNotFoundError):
                         # 备用方案：使用PIL压缩
-                        img.save(output_path, 'PNG', optimize=True)
+                        with atomic_write(output_path) as temp_output:
+                            img.save(temp_output, 'PNG', optimize=True)
                         logger.info(f"PNG PIL压缩: {input_path} -> {output_path}")
                 
                 else:
@@ -77,29 +106,14 @@ def compress_image(input_path, output_path=None, max_width=800, quality=85, max_
                     if img.mode != 'RGB':
                         img = img.convert('RGB')
                     
-                    current_quality = quality
-                    temp_output = output_path + ".tmp"
-                    
-                    while current_quality >= 10:  # 最低质量设为10
-                        # 保存图片
-                        img.save(temp_output, 'JPEG', quality=current_quality, optimize=True)
-                        
-                        # 检查文件大小
-                        file_size_kb = os.path.getsize(temp_output) / 1024
-                        
-                        if file_size_kb <= max_size_kb or current_quality <= 10:
-                            # 满足要求或达到最低质量，移动文件并退出循环
-                            shutil.move(temp_output, output_path)
-                            logger.info(f"JPEG压缩(质量{current_quality}): {input_path} -> {output_path} ({file_size_kb:.1f}KB)")
-                            break
-                        
-                        # 不满足要求，降低质量继续尝试
-                        current_quality -= 5
-                        os.remove(temp_output)
-                    
-                    # 清理临时文件（如果存在）
-                    if os.path.exists(temp_output):
-                        os.remove(temp_output)
+                    # 在内存中搜索满足大小限制的最高质量，只在最后写一次文件
+                    data, used_quality, encodes = encode_jpeg_to_size(img, max_size_kb * 1024, quality,
+                                                                 allow_downscale=allow_downscale)
+                    with atomic_write(output_path) as temp_output:
+                        with open(temp_output, "wb") as f:
+                            f.write(data)
+                    logger.info(f"JPEG压缩(质量{used_quality}, 编码{encodes}次): {input_path} -> {output_path} "
+                                f"({len(data) / 1024:.1f}KB)")
                 
                 return output_path
                 
@@ -109,34 +123,156 @@ def compress_image(input_path, output_path=None, max_width=800, quality=85, max_
     else:
         return input_path
 
-def numpy_to_temp_file(image_array, suffix='.jpg'):
-    """将numpy数组保存为临时文件"""
-    try:
-        if isinstance(image_array, np.ndarray):
-            # 确保图像格式正确
-            if image_array.dtype != np.uint8:
-                if image_array.max() <= 1.0:
-                    image_array = (image_array * 255).astype(np.uint8)
-                else:
-                    image_array = image_array.astype(np.uint8)
-            
-            # BGR转RGB
-            if len(image_array.shape) == 3 and image_array.shape[2] == 3:
-                image_array = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
-            
-            # 转换为PIL图像并调整大小
-            pil_image = Image.fromarray(image_array)
-            pil_image.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            
-            # 保存为临时文件
-            temp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
-            pil_image.save(temp_file.name, "JPEG", quality=85)
-            return temp_file.name
-            
-    except Exception as e:
-        logger.error(f"转换图片为临时文件失败: {e}")
-    return None
+def _encode_jpeg_array(img, quality):
+    """使用cv2将BGR数组编码为JPEG"""
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+    if not ok:
+        raise ValueError("JPEG编码失败")
+    return buffer.tobytes()
+
+def encode_jpeg_to_size(img, max_bytes, quality=85, min_quality=10, step=5, allow_downscale=False):
+    """
+    在内存中编码JPEG，二分查找满足大小上限的最高质量
+
+    候选质量与原来逐步降低质量的方式一致（quality, quality-step, ..., min_quality），
+    但只需要 log2(候选数) 次左右的编码，且不读写磁盘。
+
+    Args:
+        img: RGB模式的PIL图像，或BGR格式的numpy数组（使用cv2编码，不需要转换颜色通道）
+        max_bytes: 文件大小上限（字节）
+        quality: 初始（最高）质量
+        min_quality: 最低质量
+        step: 质量步长
+        allow_downscale: 最低质量仍超出上限时，是否按比例缩小图片后再次查找
+
+    Returns:
+        (data, quality, encodes): 编码后的字节、使用的质量、编码次数
+    """
+    encodes = 0
+    is_array = isinstance(img, np.ndarray)
+
+    def encode(image, q):
+        nonlocal encodes
+        encodes += 1
+        if is_array:
+            return _encode_jpeg_array(image, q)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=q, optimize=True)
+        return buffer.getvalue()
+
+    def search(image):
+        # 先尝试最高质量，大多数小图片一次即可满足
+        data = encode(image, quality)
+        if len(data) <= max_bytes:
+            return data, quality
+
+        candidates = list(range(quality - step, min_quality, -step)) + [min_quality]
+        candidates = sorted(q for q in set(candidates) if min_quality <= q < quality)
+
+        best = None
+        low, high = 0, len(candidates) - 1
+        while low <= high:
+            mid = (low + high) // 2
+            data = encode(image, candidates[mid])
+            if len(data) <= max_bytes:
+                best = (data, candidates[mid])
+                low = mid + 1
+            else:
+                high = mid - 1
+
+        if best is not None:
+            return best
+        # 全部超出上限时二分查找最后一次编码的就是最低质量，与原逻辑一致使用该结果
+        return data, candidates[0] if candidates else quality
+
+    data, used_quality = search(img)
+    if len(data) > max_bytes and allow_downscale:
+        # 按面积比例估算缩放系数，留出少量余量
+        scale = math.sqrt(max_bytes / len(data)) * 0.95
+        width, height = (img.shape[1], img.shape[0]) if is_array else img.size
+        new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        logger.debug(f"最低质量仍超出大小限制，缩小到 {new_size} 后重新编码")
+        if is_array:
+            data, used_quality = search(cv2.resize(img, new_size, interpolation=cv2.INTER_AREA))
+        else:
+            data, used_quality = search(img.resize(new_size, Image.LANCZOS))
+
+    return data, used_quality, encodes
+
+# cv2可直接编码的缓存文件格式（扩展名 -> cv2编码格式）
+_CV2_FORMATS = {
+    '.jpg': '.jpg', '.jpeg': '.jpg',
+    '.png': '.png',
+    '.bmp': '.bmp', '.dib': '.bmp',
+    '.tif': '.tiff', '.tiff': '.tiff',
+    '.webp': '.webp',
+}
+
+def to_uint8(img):
+    """转换为uint8类型（已是uint8时返回原数组，不复制）"""
+    if img.dtype == np.uint8:
+        return img
+    if img.max() <= 1.0:
+        return (img * 255).astype(np.uint8)
+    return img.astype(np.uint8)
+
+@timed("encode_card")
+def encode_card(image_bgr, ext='.jpg', max_width=800, quality=85, max_size_kb=20, allow_downscale=False):
+    """
+    将模型输出的BGR证卡图像直接编码为缓存文件内容
+
+    cv2按BGR顺序编码，不需要转换颜色通道。JPEG的大小限制压缩（同compress_image）在内存中完成，
+    不再先保存原图再重新读取压缩。cv2不支持的格式转换一次为RGB后使用PIL编码。
+
+    Args:
+        image_bgr: BGR（或BGRA、灰度）格式的numpy数组
+        ext: 缓存文件扩展名
+        max_width, quality, max_size_kb, allow_downscale: JPEG压缩参数，含义同compress_image
+
+    Returns:
+        bytes: 编码后的文件内容
+    """
+    img = to_uint8(image_bgr)
+    fmt = _CV2_FORMATS.get(ext.lower())
+
+    if fmt == '.jpg':
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        data = _encode_jpeg_array(img, quality)
+        if len(data) <= max_size_kb * 1024:
+            return data
+        # 超出大小上限时先缩小到最大宽度，再查找满足大小的质量
+        if img.shape[1] > max_width:
+            new_height = int(img.shape[0] * max_width / img.shape[1])
+            img = cv2.resize(img, (max_width, new_height), interpolation=cv2.INTER_AREA)
+        data, used_quality, encodes = encode_jpeg_to_size(img, max_size_kb * 1024, quality,
+                                                          allow_downscale=allow_downscale)
+        logger.debug(f"JPEG编码(质量{used_quality}, 编码{encodes}次): {len(data) / 1024:.1f}KB")
+        return data
+
+    if fmt is not None:
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality] if fmt == '.webp' else []
+        ok, buffer = cv2.imencode(fmt, img, params)
+        if ok:
+            return buffer.tobytes()
+        logger.debug(f"cv2不支持编码 {ext}，使用PIL编码")
+
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA if img.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, Image.registered_extensions().get(ext.lower(), 'PNG'))
+    return buffer.getvalue()
+
+def compress_images(image_paths, workers=4, **kwargs):
+    """并行压缩多张图片，返回与输入顺序一致的输出路径列表（参数同compress_image）"""
+    if len(image_paths) <= 1:
+        return [compress_image(path, **kwargs) for path in image_paths]
+
+    # PIL编码时会释放GIL，使用线程即可并行
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda path: compress_image(path, **kwargs), image_paths))
 
+@timed("process_image_format")
 def process_image_format(img):
     """统一处理图像格式"""
     logger.debug(f"处理图像格式: 原始形状 {img.shape}, 类型 {img.dtype}")
@@ -0,0 +1,486 @@
+# 卡证检测校正模型的推理后端（modelscope / ONNX Runtime / TorchScript）
+"""
+modelscope后端直接使用 modelscope 的 card_detection_correction 流水线（需要完整的modelscope和torch）。
+onnx 和 torchscript 后端只运行导出的检测网络，预处理、热力图解码和透视校正用NumPy/OpenCV实现，
+与modelscope流水线的计算方式一致；onnx后端不需要安装torch和modelscope。
+
+导出模型（需要modelscope和torch，只需执行一次）:
+    python -m inference_backends export --format onnx --output /home/models/card_correction
+    python -m inference_backends export --format torchscript --output /home/models/card_correction
+
+生成int8量化模型（onnx后端，用缓存中的证卡图片校准）:
+    python -m inference_backends quantize [--calibration-dir /home/file] [--samples 100]
+"""
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import logging
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+from config import MODEL_ID, CACHE_DIR, INFERENCE_BACKEND, INFERENCE_QUANTIZED, EXPORTED_MODEL_DIR
+from config import QUANT_CALIBRATION_SAMPLES, CARD_MAX_WIDTH
+
+logger = logging.getLogger(__name__)
+
+# 与modelscope流水线一致的归一化参数（CenterNet，按BGR通道顺序）
+_MEAN = np.array([0.408, 0.447, 0.470], dtype=np.float32)
+_STD = np.array([0.289, 0.274, 0.278], dtype=np.float32)
+
+SCORE_THRESHOLD = 0.3  # 检测框置信度阈值
+OUTPUT_STRIDE = 4  # 输出特征图相对输入的缩小倍数
+
+# 导出模型的输出顺序
+HEAD_NAMES = ("hm", "wh", "reg", "cls", "ftype")
+
+ONNX_FILE_NAME = "card_correction.onnx"
+QUANTIZED_ONNX_FILE_NAME = "card_correction.int8.onnx"
+TORCHSCRIPT_FILE_NAME = "card_correction.pt"
+META_FILE_NAME = "card_correction.json"  # 输入尺寸、最大检测数等导出时的模型配置
+
+BACKENDS = ("modelscope", "onnx", "torchscript")
+
+def to_bgr(image):
+    """将URL、文件路径或numpy数组统一为BGR格式的uint8数组"""
+    if isinstance(image, str):
+        if image.startswith(("http://", "https://")):
+            from image_loader import download_image
+            return download_image(image)
+        img = cv2.imread(image, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"无法读取图片: {image}")
+        return img
+    if not isinstance(image, np.ndarray):
+        raise TypeError(f"不支持的图片类型: {type(image)}")
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return image
+
+def get_affine_transform(center, scale, output_size, inv=False):
+    """中心对齐、按最长边缩放的仿射变换（CenterNet的get_affine_transform，不旋转）"""
+    dst_w, dst_h = output_size
+    src = np.zeros((3, 2), dtype=np.float32)
+    dst = np.zeros((3, 2), dtype=np.float32)
+    src[0] = center
+    src[1] = center + np.array([0, scale * -0.5], dtype=np.float32)
+    dst[0] = [dst_w * 0.5, dst_h * 0.5]
+    dst[1] = dst[0] + np.array([0, dst_w * -0.5], dtype=np.float32)
+    # 第三个点：前两点连线逆时针旋转90度
+    for points in (src, dst):
+        direction = points[0] - points[1]
+        points[2] = points[1] + np.array([-direction[1], direction[0]], dtype=np.float32)
+
+    if inv:
+        return cv2.getAffineTransform(dst, src)
+    return cv2.getAffineTransform(src, dst)
+
+def preprocess(image_bgr, input_h, input_w):
+    """
+    缩放到模型输入尺寸并归一化
+
+    Returns:
+        (blob, center, scale): blob为(3, input_h, input_w)的float32数组
+    """
+    height, width = image_bgr.shape[:2]
+    center = np.array([width / 2., height / 2.], dtype=np.float32)
+    scale = max(height, width) * 1.0
+
+    trans_input = get_affine_transform(center, scale, (input_w, input_h))
+    inp = cv2.warpAffine(image_bgr, trans_input, (input_w, input_h), flags=cv2.INTER_LINEAR)
+    inp = (inp.astype(np.float32) / 255. - _MEAN) / _STD
+    return inp.transpose(2, 0, 1), center, scale
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def decode_heads(heads, center, scale, K, out_h, out_w):
+    """
+    将单张图片的网络输出解码为原图坐标下的四边形
+
+    与modelscope流水线的bbox_decode + bbox_post_process一致：3x3最大值抑制后取前K个中心点，
+    中心点加偏移得到四个角点，再映射回原图坐标。（modelscope对整批结果调用nms时批大小为1，
+    nms实际不生效，这里同样不做。）
+
+    Args:
+        heads: 输出名 -> (C, out_h, out_w)数组
+        center, scale: 预处理时的仿射变换参数
+        K: 最多保留的检测数
+
+    Returns:
+        list: [(polygon(4, 2), score, angle, ftype)]，按置信度从高到低排列
+    """
+    heat = _sigmoid(heads["hm"][0].astype(np.float32))
+    # 3x3最大值抑制（边界外视为负无穷，与max_pool2d的填充方式一致）
+    hmax = cv2.dilate(heat, np.ones((3, 3), np.uint8))
+    heat = np.where(hmax == heat, heat, 0)
+
+    flat = heat.ravel()
+    K = min(K, flat.size)
+    inds = np.argpartition(-flat, K - 1)[:K]
+    inds = inds[np.argsort(-flat[inds], kind="stable")]
+    scores = flat[inds]
+
+    ys = (inds // out_w).astype(np.float32)
+    xs = (inds % out_w).astype(np.float32)
+    reg = heads["reg"].reshape(2, -1)[:, inds]
+    xs = xs + reg[0]
+    ys = ys + reg[1]
+
+    wh = heads["wh"].reshape(8, -1)[:, inds]
+    corners = np.empty((K, 4, 2), dtype=np.float32)
+    corners[:, :, 0] = xs[:, None] - wh[0::2].T
+    corners[:, :, 1] = ys[:, None] - wh[1::2].T
+
+    angles = heads["cls"].reshape(heads["cls"].shape[0], -1)[:, inds].argmax(axis=0)
+    ftypes = heads["ftype"].reshape(heads["ftype"].shape[0], -1)[:, inds].argmax(axis=0)
+
+    # 输出特征图坐标映射回原图
+    trans = get_affine_transform(center, scale, (out_w, out_h), inv=True)
+    corners = (corners.astype(np.float64) @ trans[:, :2].T + trans[:, 2]).astype(np.float32)
+
+    return [(corners[i], float(scores[i]), int(angles[i]), int(ftypes[i])) for i in range(K)]
+
+def card_size(polygon):
+    """四边形校正后的宽和高"""
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = polygon
+    img_width = math.hypot((x0 + x3) / 2 - (x1 + x2) / 2, (y0 + y3) / 2 - (y1 + y2) / 2)
+    img_height = math.hypot((x0 + x1) / 2 - (x2 + x3) / 2, (y0 + y1) / 2 - (y2 + y3) / 2)
+    return img_width, img_height
+
+def crop_card(image_bgr, polygon):
+    """按四边形透视校正裁剪证卡（与modelscope流水线的crop_image一致）"""
+    img_width, img_height = card_size(polygon)
+    target = np.float32([[0, 0], [img_width, 0], [img_width, img_height], [0, img_height]])
+    transform = cv2.getPerspectiveTransform(np.float32(polygon), target)
+    return cv2.warpPerspective(image_bgr, transform, (int(img_width), int(img_height)))
+
+# 角度类别对应的旋转方式（把证卡转正）
+_ROTATIONS = {
+    1: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    2: cv2.ROTATE_180,
+    3: cv2.ROTATE_90_CLOCKWISE,
+}
+
+def postprocess(image_bgr, heads, center, scale, K, out_h, out_w):
+    """解码检测结果并裁剪校正，输出格式与modelscope流水线一致"""
+    polygons, scores, output_imgs, labels, layout = [], [], [], [], []
+    for polygon, score, angle, ftype in decode_heads(heads, center, scale, K, out_h, out_w):
+        if score <= SCORE_THRESHOLD:
+            continue
+        card = crop_card(image_bgr, polygon)
+        if angle in _ROTATIONS:
+            card = cv2.rotate(card, _ROTATIONS[angle])
+        polygons.append(polygon.reshape(8))
+        scores.append(score)
+        output_imgs.append(card)
+        labels.append(angle)
+        layout.append(ftype)
+    return {
+        "polygons": polygons,
+        "scores": scores,
+        "output_imgs": output_imgs,
+        "labels": labels,
+        "layout": np.array(layout),
+    }
+
+def recrop_cards(result, image, max_width=CARD_MAX_WIDTH):
+    """
+    把在缩小图像上得到的检测结果映射回原图坐标，并从更高分辨率的图像重新裁剪校正证卡
+
+    裁剪用图像的分辨率只需保证每张证卡转正后的宽度不小于max_width（保存时会缩小到该宽度），
+    因此按该条件选择最小的解码比例，检测用的缩小图像已足够时不再解码；max_width为0时按原图裁剪。
+
+    Args:
+        result: 在 image.image（缩小解码的图像）上的检测结果
+        image: image_loader.EncodedImage
+        max_width: 证卡图片的最大宽度
+
+    Returns:
+        dict: 多边形为原图坐标的检测结果
+    """
+    if not result.get("output_imgs"):
+        # 未检测到证卡时无需重新解码
+        return result
+
+    polygons = [np.asarray(polygon, dtype=np.float32).reshape(4, 2) for polygon in result["polygons"]]
+    angles = result["labels"]
+    widths = []
+    for polygon, angle in zip(polygons, angles):
+        img_width, img_height = card_size(polygon)
+        widths.append((img_height if angle in (1, 3) else img_width) * image.factor)
+
+    factor = image.factor if max_width else 1
+    while factor > 1 and min(widths) / factor < max_width:
+        factor //= 2
+    source = image.image if factor == image.factor else image.decode(factor)
+
+    output_imgs, original_polygons = [], []
+    for polygon, angle in zip(polygons, angles):
+        # 缩小图像的一个像素对应原图中 image.factor x image.factor 的一块像素
+        card = crop_card(source, (polygon + 0.5) * (image.factor / factor) - 0.5)
+        if angle in _ROTATIONS:
+            card = cv2.rotate(card, _ROTATIONS[angle])
+        output_imgs.append(card)
+        original_polygons.append(((polygon + 0.5) * image.factor - 0.5).reshape(8))
+    return dict(result, polygons=original_polygons, output_imgs=output_imgs)
+
+def load_meta(model_dir):
+    """读取导出时保存的模型配置"""
+    meta_path = os.path.join(model_dir, META_FILE_NAME)
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(f"找不到导出的模型配置 {meta_path}，请先运行: python -m inference_backends export")
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+class ExportedCardDetector(ABC):
+    """
+    运行导出模型的检测器，调用方式与modelscope流水线相同（detector(image) -> 结果字典）
+
+    另外提供 process_batch，将多张图片合并为一次前向计算。子类实现 _load 和 _run。
+    """
+
+    backend = None
+    file_name = None
+
+    def __init__(self, model_dir=EXPORTED_MODEL_DIR, file_name=None):
+        self.model_dir = model_dir
+        self.model_path = os.path.join(model_dir, file_name or self.file_name)
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"找不到导出的模型 {self.model_path}，请先运行: "
+                                    f"python -m inference_backends export --format {self.backend}")
+        meta = load_meta(model_dir)
+        self.input_h = meta["input_h"]
+        self.input_w = meta["input_w"]
+        self.K = meta["K"]
+        self._load()
+
+    @abstractmethod
+    def _load(self):
+        """加载模型文件 self.model_path"""
+
+    @abstractmethod
+    def _run(self, batch):
+        """执行一次前向计算，返回 输出名 -> (N, C, H, W) 数组"""
+
+    def __call__(self, image):
+        return self.process_batch([image])[0]
+
+    def process_batch(self, images):
+        """批量推理，返回与输入顺序一致的结果列表"""
+        prepared = []
+        for image in images:
+            image_bgr = to_bgr(image)
+            blob, center, scale = preprocess(image_bgr, self.input_h, self.input_w)
+            prepared.append((image_bgr, blob, center, scale))
+
+        outputs = self._run(np.stack([blob for _, blob, _, _ in prepared]))
+        out_h, out_w = self.input_h // OUTPUT_STRIDE, self.input_w // OUTPUT_STRIDE
+        return [postprocess(image_bgr, {name: value[j] for name, value in outputs.items()},
+                            center, scale, self.K, out_h, out_w)
+                for j, (image_bgr, _, center, scale) in enumerate(prepared)]
+
+class OnnxCardDetector(ExportedCardDetector):
+    """ONNX Runtime后端（CPU），quantized为True时使用int8量化模型"""
+
+    backend = "onnx"
+    file_name = ONNX_FILE_NAME
+
+    def __init__(self, model_dir=EXPORTED_MODEL_DIR, quantized=False):
+        self.quantized = quantized
+        if quantized and not os.path.exists(os.path.join(model_dir, QUANTIZED_ONNX_FILE_NAME)):
+            raise FileNotFoundError(f"找不到int8量化模型 {os.path.join(model_dir, QUANTIZED_ONNX_FILE_NAME)}，"
+                                    f"请先运行: python -m inference_backends quantize")
+        super().__init__(model_dir, QUANTIZED_ONNX_FILE_NAME if quantized else None)
+
+    def _load(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 工作进程会设置OMP_NUM_THREADS，按该值限制线程数，避免多个进程抢占CPU核心
+        threads = int(os.environ.get("OMP_NUM_THREADS", "0") or 0)
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def _run(self, batch):
+        outputs = self.session.run(self.output_names, {self.input_name: batch})
+        return dict(zip(self.output_names, outputs))
+
+class TorchScriptCardDetector(ExportedCardDetector):
+    """TorchScript后端（CPU，不需要modelscope）"""
+
+    backend = "torchscript"
+    file_name = TORCHSCRIPT_FILE_NAME
+
+    def _load(self):
+        import torch
+
+        self._torch = torch
+        self.module = torch.jit.load(self.model_path, map_location="cpu").eval()
+
+    def _run(self, batch):
+        torch = self._torch
+        with torch.inference_mode():
+            outputs = self.module(torch.from_numpy(batch))
+        return {name: value.numpy() for name, value in zip(HEAD_NAMES, outputs)}
+
+def create_backend(name=INFERENCE_BACKEND, model_dir=EXPORTED_MODEL_DIR, quantized=INFERENCE_QUANTIZED):
+    """按名称创建推理后端，quantized只对onnx后端有效"""
+    if quantized and name != "onnx":
+        logger.warning(f"int8量化推理只支持onnx后端，{name} 后端使用fp32推理")
+    if name == "modelscope":
+        from modelscope.pipelines import pipeline
+        from modelscope.utils.constant import Tasks
+        return pipeline(Tasks.card_detection_correction, model=MODEL_ID)
+    if name == "onnx":
+        return OnnxCardDetector(model_dir, quantized=quantized)
+    if name == "torchscript":
+        return TorchScriptCardDetector(model_dir)
+    raise ValueError(f"未知的推理后端: {name}（可选: {', '.join(BACKENDS)}）")
+
+def export_model(fmt, output_dir=EXPORTED_MODEL_DIR, opset=17):
+    """从modelscope流水线导出检测网络为ONNX或TorchScript，返回导出的文件路径"""
+    import torch
+    from modelscope.pipelines import pipeline
+    from modelscope.utils.constant import Tasks
+
+    pipe = pipeline(Tasks.card_detection_correction, model=MODEL_ID, device="cpu")
+    input_h, input_w = pipe.cfg.input_h, pipe.cfg.input_w
+
+    class HeadOutputs(torch.nn.Module):
+        """将网络输出的字典按HEAD_NAMES顺序展开为元组"""
+
+        def __init__(self, net):
+            super().__init__()
+            self.net = net
+
+        def forward(self, x):
+            outputs = self.net(x)[0]
+            return tuple(outputs[name] for name in HEAD_NAMES)
+
+    model = HeadOutputs(pipe.infer_model.eval()).eval()
+    dummy = torch.zeros(1, 3, input_h, input_w)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if fmt == "onnx":
+        path = os.path.join(output_dir, ONNX_FILE_NAME)
+        dynamic_axes = {name: {0: "batch"} for name in ("input",) + HEAD_NAMES}
+        torch.onnx.export(model, dummy, path, input_names=["input"], output_names=list(HEAD_NAMES),
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    elif fmt == "torchscript":
+        path = os.path.join(output_dir, TORCHSCRIPT_FILE_NAME)
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(model, dummy))
+        traced.save(path)
+    else:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+
+    meta = {"model_id": MODEL_ID, "input_h": input_h, "input_w": input_w, "K": pipe.cfg.K}
+    with open(os.path.join(output_dir, META_FILE_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    logger.info(f"模型已导出: {path}")
+    return path
+
+def find_calibration_images(calibration_dir=CACHE_DIR, samples=QUANT_CALIBRATION_SAMPLES, seed=0):
+    """从证卡缓存目录中随机选取校准图片（固定随机种子，每次选取结果相同）"""
+    paths = []
+    for root, _, files in os.walk(calibration_dir):
+        paths.extend(os.path.join(root, name) for name in files
+                     if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")))
+    paths.sort()
+    random.Random(seed).shuffle(paths)
+    return paths[:samples]
+
+class _CalibrationReader:
+    """按模型输入格式逐张提供校准数据（onnxruntime.quantization.CalibrationDataReader接口）"""
+
+    def __init__(self, image_paths, input_name, input_h, input_w):
+        self.input_name = input_name
+        self.input_h = input_h
+        self.input_w = input_w
+        self._paths = iter(image_paths)
+
+    def get_next(self):
+        for path in self._paths:
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if image is None:
+                logger.warning(f"无法读取校准图片，已跳过: {path}")
+                continue
+            blob, _, _ = preprocess(image, self.input_h, self.input_w)
+            return {self.input_name: blob[None]}
+        return None
+
+def quantize_model(model_dir=EXPORTED_MODEL_DIR, calibration_dir=CACHE_DIR, samples=QUANT_CALIBRATION_SAMPLES):
+    """
+    将导出的ONNX模型静态量化为int8（权重按通道量化，激活值用校准图片统计范围）
+
+    检测网络几乎全是卷积，动态量化只处理MatMul/Gemm，对它没有加速效果，因此使用静态量化。
+    校准图片取自证卡缓存（校正后的证卡，按推理时相同的方式缩放到模型输入尺寸），
+    量化后的模型保存为 QUANTIZED_ONNX_FILE_NAME，与fp32模型放在同一目录。
+
+    Returns:
+        str: 量化模型的路径
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    model_path = os.path.join(model_dir, ONNX_FILE_NAME)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"找不到导出的模型 {model_path}，请先运行: python -m inference_backends export --format onnx")
+    meta = load_meta(model_dir)
+
+    image_paths = find_calibration_images(calibration_dir, samples)
+    if not image_paths:
+        raise ValueError(f"校准目录 {calibration_dir} 中没有图片，请先处理一些证卡或指定 --calibration-dir")
+    logger.info(f"使用 {len(image_paths)} 张图片校准")
+
+    input_name = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    prepared_path = os.path.join(model_dir, "card_correction.prep.onnx")
+    output_path = os.path.join(model_dir, QUANTIZED_ONNX_FILE_NAME)
+    try:
+        # 量化前做形状推断和图优化（合并BatchNorm等），量化效果更好
+        quant_pre_process(model_path, prepared_path)
+        quantize_static(prepared_path, output_path,
+                        _CalibrationReader(image_paths, input_name, meta["input_h"], meta["input_w"]),
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+    finally:
+        if os.path.exists(prepared_path):
+            os.unlink(prepared_path)
+    logger.info(f"int8量化模型已保存: {output_path}")
+    return output_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m inference_backends", description="卡证检测模型推理后端")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="导出检测网络（需要modelscope和torch）")
+    export_parser.add_argument("--format", choices=("onnx", "torchscript"), required=True)
+    export_parser.add_argument("--output", default=EXPORTED_MODEL_DIR, help="导出目录")
+    export_parser.add_argument("--opset", type=int, default=17, help="ONNX opset版本")
+    quantize_parser = subparsers.add_parser("quantize", help="生成int8量化的ONNX模型（需要onnx和onnxruntime）")
+    quantize_parser.add_argument("--model-dir", default=EXPORTED_MODEL_DIR, help="导出的模型目录")
+    quantize_parser.add_argument("--calibration-dir", default=CACHE_DIR, help="校准图片目录（默认为证卡缓存目录）")
+    quantize_parser.add_argument("--samples", type=int, default=QUANT_CALIBRATION_SAMPLES, help="校准图片数量")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == "export":
+        print(export_model(args.format, args.output, args.opset))
+    elif args.command == "quantize":
+        print(quantize_model(args.model_dir, args.calibration_dir, args.samples))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
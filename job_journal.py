@@ -0,0 +1,162 @@
+# 批量处理任务日志（记录每行处理结果，容器重启后可从中断处继续）
+import os
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_NAME = "jobs.sqlite"
+
+# 任务状态
+JOB_RUNNING = "running"  # 正在处理（或处理过程中被中断）
+JOB_SELECTING = "selecting"  # 所有行已处理，等待用户选择卡证
+JOB_DONE = "done"  # PDF已生成
+
+# 单个URL的处理结果
+SIDE_CACHED = "cached"  # 已得到证卡图片（paths为缓存文件路径）
+SIDE_NO_CARD = "no_card"  # 未检测到证卡
+SIDE_ERROR = "error"  # 处理失败
+SIDE_PENDING = "pending"  # 检测到多张卡证，等待用户选择
+
+class JobJournal:
+    """
+    批量处理任务的持久化日志
+
+    每处理完一个URL记录一次结果，每处理完一行推进一次进度。
+    CSV文件复制一份保存在日志目录中，恢复任务时不依赖Gradio的临时上传文件。
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self._lock = threading.Lock()
+
+        os.makedirs(journal_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(journal_dir, JOURNAL_FILE_NAME),
+                                     check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # 每个URL提交一次，WAL模式下NORMAL已能保证断电后日志不损坏
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    csv_path TEXT NOT NULL,
+                    output_name TEXT NOT NULL,
+                    total_rows INTEGER NOT NULL,
+                    next_row INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sides (
+                    job_id TEXT NOT NULL,
+                    row_index INTEGER NOT NULL,
+                    card_type TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    name TEXT,
+                    status TEXT NOT NULL,
+                    paths TEXT,
+                    message TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (job_id, row_index, card_type)
+                )
+            """)
+
+    def csv_path(self, job_id):
+        """任务的CSV副本路径"""
+        return os.path.join(self.journal_dir, f"{job_id}.csv")
+
+    def start_job(self, job_id, csv_path, output_name, total_rows):
+        """登记新任务，并复制一份CSV文件（csv_path已是副本路径时不复制）"""
+        saved_csv = self.csv_path(job_id)
+        if os.path.abspath(csv_path) != os.path.abspath(saved_csv):
+            shutil.copyfile(csv_path, saved_csv)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, csv_path, output_name, total_rows, next_row, status, created, updated) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+                (job_id, saved_csv, output_name, total_rows, JOB_RUNNING, now, now))
+        return saved_csv
+
+    def record_side(self, job_id, row_index, card_type, url, name, status, paths=(), message=None):
+        """记录一个URL的处理结果（同一行同一面重复处理时覆盖之前的记录）"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sides (job_id, row_index, card_type, url, name, status, paths, message, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, row_index, card_type, url, name, status, json.dumps(list(paths)), message, time.time()))
+
+    def end_row(self, job_id, row_index):
+        """该行所有URL已处理完成，下次从下一行继续"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET next_row = ?, updated = ? WHERE job_id = ? AND next_row <= ?",
+                               (row_index + 1, time.time(), job_id, row_index))
+
+    def set_total_rows(self, job_id, total_rows):
+        """更新任务的总行数（边读取边处理的任务在数据读完后调用）"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET total_rows = ?, updated = ? WHERE job_id = ?",
+                               (total_rows, time.time(), job_id))
+
+    def set_status(self, job_id, status):
+        """更新任务状态；任务完成后删除逐行记录和CSV副本"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE job_id = ?",
+                               (status, time.time(), job_id))
+            if status == JOB_DONE:
+                self._conn.execute("DELETE FROM sides WHERE job_id = ?", (job_id,))
+        if status == JOB_DONE:
+            try:
+                os.unlink(self.csv_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def get_job(self, job_id):
+        """读取任务信息，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, csv_path, output_name, total_rows, next_row, status, created, updated "
+                "FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ("job_id", "csv_path", "output_name", "total_rows", "next_row", "status", "created", "updated")
+        return dict(zip(keys, row))
+
+    def list_unfinished(self, limit=20):
+        """未完成（可恢复）的任务，最近更新的在前"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status != ? ORDER BY updated DESC LIMIT ?",
+                (JOB_DONE, limit)).fetchall()
+        return [self.get_job(job_id) for job_id, in rows]
+
+    def load_sides(self, job_id, before_row):
+        """
+        读取已完成行的处理结果
+
+        Returns:
+            dict: 行索引 -> [记录字典]，每行的记录按处理顺序排列
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_index, card_type, url, name, status, paths, message FROM sides "
+                "WHERE job_id = ? AND row_index < ? ORDER BY row_index, rowid",
+                (job_id, before_row)).fetchall()
+        sides = {}
+        for row_index, card_type, url, name, status, paths, message in rows:
+            sides.setdefault(row_index, []).append({
+                "card_type": card_type,
+                "url": url,
+                "name": name,
+                "status": status,
+                "paths": json.loads(paths or "[]"),
+                "message": message,
+            })
+        return sides
\ No newline at end of file
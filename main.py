@@ -2,6 +2,8 @@
 import logging
 
 from card_processor import processor
+from config import METRICS_PORT
+from metrics import start_metrics_server
 from gradio_interface import create_interface
 
 # 设置日志
@@ -33,6 +35,13 @@ if __name__ == "__main__":
         print("2. 网络连接是否正常")
         print("3. 模型路径是否正确")
     
+    # 启动指标服务（Prometheus格式）
+    try:
+        if start_metrics_server(METRICS_PORT):
+            print(f"📈 运行指标: http://localhost:{METRICS_PORT}/metrics")
+    except Exception as e:
+        print(f"❌ 指标服务启动失败: {e}")
+    
     print("启动Gradio界面...")
     demo = create_interface()
     
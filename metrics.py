@@ -0,0 +1,157 @@
+# 运行指标（各处理阶段耗时、缓存命中率、处理数量），以Prometheus文本格式提供
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# 阶段耗时直方图的分桶上限（秒）
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表
+
+    计数器和直方图按 (名称, 标签) 累计，仪表盘指标在输出时通过回调函数取值。
+    所有更新只在持锁时做少量加法，可以放在热路径上。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._counters = {}  # (名称, 标签) -> 数值
+        self._histograms = {}  # (名称, 标签) -> [各分桶计数, 总和, 总数]
+        self._gauges = {}  # 名称 -> 回调函数
+
+    def _declare(self, name, metric_type, help_text):
+        if name not in self._types:
+            self._types[name] = metric_type
+            self._help[name] = help_text
+
+    def inc(self, name, value=1, help_text="", **labels):
+        """计数器加value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, help_text="", buckets=STAGE_BUCKETS, **labels):
+        """直方图记录一次观测值"""
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            self._declare(name, "histogram", help_text)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0, buckets]
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, callback, help_text=""):
+        """注册仪表盘指标，输出时调用callback取当前值"""
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._gauges[name] = callback
+
+    def render(self):
+        """输出Prometheus文本格式"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1], h[2], h[3]) for key, h in self._histograms.items()}
+            gauges = dict(self._gauges)
+            types = dict(self._types)
+            helps = dict(self._help)
+
+        lines = []
+        for name in sorted(types):
+            if helps[name]:
+                lines.append(f"# HELP {name} {helps[name]}")
+            lines.append(f"# TYPE {name} {types[name]}")
+            if types[name] == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+            elif types[name] == "histogram":
+                for (metric, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for upper, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', upper),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+            else:
+                try:
+                    lines.append(f"{name} {gauges[name]()}")
+                except Exception as e:
+                    logger.warning(f"读取指标 {name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+# 全局指标注册表
+metrics = MetricsRegistry()
+
+@contextmanager
+def stage_timer(stage, items=1):
+    """记录一个处理阶段的耗时（card_stage_seconds）和处理数量（card_stage_items_total）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe("card_stage_seconds", time.perf_counter() - start,
+                        "各处理阶段每次调用的耗时（秒）", stage=stage)
+        metrics.inc("card_stage_items_total", items, "各处理阶段处理的图片数量", stage=stage)
+
+def timed(stage):
+    """装饰器：记录函数每次调用的耗时"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_cache_lookup(hits, misses):
+    """记录缓存命中和未命中的数量"""
+    if hits:
+        metrics.inc("card_cache_lookups_total", hits, "证卡缓存查询次数", result="hit")
+    if misses:
+        metrics.inc("card_cache_lookups_total", misses, "证卡缓存查询次数", result="miss")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """在后台线程中启动指标HTTP服务（/metrics），port为0时不启动"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"指标服务已启动: http://{host}:{port}/metrics")
+    return server
\ No newline at end of file
@@ -1,8 +1,15 @@
 # PDF生成功能
 import os
+import gc
+import hashlib
 import tempfile
 import logging
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
+from reportlab import rl_config
+from reportlab.pdfbase import pdfutils
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, portrait
 from reportlab.pdfbase import pdfmetrics
@@ -12,176 +19,571 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import Paragraph
 from reportlab.lib.colors import black
 
+from config import PDF_BINARY_STREAMS, PDF_SHARDS, PDF_ROWS_PER_FILE, PDF_PAGES_PER_PART
+from metrics import timed
+
+# pypdf为可选依赖，仅用于合并分片或分段生成的PDF
+try:
+    from pypdf import PdfReader
+    from pypdf.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject,
+                               NameObject, NullObject, NumberObject)
+except ImportError:
+    PdfReader = None
+
 logger = logging.getLogger(__name__)
 
-def sort_images_by_type(image_paths, image_info_list, names_list):
-    """按照每行先正面后背面的顺序排序图片"""
-    # 创建映射关系
-    path_to_info = {info["path"]: info for info in image_info_list}
-    
+# 图片数据以二进制流写入PDF，不做ASCII85编码（JPEG原样嵌入时体积减少约20%）
+if PDF_BINARY_STREAMS:
+    rl_config.useA85 = 0
+
+def sort_images_by_type(image_info_list):
+    """
+    按照每行先正面后背面的顺序排序证卡
+
+    Args:
+        image_info_list: 每张证卡的记录 {"path", "type", "row_index", "name"}，
+                         同一图片被多行引用时每行各有一条记录（路径相同）
+
+    Returns:
+        list: 排好序的记录
+    """
     # 按行索引分组
     row_groups = {}
-    for img_path in image_paths:
-        if img_path in path_to_info:
-            info = path_to_info[img_path]
-            row_index = info["row_index"]
-            if row_index not in row_groups:
-                row_groups[row_index] = {"正面": [], "背面": []}
-            row_groups[row_index][info["type"]].append(img_path)
+    for info in image_info_list:
+        row_index = info["row_index"]
+        if row_index not in row_groups:
+            row_groups[row_index] = {"正面": [], "背面": []}
+        row_groups[row_index][info["type"]].append(info)
     
     # 按行索引排序并合并
-    sorted_images = []
+    sorted_cards = []
     for row_index in sorted(row_groups.keys()):
         row_data = row_groups[row_index]
         # 先添加正面图片，再添加背面图片
-        sorted_images.extend(row_data["正面"])
-        sorted_images.extend(row_data["背面"])
+        sorted_cards.extend(row_data["正面"])
+        sorted_cards.extend(row_data["背面"])
     
-    return sorted_images
+    return sorted_cards
+
+# 页面布局：A4纵向，每页4行2列
+PAGE_WIDTH, PAGE_HEIGHT = portrait(A4)
+MARGIN = 40
+ROWS_PER_PAGE = 4
+COLS_PER_ROW = 2
+GUTTER = 15
+IMAGES_PER_PAGE = ROWS_PER_PAGE * COLS_PER_ROW
+IMG_WIDTH = (PAGE_WIDTH - 2 * MARGIN - (COLS_PER_ROW-1)*GUTTER) / COLS_PER_ROW
+IMG_HEIGHT = (PAGE_HEIGHT - 2 * MARGIN - (ROWS_PER_PAGE-1)*GUTTER) / ROWS_PER_PAGE
+
+# 边处理边生成时页码中的总页数表单：分段文件中先填写占位符，合并时替换为总页数
+TOTAL_PAGES_FORM = "total_pages"
+TOTAL_PAGES_XOBJECT = "/FormXob." + TOTAL_PAGES_FORM
+TOTAL_PAGES_PLACEHOLDER = "TOTAL"
+
+@functools.lru_cache(maxsize=None)
+def resolve_chinese_font():
+    """查找并注册中文字体，每个进程只执行一次，返回可用的字体名"""
+    try:
+        # 尝试使用系统中文字体
+        font_paths = [
+            "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf"
+        ]
+        
+        for font_path in font_paths:
+            if os.path.exists(font_path):
+                try:
+                    # 检查字体是否已经注册
+                    if 'ChineseFont' not in pdfmetrics.getRegisteredFontNames():
+                        pdfmetrics.registerFont(TTFont('ChineseFont', font_path))
+                    logger.info(f"使用中文字体: {font_path}")
+                    return "ChineseFont"
+                except Exception as e:
+                    logger.warning(f"无法注册字体 {font_path}: {e}")
+                    continue
+        
+        # 如果没有找到中文字体，使用默认字体
+        logger.warning("使用默认英文字体，中文可能显示为方块")
+            
+    except Exception as e:
+        logger.error(f"设置字体失败: {e}")
+    return "Helvetica"
 
-def generate_pdf(image_paths, names_list, output_name):
-    """生成PDF文件，每页4行2列，图片下方添加序号和姓名"""
-    logger.info(f"开始生成PDF: {output_name}, 包含 {len(image_paths)} 张图片")
+def set_chinese_font(c):
+    """设置中文字体，每页都需要调用"""
+    c.setFont(resolve_chinese_font(), 10)
+
+def read_image_size(img_path):
+    """读取图片尺寸：JPEG直接解析文件头，其他格式由PIL读取文件头（均不解码像素）"""
+    with open(img_path, "rb") as f:
+        if f.read(2) == b"\xff\xd8":
+            f.seek(0)
+            try:
+                width, height, _ = pdfutils.readJPEGInfo(f)
+                return width, height
+            except Exception:
+                pass
+    with Image.open(img_path) as img:
+        return img.size
+
+def embedded_image_path(img_path, embedded):
+    """
+    内容相同的图片只嵌入一次：返回同内容图片第一次出现时的路径
+
+    reportlab按文件路径复用已嵌入的XObject，这里按文件内容的哈希把相同的图片映射到同一路径。
+    """
+    if embedded is None:
+        return img_path
+    with open(img_path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return embedded.setdefault(digest, img_path)
+
+def draw_card(c, img_path, slot, label_text, embedded=None):
+    """
+    在当前页第slot个位置绘制一张证卡图片，并在图片下方添加标注
+
+    JPEG文件由reportlab原样嵌入（DCTDecode），不会解码再重新编码；
+    embedded为内容哈希到路径的映射，用于相同图片只嵌入一次。
+    """
+    # 计算行和列的位置
+    row = slot // COLS_PER_ROW
+    col = slot % COLS_PER_ROW
     
-    temp_dir = tempfile.gettempdir()
-    pdf_path = os.path.join(temp_dir, output_name)
+    x = MARGIN + col * (IMG_WIDTH + GUTTER)
+    y = PAGE_HEIGHT - MARGIN - (row + 1) * IMG_HEIGHT - row * GUTTER
     
-    page_width, page_height = portrait(A4)
-    margin = 40
-    rows_per_page = 4
-    cols_per_row = 2
+    width, height = read_image_size(img_path)
+    ratio = width / height
     
-    img_width = (page_width - 2 * margin - (cols_per_row-1)*15) / cols_per_row
-    img_height = (page_height - 2 * margin - (rows_per_page-1)*15) / rows_per_page
+    if ratio > IMG_WIDTH / IMG_HEIGHT:
+        display_width = IMG_WIDTH
+        display_height = IMG_WIDTH / ratio
+    else:
+        display_height = IMG_HEIGHT
+        display_width = IMG_HEIGHT * ratio
     
-    c = canvas.Canvas(pdf_path, pagesize=portrait(A4))
+    x_center = x + (IMG_WIDTH - display_width) / 2
+    y_center = y + (IMG_HEIGHT - display_height) / 2
     
-    # 设置中文字体函数
-    def set_chinese_font():
-        """设置中文字体，每页都需要调用"""
-        try:
-            # 尝试使用系统中文字体
-            font_paths = [
-                "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf"
-            ]
-            
-            chinese_font_registered = False
-            for font_path in font_paths:
-                if os.path.exists(font_path):
-                    try:
-                        # 检查字体是否已经注册
-                        if 'ChineseFont' not in pdfmetrics.getRegisteredFontNames():
-                            pdfmetrics.registerFont(TTFont('ChineseFont', font_path))
-                        c.setFont("ChineseFont", 10)
-                        chinese_font_registered = True
-                        logger.info(f"使用中文字体: {font_path}")
-                        break
-                    except Exception as e:
-                        logger.warning(f"无法注册字体 {font_path}: {e}")
-                        continue
-            
-            if not chinese_font_registered:
-                # 如果没有找到中文字体，使用默认字体
-                c.setFont("Helvetica", 10)
-                logger.warning("使用默认英文字体，中文可能显示为方块")
-                
-        except Exception as e:
-            c.setFont("Helvetica", 10)
-            logger.error(f"设置字体失败: {e}")
+    # 绘制图片
+    c.drawImage(embedded_image_path(img_path, embedded), x_center, y_center, display_width, display_height)
     
-    # 第一页设置字体
-    set_chinese_font()
+    # 在图片下方添加序号和姓名
+    c.drawString(x_center, y_center - 15, label_text)
+
+def card_label(row_index, name, card_type):
+    """生成标注文本：序号_姓名_正/反面"""
+    if name:
+        return f"{row_index + 1}_{name}_{card_type}"
+    return f"{row_index + 1}_{card_type}"
+
+def label_cards(image_info_list):
+    """为排好序的证卡记录生成标注文本，返回 [(图片路径, 标注文本, 行索引)]"""
+    return [(info["path"], card_label(info["row_index"], info.get("name"), info["type"]), info["row_index"])
+            for info in image_info_list]
+
+def render_pages(pdf_path, cards, first_page=1, total_pages=None):
+    """
+    将标注好的证卡按每页4行2列绘制到PDF
+
+    Args:
+        pdf_path: 输出PDF路径
+        cards: [(图片路径, 标注文本, 行索引)]
+        first_page: 第一页的页码（分片生成时为该分片在整个文档中的页码）
+        total_pages: 整个文档的总页数，None表示就是本文件的页数
+    """
+    if total_pages is None:
+        total_pages = (len(cards) + IMAGES_PER_PAGE - 1) // IMAGES_PER_PAGE
     
-    current_page = 0
-    images_per_page = rows_per_page * cols_per_row
+    c = canvas.Canvas(pdf_path, pagesize=portrait(A4))
+    embedded = {}  # 图片内容哈希 -> 首次嵌入的路径
     
-    # 获取图片信息映射
-    from card_processor import processor
-    path_to_info = {}
-    for info in processor.image_info_list:
-        path_to_info[info["path"]] = info
+    # 第一页设置字体
+    set_chinese_font(c)
     
-    # 创建行索引到姓名的映射 - 修复：确保每个行索引只对应一个姓名
-    row_to_name = {}
-    for i, name in enumerate(names_list):
-        if i < len(processor.image_info_list):
-            row_index = processor.image_info_list[i]["row_index"]
-            row_to_name[row_index] = name
+    current_page = first_page - 1
     
-    for page_start in range(0, len(image_paths), images_per_page):
+    for page_start in range(0, len(cards), IMAGES_PER_PAGE):
         if page_start > 0:
             c.showPage()
             current_page += 1
             # 每页都需要重新设置字体
-            set_chinese_font()
+            set_chinese_font(c)
         
-        page_images = image_paths[page_start:page_start + images_per_page]
-        logger.debug(f"生成第 {current_page + 1} 页，包含 {len(page_images)} 张图片")
+        page_cards = cards[page_start:page_start + IMAGES_PER_PAGE]
+        logger.debug(f"生成第 {current_page + 1} 页，包含 {len(page_cards)} 张图片")
         
-        for idx, img_path in enumerate(page_images):
-            # 计算行和列的位置
-            row = idx // cols_per_row
-            col = idx % cols_per_row
-            
-            x = margin + col * (img_width + 15)
-            y = page_height - margin - (row + 1) * img_height - row * 15
-            
+        for idx, (img_path, label_text, _) in enumerate(page_cards):
             try:
-                with Image.open(img_path) as img:
-                    width, height = img.size
-                    ratio = width / height
-                    
-                    if ratio > img_width / img_height:
-                        display_width = img_width
-                        display_height = img_width / ratio
-                    else:
-                        display_height = img_height
-                        display_width = img_height * ratio
-                
-                x_center = x + (img_width - display_width) / 2
-                y_center = y + (img_height - display_height) / 2
-                
-                # 绘制图片
-                c.drawImage(img_path, x_center, y_center, display_width, display_height)
-                
-                # 在图片下方添加序号和姓名
-                text_y = y_center - 15
-                image_index = page_start + idx
-                
-                # 获取图片信息
-                if img_path in path_to_info:
-                    info = path_to_info[img_path]
-                    card_type = info["type"]
-                    row_index = info["row_index"]
-                    
-                    # 获取姓名 - 修复：直接从映射中获取，确保每个行索引只对应一个姓名
-                    name = row_to_name.get(row_index, "")
-                    
-                    # 生成标注文本：序号_姓名_正/反面
-                    # 修复：使用正确的序号计算方式
-                    if name:
-                        label_text = f"{row_index + 1}_{name}_{card_type}"
-                    else:
-                        label_text = f"{row_index + 1}_{card_type}"
-                    
-                    c.drawString(x_center, text_y, label_text)
-                else:
-                    # 如果没有找到图片信息，只显示序号
-                    c.drawString(x_center, text_y, f"{image_index + 1}")
-                
+                draw_card(c, img_path, idx, label_text, embedded)
             except Exception as e:
                 logger.warning(f"无法将图片 {img_path} 添加到PDF: {e}")
                 continue
         
         # 页码 - 使用英文字体确保显示正常
-        total_pages = (len(image_paths) + images_per_page - 1) // images_per_page
         c.setFont("Helvetica", 10)
-        c.drawCentredString(page_width - 30, 20, f"{current_page + 1}/{total_pages}")
+        c.drawCentredString(PAGE_WIDTH - 30, 20, f"{current_page + 1}/{total_pages}")
         # 恢复中文字体
-        set_chinese_font()
+        set_chinese_font(c)
     
     c.save()
+    return pdf_path
+
+@timed("generate_pdf")
+def generate_pdf(image_info_list, output_name, output_dir=None):
+    """生成PDF文件，每页4行2列，图片下方添加序号和姓名（image_info_list为sort_images_by_type排好序的记录）"""
+    logger.info(f"开始生成PDF: {output_name}, 包含 {len(image_info_list)} 张图片")
+    
+    temp_dir = output_dir or tempfile.gettempdir()
+    pdf_path = os.path.join(temp_dir, output_name)
+    
+    render_pages(pdf_path, label_cards(image_info_list))
     logger.info(f"PDF生成完成: {pdf_path}")
-    return pdf_path
\ No newline at end of file
+    return pdf_path
+
+def _renumber(obj, offset):
+    """把对象中的间接引用编号整体加上offset（原地修改字典和数组）"""
+    if isinstance(obj, IndirectObject):
+        return IndirectObject(obj.idnum + offset, 0, None)
+    if isinstance(obj, DictionaryObject):
+        for key, value in list(obj.items()):
+            obj[key] = _renumber(value, offset)
+    elif isinstance(obj, ArrayObject):
+        obj[:] = [_renumber(value, offset) for value in obj]
+    return obj
+
+def _fill_total_pages(form, total_pages):
+    """返回填写了总页数的表单对象（表单内容中的占位符替换为总页数）"""
+    filled = DecodedStreamObject()
+    for key, value in form.items():
+        if key not in ("/Filter", "/DecodeParms", "/Length"):
+            filled[key] = value
+    placeholder = f"({TOTAL_PAGES_PLACEHOLDER})".encode()
+    filled.set_data(form.get_data().replace(placeholder, f"({total_pages})".encode()))
+    return filled
+
+def merge_pdf_parts(part_paths, pdf_path, total_pages=None):
+    """
+    按顺序合并多个PDF文件，逐个对象读取并写出
+
+    pypdf的PdfWriter.append会把所有页面（包括图片数据）读入内存后再一次写出，内存占用随文档大小增长；
+    这里每次只读取一个文件，对象编号整体平移后直接写入输出文件，各文件的页面树挂到新的根节点下，
+    内存占用只与单个文件的大小有关。
+
+    Args:
+        part_paths: 按顺序排列的PDF文件路径（reportlab生成，不含对象流）
+        pdf_path: 输出PDF路径
+        total_pages: 不为None时，把StreamingPdfWriter总页数表单中的占位符替换为该值
+    """
+    offsets = {}  # 对象编号 -> 在输出文件中的位置
+    kids = []
+    page_count = 0
+    next_id = 3  # 1为文档目录，2为页面树根节点，最后写入
+    with open(pdf_path, "wb") as f:
+        f.write(b"%PDF-1.4\n%\x93\x8c\x8b\x9e\n")
+
+        def write_object(idnum, obj):
+            offsets[idnum] = f.tell()
+            f.write(f"{idnum} 0 obj\n".encode())
+            obj.write_to_stream(f)
+            f.write(b"\nendobj\n")
+
+        for part_path in part_paths:
+            # 从文件按需读取对象（不把整个文件读入内存）
+            with open(part_path, "rb") as part:
+                reader = PdfReader(part)
+                offset = next_id - 1
+                catalog = reader.trailer.raw_get("/Root")
+                pages = reader.trailer["/Root"].raw_get("/Pages")
+                forms = set()
+                if total_pages is not None:
+                    for page in reader.pages:
+                        xobjects = page["/Resources"].get("/XObject")
+                        if xobjects is not None and TOTAL_PAGES_XOBJECT in xobjects:
+                            forms.add(xobjects.raw_get(TOTAL_PAGES_XOBJECT).idnum)
+                page_count += len(reader.pages)
+                kids.append(IndirectObject(pages.idnum + offset, 0, None))
+
+                size = reader.trailer["/Size"]
+                for idnum in range(1, size):
+                    if idnum == catalog.idnum:
+                        obj = NullObject()  # 各文件自己的文档目录不再需要
+                    else:
+                        obj = reader.get_object(idnum)
+                        if obj is None:
+                            obj = NullObject()
+                        elif idnum in forms:
+                            obj = _fill_total_pages(obj, total_pages)
+                        obj = _renumber(obj, offset)
+                        if idnum == pages.idnum:
+                            obj[NameObject("/Parent")] = IndirectObject(2, 0, None)
+                    write_object(idnum + offset, obj)
+                next_id += size - 1
+            # pypdf的对象之间存在循环引用，及时回收已写出的对象
+            del reader
+            gc.collect()
+
+        root = DictionaryObject()
+        root[NameObject("/Type")] = NameObject("/Pages")
+        root[NameObject("/Kids")] = ArrayObject(kids)
+        root[NameObject("/Count")] = NumberObject(page_count)
+        write_object(2, root)
+        catalog = DictionaryObject()
+        catalog[NameObject("/Type")] = NameObject("/Catalog")
+        catalog[NameObject("/Pages")] = IndirectObject(2, 0, None)
+        write_object(1, catalog)
+
+        xref = f.tell()
+        f.write(f"xref\n0 {next_id}\n0000000000 65535 f \n".encode())
+        for idnum in range(1, next_id):
+            f.write(f"{offsets[idnum]:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return pdf_path
+
+def _render_parts(jobs, workers):
+    """在多个进程中并行生成PDF分片，jobs为render_pages的参数列表"""
+    if workers <= 1 or len(jobs) <= 1:
+        return [render_pages(*job) for job in jobs]
+    
+    # 使用spawn方式启动，子进程不继承主进程中已加载的模型
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context) as executor:
+            return list(executor.map(render_pages, *zip(*jobs)))
+    except Exception as e:
+        logger.error(f"多进程生成PDF失败，改为单进程生成: {e}")
+        return [render_pages(*job) for job in jobs]
+
+@timed("generate_pdf")
+def generate_pdf_sharded(image_info_list, output_name, output_dir=None,
+                         shards=PDF_SHARDS, rows_per_file=PDF_ROWS_PER_FILE):
+    """
+    分片并行生成PDF：按整页切分排好序的证卡记录（sort_images_by_type），每个分片在单独的进程中绘制，最后合并为一个文件
+
+    页码（n/总页数）和标注在各分片之间保持连续。rows_per_file大于0时，
+    另外按每N行输出一组独立的PDF文件（各自从第1页开始编号）。
+
+    Returns:
+        (pdf_path, part_paths): 合并后的PDF路径，以及按行拆分的PDF路径列表
+    """
+    logger.info(f"开始分片生成PDF: {output_name}, 包含 {len(image_info_list)} 张图片，{shards} 个分片")
+    
+    temp_dir = output_dir or tempfile.gettempdir()
+    pdf_path = os.path.join(temp_dir, output_name)
+    stem = os.path.splitext(output_name)[0]
+    cards = label_cards(image_info_list)
+    total_pages = (len(cards) + IMAGES_PER_PAGE - 1) // IMAGES_PER_PAGE
+    
+    jobs = []
+    if PdfReader is None or shards <= 1 or total_pages <= 1:
+        if shards > 1 and PdfReader is None:
+            logger.warning("未安装pypdf，无法合并分片，改为单进程生成")
+        jobs.append((pdf_path, cards, 1, total_pages))
+        shard_paths = []
+    else:
+        # 按整页切分，保证每个分片的页码从正确的位置开始
+        pages_per_shard = (total_pages + shards - 1) // shards
+        shard_paths = []
+        for shard_index, first_page in enumerate(range(1, total_pages + 1, pages_per_shard)):
+            shard_path = os.path.join(temp_dir, f"{stem}.part{shard_index:03d}.pdf")
+            start = (first_page - 1) * IMAGES_PER_PAGE
+            shard_cards = cards[start:start + pages_per_shard * IMAGES_PER_PAGE]
+            jobs.append((shard_path, shard_cards, first_page, total_pages))
+            shard_paths.append(shard_path)
+    
+    # 按每N行拆分的独立文件
+    part_paths = []
+    if rows_per_file and rows_per_file > 0:
+        groups = {}
+        for card in cards:
+            group_index = card[2] // rows_per_file if card[2] is not None else 0
+            groups.setdefault(group_index, []).append(card)
+        for group_index in sorted(groups):
+            rows = [card[2] for card in groups[group_index] if card[2] is not None] or [0]
+            part_path = os.path.join(temp_dir, f"{stem}_{min(rows) + 1}-{max(rows) + 1}.pdf")
+            jobs.append((part_path, groups[group_index], 1, None))
+            part_paths.append(part_path)
+    
+    _render_parts(jobs, max(1, shards))
+    
+    if shard_paths:
+        # 合并分片
+        merge_pdf_parts(shard_paths, pdf_path)
+        for shard_path in shard_paths:
+            try:
+                os.unlink(shard_path)
+            except OSError:
+                pass
+    
+    logger.info(f"PDF生成完成: {pdf_path}，共 {total_pages} 页" +
+                (f"，另按每 {rows_per_file} 行拆分为 {len(part_paths)} 个文件" if part_paths else ""))
+    return pdf_path, part_paths
+
+class StreamingPdfWriter:
+    """
+    增量生成PDF：按行顺序接收处理完成的证卡，每凑满一页（4行2列）就立即绘制该页
+
+    每行的证卡先正面后背面排列（与sort_images_by_type一致）。某一行有等待用户选择的卡证时，
+    该行及之后的行暂不输出，选择完成后再继续。总页数在最后才能确定，因此页码中的总页数
+    使用一个在保存前才填写内容的PDF表单对象。
+
+    reportlab在保存前把所有页面保留在内存中，因此每绘制pages_per_part页就保存为一个临时分段文件，
+    关闭时用merge_pdf_parts逐个对象合并，并在合并时填写总页数，内存占用不随行数增长。
+    """
+
+    def __init__(self, output_name, output_dir=None, pages_per_part=PDF_PAGES_PER_PART):
+        self.pdf_path = os.path.join(output_dir or tempfile.gettempdir(), output_name)
+        if pages_per_part > 0 and PdfReader is None:
+            logger.warning("未安装pypdf，无法合并分段，PDF将在内存中生成")
+            pages_per_part = 0
+        self.pages_per_part = pages_per_part
+        self._part_paths = []  # 已保存的分段文件
+        self._canvas = None
+        self._canvas_pages = 0  # 当前分段中的页数
+        self._embedded = {}  # 图片内容哈希 -> 首次嵌入的路径
+        self._rows = {}  # 行索引 -> {"cards": [(路径, 类型, 姓名)], "ended": bool, "pending": int}
+        self._next_row = 0  # 下一个等待输出的行索引
+        self._page_buffer = []  # 已就绪、尚未成页的证卡
+        self._page_count = 0
+        self._card_count = 0
+        self._closed = False
+        self._new_canvas()
+
+    def _part_path(self, part_index):
+        stem = os.path.splitext(self.pdf_path)[0]
+        return f"{stem}.stream{part_index:04d}.pdf"
+
+    def _new_canvas(self):
+        """开始一个新的分段（不分段时直接写入最终的PDF文件）"""
+        path = self._part_path(len(self._part_paths)) if self.pages_per_part > 0 else self.pdf_path
+        self._canvas = canvas.Canvas(path, pagesize=portrait(A4))
+        self._canvas_pages = 0
+        set_chinese_font(self._canvas)
+
+    def _save_canvas(self, total_pages):
+        """填写总页数表单并保存当前分段"""
+        c = self._canvas
+        c.beginForm(TOTAL_PAGES_FORM)
+        c.setFont("Helvetica", 10)
+        c.drawString(0, 0, str(total_pages))
+        c.endForm()
+        c.save()
+        self._canvas = None
+
+    def _row(self, row_index):
+        return self._rows.setdefault(row_index, {"cards": [], "ended": False, "pending": 0})
+
+    def add_card(self, row_index, image_path, card_type, name=None):
+        """添加一张处理完成的证卡"""
+        self._row(row_index)["cards"].append((image_path, card_type, name))
+        self._flush_ready_rows()
+
+    def mark_pending(self, row_index):
+        """标记该行有一组卡证等待用户选择"""
+        self._row(row_index)["pending"] += 1
+
+    def resolve_pending(self, row_index):
+        """该行的一组卡证选择完成（选中的卡证需在此之前通过add_card添加）"""
+        row = self._row(row_index)
+        row["pending"] = max(0, row["pending"] - 1)
+        self._flush_ready_rows()
+
+    def end_row(self, row_index):
+        """该行的所有URL都已处理（不包括仍在等待选择的卡证）"""
+        self._row(row_index)["ended"] = True
+        self._flush_ready_rows()
+
+    def _flush_ready_rows(self):
+        """按行顺序把已完成的行放入页面缓冲，凑满一页就绘制"""
+        while self._next_row in self._rows:
+            row = self._rows[self._next_row]
+            if not row["ended"] or row["pending"]:
+                break
+            # 先添加正面图片，再添加背面图片
+            cards = [card for card in row["cards"] if card[1] == "正面"]
+            cards += [card for card in row["cards"] if card[1] != "正面"]
+            self._page_buffer.extend((self._next_row, card) for card in cards)
+            del self._rows[self._next_row]
+            self._next_row += 1
+        
+        while len(self._page_buffer) >= IMAGES_PER_PAGE:
+            self._draw_page(self._page_buffer[:IMAGES_PER_PAGE])
+            self._page_buffer = self._page_buffer[IMAGES_PER_PAGE:]
+
+    @timed("pdf_page")
+    def _draw_page(self, page_cards):
+        if self.pages_per_part > 0 and self._canvas_pages >= self.pages_per_part:
+            # 当前分段已满，保存后释放其占用的内存
+            self._save_canvas(TOTAL_PAGES_PLACEHOLDER)
+            self._part_paths.append(self._part_path(len(self._part_paths)))
+            self._new_canvas()
+        c = self._canvas
+        if self._canvas_pages > 0:
+            c.showPage()
+            # 每页都需要重新设置字体
+            set_chinese_font(c)
+        self._canvas_pages += 1
+        self._page_count += 1
+        logger.debug(f"生成第 {self._page_count} 页，包含 {len(page_cards)} 张图片")
+        
+        for slot, (row_index, (img_path, card_type, name)) in enumerate(page_cards):
+            try:
+                draw_card(c, img_path, slot, card_label(row_index, name, card_type), self._embedded)
+                self._card_count += 1
+            except Exception as e:
+                logger.warning(f"无法将图片 {img_path} 添加到PDF: {e}")
+        
+        # 页码 - 使用英文字体确保显示正常，总页数在保存前填写
+        c.setFont("Helvetica", 10)
+        c.drawRightString(PAGE_WIDTH - 30, 20, f"{self._page_count}/")
+        c.saveState()
+        c.translate(PAGE_WIDTH - 30, 20)
+        c.doForm(TOTAL_PAGES_FORM)
+        c.restoreState()
+        # 恢复中文字体
+        set_chinese_font(c)
+
+    @property
+    def card_count(self):
+        """已写入PDF的证卡数量"""
+        return self._card_count
+
+    def close(self):
+        """输出剩余的证卡并保存PDF，返回PDF路径"""
+        if self._closed:
+            return self.pdf_path
+        
+        # 仍未完成的行（例如选择被放弃）按已有证卡输出
+        for row_index, row in self._rows.items():
+            if row["pending"]:
+                logger.warning(f"第 {row_index + 1} 行仍有未完成的选择，按已有证卡输出")
+            row["ended"] = True
+            row["pending"] = 0
+        # 跳过缺失的行索引，按行顺序输出剩余的行
+        for row_index in sorted(self._rows):
+            if row_index in self._rows:
+                self._next_row = row_index
+                self._flush_ready_rows()
+        
+        if self._page_buffer or self._page_count == 0:
+            self._draw_page(self._page_buffer)
+            self._page_buffer = []
+        
+        if not self._part_paths:
+            # 只有一个分段：直接填写总页数
+            self._save_canvas(self._page_count)
+            if self.pages_per_part > 0:
+                os.replace(self._part_path(0), self.pdf_path)
+        else:
+            self._save_canvas(TOTAL_PAGES_PLACEHOLDER)
+            self._part_paths.append(self._part_path(len(self._part_paths)))
+            merge_pdf_parts(self._part_paths, self.pdf_path, total_pages=self._page_count)
+            for part_path in self._part_paths:
+                try:
+                    os.unlink(part_path)
+                except OSError:
+                    pass
+        self._closed = True
+        logger.info(f"PDF生成完成: {self.pdf_path}，共 {self._page_count} 页 {self._card_count} 张图片")
+        return self.pdf_path
\ No newline at end of file
@@ -0,0 +1,130 @@
+# 批量处理进度（按时间限流刷新界面，完整日志写入文件供下载）
+import time
+import logging
+from collections import deque
+
+from config import PROGRESS_UPDATES_PER_SECOND, PROGRESS_TAIL_LINES
+
+logger = logging.getLogger(__name__)
+
+# 卡证处理结果的显示名称（对应批量处理引擎card事件的status）
+_CARD_STATUS_LABELS = (
+    ("cache_hit", "缓存"),
+    ("saved_selection", "已保存的选择"),
+    ("processed", "新处理"),
+    ("selection_pending", "待选择"),
+    ("no_card", "未检测到"),
+    ("error", "失败"),
+)
+
+# 这些事件总是立即刷新界面
+_FLUSH_EVENTS = ("start", "selection_required", "done")
+
+def format_duration(seconds):
+    """将秒数格式化为“1小时2分”“3分12秒”形式"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}小时{seconds % 3600 // 60}分"
+    if seconds >= 60:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds}秒"
+
+class ProgressTracker:
+    """
+    批量处理进度跟踪
+
+    批量处理引擎的每个事件都写入日志文件，界面只显示汇总（行数、速度、预计剩余时间、
+    各类结果数量）和最近的若干条记录，并且每秒最多刷新 updates_per_second 次。
+    这样处理上万行的CSV时，发送到浏览器的文本大小和次数都不随行数增长。
+    """
+
+    def __init__(self, log_path, updates_per_second=PROGRESS_UPDATES_PER_SECOND, tail_lines=PROGRESS_TAIL_LINES):
+        self.log_path = log_path
+        self.min_interval = 1.0 / updates_per_second if updates_per_second > 0 else 0.0
+        self.tail = deque(maxlen=max(1, tail_lines))  # 最近的进度记录
+        self.waiting = None  # 最新的排队提示（不写入日志）
+        self.total_rows = 0
+        self.start_row = 0
+        self.rows_done = 0  # 本次运行完成的行数（不含恢复任务时已完成的行）
+        self.card_counts = {}  # 卡证处理结果 -> URL数量
+        self.started = time.monotonic()
+        self._last_flush = None
+        self._log = open(log_path, "a", encoding="utf-8")
+
+    def add(self, event):
+        """
+        记录一个进度事件
+
+        Returns:
+            bool: 是否需要刷新界面
+        """
+        kind = event["event"]
+        message = event.get("message")
+
+        if kind == "waiting":
+            self.waiting = message
+        else:
+            self.waiting = None
+            if message:
+                self.write(message)
+
+        if kind == "start":
+            self.total_rows = event["total_rows"]
+            self.start_row = event["start_row"]
+            self.started = time.monotonic()
+        elif kind == "card":
+            self.card_counts[event["status"]] = self.card_counts.get(event["status"], 0) + 1
+        elif kind == "row_done":
+            self.rows_done += 1
+            # 边读取边处理时数据读完才知道总行数
+            self.total_rows = event.get("total_rows") or self.total_rows
+
+        now = time.monotonic()
+        if kind in _FLUSH_EVENTS or self._last_flush is None or now - self._last_flush >= self.min_interval:
+            self._last_flush = now
+            return True
+        return False
+
+    def write(self, message):
+        """写入日志文件，并加入最近记录"""
+        try:
+            self._log.write(message.lstrip("\n") + "\n")
+        except (OSError, ValueError) as e:
+            logger.warning(f"写入进度日志失败: {e}")
+        for line in message.strip("\n").splitlines():
+            self.tail.append(line)
+
+    def summary(self):
+        """进度汇总：已完成行数、处理速度、预计剩余时间和各类结果数量"""
+        done = self.start_row + self.rows_done
+        lines = []
+        if self.total_rows or self.rows_done:
+            if self.total_rows:
+                text = f"进度: {done}/{self.total_rows} 行（{done * 100 / self.total_rows:.1f}%）"
+            else:
+                text = f"进度: {done} 行（数据读取中）"
+            elapsed = time.monotonic() - self.started
+            if self.rows_done and elapsed > 0:
+                rate = self.rows_done / elapsed
+                text += f"，{rate:.2f} 行/秒"
+                if self.total_rows and done < self.total_rows:
+                    text += f"，预计剩余 {format_duration((self.total_rows - done) / rate)}"
+            lines.append(text)
+        counts = [f"{label} {self.card_counts[status]}" for status, label in _CARD_STATUS_LABELS
+                  if self.card_counts.get(status)]
+        if counts:
+            lines.append("图片: " + "，".join(counts))
+        return "\n".join(lines)
+
+    def render(self):
+        """界面显示的进度文本"""
+        parts = [self.summary(), "", *self.tail]
+        if self.waiting:
+            parts.append(self.waiting)
+        return "\n".join(parts).strip("\n")
+
+    def close(self):
+        try:
+            self._log.close()
+        except OSError:
+            pass
\ No newline at end of file
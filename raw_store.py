@@ -0,0 +1,141 @@
+# 原始图片存储（下载的原始数据按URL保存，重新处理时不必再次下载）
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from urllib.parse import urlparse
+
+from image_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "raw_index.sqlite"
+
+class RawImageStore:
+    """
+    下载的原始图片数据的磁盘存储
+
+    文件按URL的哈希存放，索引记录大小、ETag、Last-Modified和最后访问时间；
+    再次下载同一URL时据此发送条件请求，服务器返回304时直接使用保存的数据。
+    总大小超过 max_bytes 时按最后访问时间淘汰最久未使用的文件。
+    """
+
+    def __init__(self, store_dir, max_bytes, min_age=3600):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.min_age = min_age  # 最近访问过的文件不淘汰
+        self._lock = threading.Lock()
+
+        os.makedirs(store_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(store_dir, INDEX_FILE_NAME),
+                                     check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    url TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_access ON images (last_access)")
+
+    def path_for(self, url):
+        """保存文件的路径：URL的哈希（保留原URL的扩展名）"""
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        ext = os.path.splitext(urlparse(url).path)[1].lower() or ".jpg"
+        return os.path.join(self.store_dir, key[:2], key + ext)
+
+    def get(self, url):
+        """
+        读取保存的原始数据
+
+        Returns:
+            (数据, ETag, Last-Modified)，没有保存或文件已丢失时返回None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT path, etag, last_modified FROM images WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+
+        path, etag, last_modified = row
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM images WHERE url = ?", (url,))
+            return None
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE images SET last_access = ? WHERE url = ?", (time.time(), url))
+        return data, etag, last_modified
+
+    def put(self, url, data, etag=None, last_modified=None):
+        """保存下载的原始数据和校验信息，超出容量时淘汰旧文件"""
+        path = self.path_for(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as temp_path:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO images (url, path, size, etag, last_modified, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, path, len(data), etag, last_modified, now, now))
+        self.evict()
+        return path
+
+    def touch(self, url):
+        """服务器确认数据未变化（304）后更新确认时间"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE images SET fetched_at = ?, last_access = ? WHERE url = ?", (now, now, url))
+
+    def total_size(self):
+        """所有保存文件的总大小（字节）"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def evict(self):
+        """总大小超过上限时，按最后访问时间删除最久未使用的文件"""
+        if not self.max_bytes:
+            return 0
+
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+
+        with self._lock:
+            candidates = self._conn.execute(
+                "SELECT url, path, size FROM images WHERE last_access < ? ORDER BY last_access",
+                (time.time() - self.min_age,)).fetchall()
+
+        removed_urls = []
+        freed = 0
+        for url, path, size in candidates:
+            if freed >= excess:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除原始图片失败: {path} - {e}")
+                continue
+            removed_urls.append(url)
+            freed += size
+
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM images WHERE url = ?", [(url,) for url in removed_urls])
+        if removed_urls:
+            logger.info(f"原始图片淘汰 {len(removed_urls)} 个文件，释放 {freed / 1024 / 1024:.1f}MB")
+        return len(removed_urls)
\ No newline at end of file
@@ -0,0 +1,241 @@
+# 检测结果存储（首次推理后持久化，避免重复运行模型）
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+from config import RESULT_JPEG_QUALITY
+from image_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "results.sqlite"
+_QUERY_CHUNK = 500
+
+def _to_list(value):
+    """将numpy数组等转换为可JSON序列化的列表"""
+    if value is None:
+        return []
+    return np.asarray(value).tolist()
+
+class ResultStore:
+    """
+    模型检测结果的持久化存储
+
+    每个URL的全部裁剪结果（output_imgs）以高质量JPEG编码保存在一个npz文件中，
+    多边形、置信度等信息和用户的卡证选择记录在SQLite中，重启后仍然有效。
+    裁剪文件总大小超过 max_bytes 时按最后访问时间淘汰最久未使用的结果（之后再遇到该URL时重新推理）。
+    """
+
+    def __init__(self, store_dir, model_id, max_bytes=0, min_age=3600):
+        self.store_dir = store_dir
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.min_age = min_age  # 最近访问过的结果不淘汰，避免等待选择的任务重新推理
+        self._lock = threading.Lock()
+
+        os.makedirs(store_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(store_dir, INDEX_FILE_NAME),
+                                     check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    card_count INTEGER NOT NULL,
+                    polygons TEXT,
+                    scores TEXT,
+                    path TEXT,
+                    created REAL NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    last_access REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # 旧版索引没有大小和访问时间，补充这两列（已有结果按文件实际大小计入容量）
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(results)")}
+            if "size" not in columns:
+                self._conn.execute("ALTER TABLE results ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute("ALTER TABLE results ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+                rows = self._conn.execute("SELECT key, path, created FROM results WHERE path IS NOT NULL").fetchall()
+                self._conn.executemany("UPDATE results SET size = ?, last_access = ? WHERE key = ?",
+                                       [(os.path.getsize(path) if os.path.exists(path) else 0, created, key)
+                                        for key, path, created in rows])
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_access ON results (last_access)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS selections (
+                    url TEXT NOT NULL,
+                    card_type TEXT NOT NULL,
+                    indices TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (url, card_type)
+                )
+            """)
+
+    def make_key(self, url):
+        """结果键：URL和模型ID的哈希"""
+        return hashlib.sha1(f"{self.model_id}\n{url}".encode("utf-8")).hexdigest()
+
+    def save_result(self, url, result):
+        """保存一次推理的完整结果（所有裁剪图片、多边形和置信度），超出容量时淘汰旧结果"""
+        key = self.make_key(url)
+        output_imgs = [img for img in (result or {}).get("output_imgs") or [] if isinstance(img, np.ndarray)]
+
+        path = None
+        if output_imgs:
+            path = os.path.join(self.store_dir, key[:2], key + ".npz")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            encoded = {}
+            for j, img in enumerate(output_imgs):
+                # 带透明通道等JPEG无法保存的图片仍使用PNG，读取时按文件内容识别格式
+                if img.ndim == 2 or img.shape[2] == 3:
+                    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, RESULT_JPEG_QUALITY])
+                else:
+                    ok, buffer = cv2.imencode(".png", img)
+                if not ok:
+                    raise ValueError(f"裁剪结果编码失败: {url} 第 {j+1} 张")
+                encoded[f"card_{j}"] = buffer
+            # 先写临时文件再替换，避免读取到不完整的文件
+            with atomic_write(path) as temp_path:
+                with open(temp_path, "wb") as f:
+                    np.savez(f, **encoded)
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results "
+                "(key, url, model_id, card_count, polygons, scores, path, created, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, self.model_id, len(output_imgs),
+                 json.dumps(_to_list(result.get("polygons") if result else None)),
+                 json.dumps(_to_list(result.get("scores") if result else None)),
+                 path, now, os.path.getsize(path) if path else 0, now))
+        logger.info(f"检测结果已保存: {url} ({len(output_imgs)} 张卡证)")
+        self.evict()
+        return key
+
+    def lookup_many(self, urls):
+        """
+        批量查询已保存的检测结果
+
+        Returns:
+            dict: URL -> 卡证数量（只包含已保存结果的URL）
+        """
+        url_by_key = {self.make_key(url): url for url in set(urls)}
+        key_list = list(url_by_key)
+        found = {}
+        hit_keys = []
+        with self._lock:
+            for start in range(0, len(key_list), _QUERY_CHUNK):
+                chunk = key_list[start:start + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for key, card_count, path in self._conn.execute(
+                        f"SELECT key, card_count, path FROM results WHERE key IN ({placeholders})", chunk):
+                    # 裁剪文件丢失时视为没有结果，重新推理
+                    if card_count and not (path and os.path.exists(path)):
+                        continue
+                    found[url_by_key[key]] = card_count
+                    hit_keys.append(key)
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE results SET last_access = ? WHERE key = ?",
+                                   [(now, key) for key in hit_keys])
+        return found
+
+    def load_result(self, url, indices=None):
+        """
+        读取已保存的检测结果
+
+        Args:
+            url: 图片URL
+            indices: 需要读取的裁剪图片序号，None表示全部
+
+        Returns:
+            dict: 与模型输出格式一致（output_imgs/polygons/scores），不存在时返回None
+        """
+        key = self.make_key(url)
+        with self._lock:
+            row = self._conn.execute("SELECT card_count, polygons, scores, path FROM results WHERE key = ?",
+                                     (key,)).fetchone()
+        if row is None:
+            return None
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        card_count, polygons, scores, path = row
+        if indices is None:
+            indices = range(card_count)
+
+        output_imgs = []
+        if card_count:
+            with np.load(path) as data:
+                for j in indices:
+                    if 0 <= j < card_count:
+                        output_imgs.append(cv2.imdecode(data[f"card_{j}"], cv2.IMREAD_UNCHANGED))
+        return {
+            "output_imgs": output_imgs,
+            "polygons": np.array(json.loads(polygons or "[]")),
+            "scores": np.array(json.loads(scores or "[]")),
+        }
+
+    def total_size(self):
+        """所有裁剪文件的总大小（字节）"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def evict(self):
+        """总大小超过上限时，按最后访问时间删除最久未使用的检测结果（用户的选择记录保留）"""
+        if not self.max_bytes:
+            return 0
+
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+
+        with self._lock:
+            candidates = self._conn.execute(
+                "SELECT key, path, size FROM results WHERE path IS NOT NULL AND last_access < ? "
+                "ORDER BY last_access", (time.time() - self.min_age,)).fetchall()
+
+        removed_keys = []
+        freed = 0
+        for key, path, size in candidates:
+            if freed >= excess:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除检测结果失败: {path} - {e}")
+                continue
+            removed_keys.append(key)
+            freed += size
+
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM results WHERE key = ?", [(key,) for key in removed_keys])
+        if removed_keys:
+            logger.info(f"检测结果淘汰 {len(removed_keys)} 个，释放 {freed / 1024 / 1024:.1f}MB")
+        return len(removed_keys)
+
+    def save_selection(self, url, card_type, selected_indices):
+        """保存用户对多卡证图片的选择"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO selections (url, card_type, indices, updated) VALUES (?, ?, ?, ?)",
+                (url, card_type, json.dumps(list(selected_indices)), time.time()))
+
+    def get_selection(self, url, card_type):
+        """获取用户保存的选择，没有保存过时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT indices FROM selections WHERE url = ? AND card_type = ?",
+                                     (url, card_type)).fetchone()
+        return json.loads(row[0]) if row else None
\ No newline at end of file
@@ -0,0 +1,138 @@
+# 多任务公平调度（多个用户同时批量处理时共享模型推理能力）
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from config import MODEL_WORKERS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class Ticket:
+    """一次推理请求的排队凭证"""
+
+    def __init__(self, scheduler, job_id):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.created = time.monotonic()
+        self.granted_at = None
+
+    @property
+    def granted(self):
+        return self.granted_at is not None
+
+    @property
+    def waited(self):
+        """已排队（或排队到获得执行权为止）的秒数"""
+        return (self.granted_at or time.monotonic()) - self.created
+
+    def wait(self, timeout=None):
+        """等待获得执行权，超时返回False（仍保留排队位置）"""
+        return self.scheduler._wait(self, timeout)
+
+class FairScheduler:
+    """
+    公平调度器：模型同时只能执行 capacity 次推理，多个任务排队时按任务轮转分配
+
+    每次有空闲名额时，优先分配给正在执行数量最少、且最久没有分配到名额的任务，
+    这样一个大批量任务不会把其他用户的任务挡在后面。
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self._cond = threading.Condition()
+        self._waiting = {}  # 任务ID -> 排队中的凭证列表（按提交顺序）
+        self._running = {}  # 任务ID -> 正在执行的数量
+        self._last_grant = {}  # 任务ID -> 最近一次分配名额的时间
+        self._wait_totals = {}  # 任务ID -> (累计排队秒数, 推理次数)
+
+    def request(self, job_id):
+        """提交一次推理请求，返回排队凭证"""
+        ticket = Ticket(self, job_id)
+        with self._cond:
+            self._waiting.setdefault(job_id, []).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def release(self, ticket):
+        """推理完成后释放名额；尚未获得名额的凭证则取消排队"""
+        with self._cond:
+            if ticket.granted:
+                self._running[ticket.job_id] -= 1
+                if not self._running[ticket.job_id]:
+                    del self._running[ticket.job_id]
+            else:
+                queue = self._waiting.get(ticket.job_id, [])
+                if ticket in queue:
+                    queue.remove(ticket)
+                if not queue:
+                    self._waiting.pop(ticket.job_id, None)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, job_id):
+        """阻塞等待名额，在with块内执行推理"""
+        ticket = self.request(job_id)
+        try:
+            ticket.wait()
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _wait(self, ticket, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: ticket.granted, timeout)
+
+    def _dispatch(self):
+        """有空闲名额时按公平顺序分配（调用时需持有锁）"""
+        granted = False
+        while self._waiting and sum(self._running.values()) < self.capacity:
+            job_id = min(self._waiting, key=lambda j: (self._running.get(j, 0), self._last_grant.get(j, 0.0)))
+            queue = self._waiting[job_id]
+            ticket = queue.pop(0)
+            if not queue:
+                del self._waiting[job_id]
+
+            ticket.granted_at = time.monotonic()
+            self._running[job_id] = self._running.get(job_id, 0) + 1
+            self._last_grant[job_id] = ticket.granted_at
+            total, count = self._wait_totals.get(job_id, (0.0, 0))
+            self._wait_totals[job_id] = (total + ticket.waited, count + 1)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def status(self, job_id=None):
+        """
+        当前排队情况
+
+        Returns:
+            dict: queue_depth（排队中的请求数）、waiting_jobs（排队中的任务数）、
+                  running（正在执行的推理数）、capacity、以及该任务的 waited（当前请求已等待秒数）
+                  和 total_wait（该任务累计排队秒数）
+        """
+        with self._cond:
+            queue = self._waiting.get(job_id, [])
+            total_wait, _ = self._wait_totals.get(job_id, (0.0, 0))
+            return {
+                "queue_depth": sum(len(q) for q in self._waiting.values()),
+                "waiting_jobs": len(self._waiting),
+                "running": sum(self._running.values()),
+                "capacity": self.capacity,
+                "waited": queue[0].waited if queue else 0.0,
+                "total_wait": total_wait,
+            }
+
+    def forget(self, job_id):
+        """任务结束后清除其统计信息"""
+        with self._cond:
+            self._last_grant.pop(job_id, None)
+            self._wait_totals.pop(job_id, None)
+
+# 全局调度器：名额数与可同时推理的模型实例数一致
+scheduler = FairScheduler(max(1, MODEL_WORKERS))
+
+metrics.gauge("card_scheduler_queue_depth", lambda: scheduler.status()["queue_depth"], "排队等待推理的请求数")
+metrics.gauge("card_scheduler_waiting_jobs", lambda: scheduler.status()["waiting_jobs"], "排队等待推理的任务数")
+metrics.gauge("card_scheduler_running", lambda: scheduler.status()["running"], "正在执行的推理数")
\ No newline at end of file
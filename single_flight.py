@@ -0,0 +1,97 @@
+# 合并进行中的相同请求（single-flight）：同一个键同时只计算一次，并发的请求等待并共享结果
+import logging
+import threading
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class Flight:
+    """一次进行中的计算"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def resolve(self, result=None, error=None):
+        """记录计算结果（或异常）并唤醒所有等待者"""
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        等待计算完成并返回结果
+
+        Raises:
+            TimeoutError: 超时仍未完成
+            Exception: 计算时抛出的异常
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("等待进行中的相同请求超时")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """
+    进程内的相同请求合并
+
+    第一个请求某个键的调用方负责计算（leader），计算期间其他请求同一个键的调用方等待并共享结果；
+    计算完成后不保留结果（之后的请求由缓存等持久化存储负责）。
+    """
+
+    def __init__(self, name):
+        self.name = name  # 用于指标标签
+        self._lock = threading.Lock()
+        self._flights = {}  # 键 -> 进行中的Flight
+
+    def claim(self, key):
+        """
+        登记一次请求
+
+        Returns:
+            (flight, leader): leader为True时调用方负责计算，完成后必须调用finish；
+                              否则调用flight.wait()等待结果
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                metrics.inc("card_single_flight_shared_total", 1, "等待进行中的相同请求而没有重复计算的次数", flight=self.name)
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key, flight, result=None, error=None):
+        """leader完成计算：移除登记并把结果交给等待者"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.resolve(result, error)
+
+    def do(self, key, fn, *args, **kwargs):
+        """执行fn(*args, **kwargs)，同一个键正在计算时等待并返回其结果"""
+        flight, leader = self.claim(key)
+        if not leader:
+            return flight.wait()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result=result)
+        return result
+
+    def __len__(self):
+        """进行中的计算数量"""
+        with self._lock:
+            return len(self._flights)
+
+# 全局实例：同一URL的推理、同一张证卡的缓存写入
+inference_flights = SingleFlight("inference")
+cache_flights = SingleFlight("save_to_cache")
\ No newline at end of file
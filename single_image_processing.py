@@ -6,6 +6,8 @@ import numpy as np
 
 from card_processor import processor
 from image_utils import process_image_format
+from metrics import stage_timer
+from scheduler import scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -25,8 +27,9 @@ def process_single_image(image, output_format="png"):
     
     try:
         logger.info("调用模型处理图片...")
-        # 处理图片
-        result = processor.model(image)
+        # 处理图片（与批量处理任务共享模型，按公平调度排队）
+        with scheduler.slot("single"), stage_timer("inference"):
+            result = processor.model(image)
         logger.info(f"模型返回结果: {type(result)}")
         
         if not result or "output_imgs" not in result or not result["output_imgs"]:
@@ -0,0 +1,92 @@
+# 多卡证选择界面的缩略图（内存中LRU缓存，不写临时文件）
+import logging
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from config import THUMBNAIL_SIZE, THUMBNAIL_CACHE_BYTES
+from image_utils import to_uint8
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def make_thumbnail(image_bgr, size=THUMBNAIL_SIZE):
+    """
+    生成长边不超过size的RGB缩略图
+
+    先用INTER_AREA缩小（缩小时质量好且比LANCZOS快得多），再在缩小后的图像上转换颜色。
+    """
+    image = to_uint8(image_bgr)
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+class ThumbnailCache:
+    """
+    按 (URL, 卡证序号) 缓存的缩略图（RGB的numpy数组，可直接作为Gallery的值）
+
+    总大小超过 max_bytes 时淘汰最久未使用的缩略图。同一图片再次需要选择时（重新处理、恢复任务）直接使用。
+    """
+
+    def __init__(self, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # (URL, 序号) -> 缩略图
+        self._bytes = 0
+
+    def get(self, url, index, image=None):
+        """返回缩略图；没有缓存时由image（模型输出的BGR图像）生成，image为None时返回None"""
+        key = (url, index)
+        with self._lock:
+            thumbnail = self._items.get(key)
+            if thumbnail is not None:
+                self._items.move_to_end(key)
+                metrics.inc("card_thumbnail_cache_total", 1, "选择界面缩略图的缓存查询次数", result="hit")
+                return thumbnail
+        if image is None:
+            return None
+
+        metrics.inc("card_thumbnail_cache_total", 1, "选择界面缩略图的缓存查询次数", result="miss")
+        thumbnail = make_thumbnail(image)
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._items[key] = thumbnail
+            self._bytes += thumbnail.nbytes
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return thumbnail
+
+    def get_cached(self, url, count):
+        """URL对应的count张卡证的缩略图都已缓存时按序号返回，否则返回None"""
+        cached = [self.get(url, index) for index in range(count)]
+        return cached if count and all(thumbnail is not None for thumbnail in cached) else None
+
+    def get_many(self, url, output_imgs):
+        """多卡证图片中每张卡证的缩略图（跳过不是图像的输出）"""
+        thumbnails = []
+        for index, image in enumerate(output_imgs):
+            if isinstance(image, np.ndarray):
+                try:
+                    thumbnails.append(self.get(url, index, image))
+                except Exception as e:
+                    logger.error(f"生成缩略图失败: {url} 第 {index + 1} 张 - {e}")
+        return thumbnails
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+# 全局缩略图缓存（所有任务共用）
+thumbnails = ThumbnailCache()
\ No newline at end of file
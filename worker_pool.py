@@ -0,0 +1,77 @@
+# 多进程模型工作池
+import os
+import atexit
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# 工作进程内的处理器实例（每个进程只加载一次模型）
+_worker_processor = None
+
+def _init_worker(torch_threads):
+    """工作进程初始化：限制计算线程数，避免多个进程抢占CPU核心，然后加载模型"""
+    global _worker_processor
+    for env_name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[env_name] = str(torch_threads)
+
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        # 使用onnx后端时可以不安装torch
+        pass
+
+    from card_processor import CardProcessor
+    _worker_processor = CardProcessor(use_worker_pool=False)
+    if not _worker_processor.init_model():
+        logger.error(f"工作进程 {os.getpid()} 模型初始化失败")
+
+def _run_batch(args):
+    """在工作进程中执行一批推理"""
+    images, batch_size = args
+    if _worker_processor is None or not _worker_processor.model_loaded:
+        return [RuntimeError("工作进程模型未加载") for _ in images]
+
+    results = _worker_processor.process_many(images, batch_size=batch_size)
+    # 异常对象不一定能被pickle，统一转换为RuntimeError
+    return [RuntimeError(str(r)) if isinstance(r, Exception) else r for r in results]
+
+class ModelWorkerPool:
+    """多进程模型工作池，每个进程持有一个模型实例"""
+
+    def __init__(self, size, torch_threads=0):
+        self.size = size
+        # 未指定时按CPU核心数平均分配给各个进程
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // size)
+        self._pool = None
+
+    def start(self):
+        """启动工作进程"""
+        if self._pool is None:
+            logger.info(f"启动模型工作池: {self.size} 个进程，每个进程 {self.torch_threads} 个线程")
+            # 使用spawn方式启动，避免fork已初始化的torch线程池
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(self.size, initializer=_init_worker,
+                                      initargs=(self.torch_threads,))
+            atexit.register(self.close)
+        return self
+
+    def process_many(self, images, batch_size):
+        """将图片按批次分发到各个工作进程，结果按输入顺序返回"""
+        self.start()
+        batch_size = max(1, batch_size)
+        batches = [(images[i:i + batch_size], batch_size) for i in range(0, len(images), batch_size)]
+
+        results = []
+        for batch_results in self._pool.imap(_run_batch, batches):
+            results.extend(batch_results)
+        return results
+
+    def close(self):
+        """关闭工作进程"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            logger.info("模型工作池已关闭")
\ No newline at end of file